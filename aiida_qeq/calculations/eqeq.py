@@ -6,11 +6,13 @@ Register calculations via the "aiida.calculations" entry point in setup.json.
 """
 
 from aiida.engine import CalcJob
-from aiida.orm import SinglefileData, Data
-from aiida.common.datastructures import (CalcInfo, CodeInfo)
+from aiida.orm import SinglefileData, Data, ArrayData, Dict
+from aiida.common.datastructures import (CalcInfo, CodeInfo, CodeRunMode)
 from aiida.plugins import DataFactory
 
 EQeqParameters = DataFactory('qeq.eqeq')
+EQeqIonizationTable = DataFactory('qeq.ionization_table')
+EQeqChargeCenterTable = DataFactory('qeq.charge_center_table')
 CifData = DataFactory('cif')
 
 
@@ -30,20 +32,51 @@ class EQeqCalculation(CalcJob):
             'num_mpiprocs_per_machine': 1,
         }
         spec.inputs['metadata']['options']['withmpi'].default = False
+        spec.input('metadata.options.profile_parser',
+                   valid_type=bool,
+                   default=False,
+                   help='Run the parser under cProfile and add the statistics as `parser_profile` output.')
 
         spec.input('parameters', valid_type=EQeqParameters, help='Command line parameters for EQEQ')
         spec.input('ionization_data',
-                   valid_type=SinglefileData,
-                   help='File containing ionization data on the elements.')
+                   valid_type=(SinglefileData, EQeqIonizationTable),
+                   help='File or table containing ionization data on the elements.')
         spec.input('charge_data',
-                   valid_type=SinglefileData,
-                   help='File containing information on common oxidation state of the elements.')
+                   valid_type=(SinglefileData, EQeqChargeCenterTable),
+                   help='File or table containing information on common oxidation state of the elements.')
         spec.input('structure',
                    valid_type=CifData,
                    help='Input structure, for which atomic charges are to be computed.')
 
         spec.outputs.dynamic = True
         spec.outputs.valid_type = Data
+        spec.output('charges',
+                    valid_type=ArrayData,
+                    required=False,
+                    help='Partial charges (array "charges") and atomic numbers (array "atomic_numbers") of the atoms.')
+        spec.output('structure_with_charges',
+                    valid_type=CifData,
+                    required=False,
+                    help='Input structure with the charges in the `_atom_site_charge` column.')
+        spec.output_namespace('charges_sweep',
+                              valid_type=ArrayData,
+                              dynamic=True,
+                              help='Charges for each (lambda, hI0) combination of a parameter sweep.')
+        spec.output_namespace('structure_with_charges_sweep',
+                              valid_type=CifData,
+                              dynamic=True,
+                              help='Structure with charges for each (lambda, hI0) combination of a parameter sweep.')
+        spec.output('metrics',
+                    valid_type=Dict,
+                    required=False,
+                    help='Wall time of eqeq, parse time, number of atoms, retrieved file sizes.')
+        spec.output('parser_profile',
+                    valid_type=SinglefileData,
+                    required=False,
+                    help='cProfile statistics of the parser (if the `profile_parser` option is set).')
+
+        spec.exit_code(803, 'ERROR_CHARGES_INCONSISTENT', 'Charges in the json file do not match the input structure.')
+        spec.exit_code(804, 'ERROR_MISSING_OUTPUT', 'No charges were found for any point of the parameter sweep.')
 
     def prepare_for_submission(self, folder):
         """Create the input files from the input nodes passed to this instance of the `CalcJob`.
@@ -51,28 +84,47 @@ class EQeqCalculation(CalcJob):
         :param folder: an `aiida.common.folders.Folder` to temporarily write files on disk
         :return: `aiida.common.datastructures.CalcInfo` instance
         """
-        # Prepare CodeInfo object for aiida
-        codeinfo = CodeInfo()
-        codeinfo.code_uuid = self.inputs.code.uuid
-        codeinfo.cmdline_params = self.inputs.parameters.cmdline_params(
-            structure_file_name=self.inputs.structure.filename,
-            ionization_file_name=self.inputs.ionization_data.filename,
-            charge_file_name=self.inputs.charge_data.filename)
-        codeinfo.stdout_name = self._LOG_FILE_NAME
+        from aiida_qeq.data.eqeq import sweep_key
+        from aiida_qeq.data.tables import local_copy_entries
+        from aiida_qeq.utils.metrics import TIMING_FILE_NAME, timing_texts
+
+        parameters = self.inputs.parameters
+        # a parameter sweep runs eqeq once per (lambda, hI0) combination, in the same folder
+        points = parameters.sweep_points if parameters.is_sweep else [None]
+        codes_info = []
+        output_dicts = []
+        for point in points:
+            codeinfo = CodeInfo()
+            codeinfo.code_uuid = self.inputs.code.uuid
+            codeinfo.cmdline_params = parameters.cmdline_params(
+                structure_file_name=self.inputs.structure.filename,
+                ionization_file_name=self.inputs.ionization_data.filename,
+                charge_file_name=self.inputs.charge_data.filename,
+                point=point)
+            codeinfo.stdout_name = self._LOG_FILE_NAME if point is None else 'eqeq_{}.log'.format(sweep_key(point))
+            codeinfo.withmpi = self.inputs.metadata.options.withmpi
+            codes_info.append(codeinfo)
+            output_dicts.append(parameters.output_files_dict(self.inputs.structure.filename, point))
 
         # Prepare CalcInfo object for aiida
         calcinfo = CalcInfo()
         calcinfo.uuid = self.uuid
+        calcinfo.prepend_text, calcinfo.append_text = timing_texts()
         calcinfo.local_copy_list = [
             [self.inputs.structure.uuid, self.inputs.structure.filename, self.inputs.structure.filename],
-            [
-                self.inputs.ionization_data.uuid, self.inputs.ionization_data.filename,
-                self.inputs.ionization_data.filename
-            ],
-            [self.inputs.charge_data.uuid, self.inputs.charge_data.filename, self.inputs.charge_data.filename],
         ]
+        calcinfo.local_copy_list += local_copy_entries(self.inputs.ionization_data, folder)
+        calcinfo.local_copy_list += local_copy_entries(self.inputs.charge_data, folder)
         calcinfo.remote_copy_list = []
-        calcinfo.retrieve_list = self.inputs.parameters.output_files(self.inputs.structure.filename)
-        calcinfo.codes_info = [codeinfo]
+        # the charges in the JSON file are parsed into the `charges` output, the file itself is not stored
+        calcinfo.retrieve_list = []
+        calcinfo.retrieve_temporary_list = [TIMING_FILE_NAME]
+        for output_dict in output_dicts:
+            calcinfo.retrieve_list += [name for ext, name in output_dict.items() if ext != 'json']
+            if 'json' in output_dict:
+                calcinfo.retrieve_temporary_list.append(output_dict['json'])
+        calcinfo.codes_info = codes_info
+        # the points of a sweep run one after the other
+        calcinfo.codes_run_mode = CodeRunMode.SERIAL
 
         return calcinfo
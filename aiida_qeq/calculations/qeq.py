@@ -7,11 +7,13 @@ Register calculations via the "aiida.calculations" entry point in setup.json.
 
 import io
 from aiida.engine import CalcJob
-from aiida.orm import SinglefileData, Data
+from aiida.orm import SinglefileData, Data, ArrayData, Dict
 from aiida.common.datastructures import (CalcInfo, CodeInfo)
 from aiida.plugins import DataFactory
 
 QeqParameters = DataFactory('qeq.qeq')
+QeqElementTable = DataFactory('qeq.element_table')
+GridData = DataFactory('qeq.grid')
 CifData = DataFactory('cif')
 
 
@@ -29,26 +31,59 @@ class QeqCalculation(CalcJob):
             'num_mpiprocs_per_machine': 1,
         }
         spec.inputs['metadata']['options']['withmpi'].default = False
+        spec.input('metadata.options.profile_parser',
+                   valid_type=bool,
+                   default=False,
+                   help='Run the parser under cProfile and add the statistics as `parser_profile` output.')
 
         spec.input('configure',
                    valid_type=QeqParameters,
                    help='Configuration input for QEQ (configure.input file)',
                    required=False)
         spec.input('parameters',
-                   valid_type=SinglefileData,
-                   help='File containing electronegativity and Idempotential data of the elements.')
+                   valid_type=(SinglefileData, QeqElementTable),
+                   help='File or table containing electronegativity and Idempotential data of the elements.')
         spec.input('structure',
                    valid_type=CifData,
                    help='Input structure, for which atomic charges are to be computed.')
 
         spec.outputs.dynamic = True
         spec.outputs.valid_type = Data
+        spec.output('charges',
+                    valid_type=ArrayData,
+                    required=False,
+                    help='Partial charges (array "charges") and atomic numbers (array "atomic_numbers") of the atoms.')
+        spec.output('structure_with_charges',
+                    valid_type=CifData,
+                    required=False,
+                    help='Input structure with the charges in the `_atom_site_charge` column.')
+        spec.output('grid',
+                    valid_type=GridData,
+                    required=False,
+                    help='Grid written by egulp (`save_grid` option), unless kept on the remote.')
+        spec.output('potential',
+                    valid_type=GridData,
+                    required=False,
+                    help='Electrostatic potential cube file (`calculate_pot` option), unless kept on the remote.')
+        spec.output('output_parameters',
+                    valid_type=Dict,
+                    required=False,
+                    help='Data extracted from the log: cell, number of atoms, remapped atoms and SCF trace.')
+        spec.output('metrics',
+                    valid_type=Dict,
+                    required=False,
+                    help='Wall time of egulp, parse time, number of atoms and SCF iterations, retrieved file sizes.')
+        spec.output('parser_profile',
+                    valid_type=SinglefileData,
+                    required=False,
+                    help='cProfile statistics of the parser (if the `profile_parser` option is set).')
 
         spec.exit_code(
             800, 'ERROR_SEGFAULT',
             'egulp program sefaulted. This can happend, for example, when parsing non-supported CIF formats.')
         spec.exit_code(801, 'ERROR_SCF_NOT_CONVERGED', 'SCF of qeq method did not converge')
         spec.exit_code(802, 'ERROR_SEGFAULT', 'Program')
+        spec.exit_code(803, 'ERROR_CHARGES_INCONSISTENT', 'Charges in charges.dat do not match the input structure.')
 
     def prepare_for_submission(self, folder):
         """Create the input files from the input nodes passed to this instance of the `CalcJob`.
@@ -56,7 +91,10 @@ class QeqCalculation(CalcJob):
         :param folder: an `aiida.common.folders.Folder` to temporarily write files on disk
         :return: `aiida.common.datastructures.CalcInfo` instance
         """
-        from aiida_qeq.data.qeq import DEFAULT_CONFIGURE_FILE_NAME, LOG_FILE_NAME
+        from aiida_qeq.data.qeq import (DEFAULT_CONFIGURE_FILE_NAME, ENERGY_FILE_NAME, LOG_FILE_NAME,
+                                        LOG_SUMMARY_PATTERNS)
+        from aiida_qeq.data.tables import local_copy_entries
+        from aiida_qeq.utils import metrics, transfer
 
         try:
             configure = self.inputs.configure
@@ -79,13 +117,24 @@ class QeqCalculation(CalcJob):
         # Prepare CalcInfo object for aiida
         calcinfo = CalcInfo()
         calcinfo.uuid = self.uuid
+        calcinfo.prepend_text, calcinfo.append_text = metrics.timing_texts()
+        # only the lines of the log needed by the parser and its last lines (for error reports) are retrieved
+        calcinfo.append_text += '\n' + transfer.log_summary_text(LOG_FILE_NAME, LOG_SUMMARY_PATTERNS)
+        retrieved_files = configure.output_files + list(configure.retrieved_grid_files.values())
+        compress = configure.compress_min_size is not None
+        if compress:
+            calcinfo.append_text += '\n' + transfer.compress_text(retrieved_files, configure.compress_min_size)
         calcinfo.local_copy_list = [
             [self.inputs.structure.uuid, self.inputs.structure.filename, self.inputs.structure.filename],
-            [self.inputs.parameters.uuid, self.inputs.parameters.filename, self.inputs.parameters.filename],
-        ]
+        ] + local_copy_entries(self.inputs.parameters, folder)
         calcinfo.remote_copy_list = []
-        calcinfo.retrieve_list = configure.output_files
-        calcinfo.retrieve_temporary_list = [LOG_FILE_NAME]  # check output for error reports
+        calcinfo.retrieve_list = transfer.retrieve_names(retrieved_files, compressed=compress)
+        # check output for error reports and collect metrics
+        calcinfo.retrieve_temporary_list = [
+            transfer.LOG_SUMMARY_FILE_NAME, transfer.LOG_TAIL_FILE_NAME, metrics.TIMING_FILE_NAME
+        ]
+        if ENERGY_FILE_NAME not in configure.output_files:
+            calcinfo.retrieve_temporary_list.append(ENERGY_FILE_NAME)
         calcinfo.codes_info = [codeinfo]
 
         return calcinfo
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Calculations provided by aiida_qeq for running Qeq on many structures in one job.
+
+Register calculations via the "aiida.calculations" entry point in setup.json.
+"""
+
+import io
+import os
+from aiida.engine import CalcJob
+from aiida.orm import SinglefileData, Data
+from aiida.common.datastructures import (CalcInfo, CodeInfo)
+from aiida.plugins import DataFactory
+
+QeqParameters = DataFactory('qeq.qeq')
+QeqElementTable = DataFactory('qeq.element_table')
+CifData = DataFactory('cif')
+
+BATCH_SCRIPT_NAME = '_run_batch.sh'
+EXIT_STATUS_FILE_NAME = 'exit_status'
+STDERR_FILE_NAME = 'stderr.txt'
+
+# Runs egulp in the directory of each structure, at most NPARALLEL at a time.
+# The structure in FIRST_DIR is run by the code in the foreground of the job script and holds one of the NPARALLEL
+# slots until its exit status has been written.
+# Usage: _run_batch.sh EGULP NPARALLEL PARAM_FILE CONFIGURE_FILE FIRST_DIR [DIR2 CIF2 ...]
+BATCH_SCRIPT = """#!/bin/bash
+EGULP="$1"; NPARALLEL="$2"; PARAM_FILE="$3"; CONFIGURE_FILE="$4"; FIRST_DIR="$5"
+shift 5
+TOP="$(pwd)"
+case "$EGULP" in /*) ;; *) EGULP="$TOP/$EGULP" ;; esac
+
+run_egulp() {{
+    cd "$TOP/$1" || return
+    "$EGULP" "$2" "$TOP/$PARAM_FILE" "$TOP/$CONFIGURE_FILE" > {log} 2> {stderr}
+    echo $? > {exit_status}
+}}
+
+num_running() {{
+    local num="$(jobs -rp | wc -l)"
+    [ -e "$TOP/$FIRST_DIR/{exit_status}" ] || num=$((num + 1))
+    echo "$num"
+}}
+
+while [ "$#" -gt 1 ]; do
+    while [ "$(num_running)" -ge "$NPARALLEL" ]; do
+        sleep 1
+    done
+    run_egulp "$1" "$2" &
+    shift 2
+done
+wait
+"""
+
+
+class QeqBatchCalculation(CalcJob):
+    """
+    AiiDA calculation plugin running the Qeq code on many structures in one job.
+
+    Parameter and configure files are uploaded once, each structure is run in its own subdirectory
+    named after its input key.
+
+    The structure with the first key (in sorted order) is run by the code itself, such that the job script
+    follows the usual AiiDA layout. The batch script runs the remaining structures in the background, and counts
+    the first structure as one of the ``max_parallel`` running processes until it has finished, such that all
+    structures share the same pool of slots.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super(QeqBatchCalculation, cls).define(spec)
+        spec.inputs['metadata']['options']['parser_name'].default = 'qeq.qeq_batch'
+        spec.inputs['metadata']['options']['resources'].default = {
+            'num_machines': 1,
+            'num_mpiprocs_per_machine': 1,
+        }
+        spec.inputs['metadata']['options']['withmpi'].default = False
+        spec.input('metadata.options.max_parallel',
+                   valid_type=int,
+                   default=1,
+                   help='Maximum number of egulp processes running at the same time.')
+
+        spec.input('configure',
+                   valid_type=QeqParameters,
+                   help='Configuration input for QEQ (configure.input file)',
+                   required=False)
+        spec.input('parameters',
+                   valid_type=(SinglefileData, QeqElementTable),
+                   help='File or table containing electronegativity and Idempotential data of the elements.')
+        spec.input_namespace('structures',
+                             valid_type=CifData,
+                             dynamic=True,
+                             help='Input structures, for which atomic charges are to be computed.')
+
+        spec.outputs.dynamic = True
+        spec.outputs.valid_type = Data
+        spec.output_namespace('structure_with_charges',
+                              valid_type=CifData,
+                              dynamic=True,
+                              help='Structures with charges, one per input structure that succeeded.')
+
+        spec.exit_code(810, 'ERROR_ALL_STRUCTURES_FAILED', 'egulp failed for all structures of the batch.')
+
+    def prepare_for_submission(self, folder):
+        """Create the input files from the input nodes passed to this instance of the `CalcJob`.
+
+        :param folder: an `aiida.common.folders.Folder` to temporarily write files on disk
+        :return: `aiida.common.datastructures.CalcInfo` instance
+        """
+        from aiida_qeq.data.qeq import DEFAULT_CONFIGURE_FILE_NAME, LOG_FILE_NAME
+        from aiida_qeq.data.tables import local_copy_entries
+
+        try:
+            configure = self.inputs.configure
+        except AttributeError:
+            configure = QeqParameters()
+
+        keys = sorted(self.inputs.structures.keys())
+        if not keys:
+            raise ValueError('At least one structure is required.')
+
+        # write shared configure.input file and batch script
+        with io.StringIO(configure.configure_string) as handle:
+            folder.create_file_from_filelike(handle, filename=DEFAULT_CONFIGURE_FILE_NAME, mode='w')
+        script = BATCH_SCRIPT.format(log=LOG_FILE_NAME, stderr=STDERR_FILE_NAME, exit_status=EXIT_STATUS_FILE_NAME)
+        with io.StringIO(script) as handle:
+            folder.create_file_from_filelike(handle, filename=BATCH_SCRIPT_NAME, mode='w')
+
+        # the first structure is run by the code itself, all others by the batch script running in the background
+        first = self.inputs.structures[keys[0]]
+        codeinfo = CodeInfo()
+        codeinfo.code_uuid = self.inputs.code.uuid
+        codeinfo.cmdline_params = [
+            first.filename,
+            os.path.join(os.pardir, self.inputs.parameters.filename),
+            os.path.join(os.pardir, DEFAULT_CONFIGURE_FILE_NAME),
+        ]
+        codeinfo.stdout_name = LOG_FILE_NAME
+        codeinfo.stderr_name = STDERR_FILE_NAME
+
+        batch_arguments = [self.inputs.code.get_execname(), str(self.node.get_option('max_parallel'))]
+        batch_arguments += [self.inputs.parameters.filename, DEFAULT_CONFIGURE_FILE_NAME, keys[0]]
+        for key in keys[1:]:
+            batch_arguments += [key, self.inputs.structures[key].filename]
+
+        # Prepare CalcInfo object for aiida
+        calcinfo = CalcInfo()
+        calcinfo.uuid = self.uuid
+        calcinfo.prepend_text = '\n'.join([
+            'bash {} {} &'.format(BATCH_SCRIPT_NAME, ' '.join("'{}'".format(arg) for arg in batch_arguments)),
+            'cd {}'.format(keys[0]),
+        ])
+        calcinfo.append_text = '\n'.join([
+            'echo $? > {}'.format(EXIT_STATUS_FILE_NAME),
+            'cd ..',
+            'wait',
+        ])
+        calcinfo.local_copy_list = local_copy_entries(self.inputs.parameters, folder)
+        calcinfo.retrieve_list = []
+        calcinfo.retrieve_temporary_list = []
+        for key in keys:
+            structure = self.inputs.structures[key]
+            folder.get_subfolder(key, create=True)
+            calcinfo.local_copy_list.append([structure.uuid, structure.filename, os.path.join(key, structure.filename)])
+            calcinfo.retrieve_list += [[os.path.join(key, fname), '.', 2] for fname in configure.output_files]
+            calcinfo.retrieve_temporary_list += [
+                [os.path.join(key, fname), '.', 2] for fname in (LOG_FILE_NAME, STDERR_FILE_NAME, EXIT_STATUS_FILE_NAME)
+            ]
+        calcinfo.remote_copy_list = []
+        calcinfo.codes_info = [codeinfo]
+
+        return calcinfo
@@ -7,14 +7,16 @@ Register data types via the "aiida.data" entry point in setup.json.
 
 # You can directly use or subclass aiida.orm.data.Data
 # or any other data type listed under 'verdi data'
+import itertools
 from collections import OrderedDict
 from aiida.orm import Dict
-from voluptuous import Schema, Optional, Any
+from voluptuous import Schema, Optional, Any, All, Length, Invalid
 
 # key : [ accepted values, label ]
+# lists of `lambda` and `hI0` values define a parameter sweep over all combinations, run in a single job
 cmdline_options = OrderedDict([
-    (Optional('lambda', default=1.2), float),
-    (Optional('hI0', default=-2.0), float),
+    (Optional('lambda', default=1.2), Any(float, All([float], Length(min=1)))),
+    (Optional('hI0', default=-2.0), Any(float, All([float], Length(min=1)))),
     (Optional('charge-precision', default=3), int),
     (Optional('method', default='ewald'), Any('ewald', 'nonperiodic')),
     (Optional('mr', default=2), int),
@@ -25,7 +27,16 @@ cmdline_options = OrderedDict([
 
 DEFAULT_CHARGE_FILE_NAME = 'chargecenters.dat'
 DEFAULT_IONIZATION_FILE_NAME = 'ionizationdata.dat'
-DEFAULT_OUTPUT_FILE_EXTENSIONS = ['cif']
+DEFAULT_OUTPUT_FILE_EXTENSIONS = ['cif', 'json']
+# output formats supported by parameter sweeps
+SWEEP_OUTPUT_FILE_EXTENSIONS = ['cif', 'json']
+SWEEP_PARAMETERS = ('lambda', 'hI0')
+
+
+def sweep_key(point):
+    """Return the link label of a (lambda, hI0) combination of a parameter sweep, e.g. 'lambda_1_20_hI0_m2_00'."""
+    return 'lambda_{:.2f}_hI0_{:.2f}'.format(*point).replace('.', '_').replace('-', 'm')
+
 
 output_options = {
     Optional('retrieve', default=DEFAULT_OUTPUT_FILE_EXTENSIONS): [Any('car', 'cif', 'json', 'mol', 'pdb')]
@@ -63,24 +74,58 @@ class EQeqParameters(Dict):
 
     def validate(self, parameters_dict):
         """Validate command line options."""
-        return self._schema(parameters_dict)
+        parameters_dict = self._schema(parameters_dict)
+        if any(isinstance(parameters_dict[key], list) for key in SWEEP_PARAMETERS):
+            unsupported = set(parameters_dict['retrieve']) - set(SWEEP_OUTPUT_FILE_EXTENSIONS)
+            if unsupported:
+                raise Invalid('Parameter sweeps only support the output formats {}, got {}'.format(
+                    SWEEP_OUTPUT_FILE_EXTENSIONS, sorted(unsupported)))
+        return parameters_dict
+
+    @property
+    def is_sweep(self):
+        """Whether lists of `lambda` or `hI0` values are given."""
+        pm_dict = self.get_dict()
+        return any(isinstance(pm_dict[key], list) for key in SWEEP_PARAMETERS)
+
+    @property
+    def sweep_points(self):
+        """Returns list of all (lambda, hI0) combinations (a single one, unless lists of values are given)."""
+        pm_dict = self.get_dict()
+        values = [pm_dict[key] if isinstance(pm_dict[key], list) else [pm_dict[key]] for key in SWEEP_PARAMETERS]
+        return list(itertools.product(*values))
+
+    def _point_dict(self, point=None):
+        """Returns parameter dictionary for one (lambda, hI0) combination.
+
+        :raises ValueError: if no combination is specified for a parameter sweep
+        """
+        pm_dict = self.get_dict()
+        if point is None:
+            if self.is_sweep:
+                raise ValueError('Specify the (lambda, hI0) combination of the parameter sweep')
+            return pm_dict
+        pm_dict.update(zip(SWEEP_PARAMETERS, point))
+        return pm_dict
 
     def cmdline_params(self,
                        structure_file_name,
                        ionization_file_name=DEFAULT_IONIZATION_FILE_NAME,
-                       charge_file_name=DEFAULT_CHARGE_FILE_NAME):
+                       charge_file_name=DEFAULT_CHARGE_FILE_NAME,
+                       point=None):
         """Synthesize command line parameters.
 
         e.g. [ 'HKUST-1.cif', '1.4']
 
         :param structure_file_name: Name of input structure (cif format)
+        :param point: (lambda, hI0) combination, required for parameter sweeps
 
         """
         parameters = []
 
         parameters += [structure_file_name]
 
-        pm_dict = self.get_dict()
+        pm_dict = self._point_dict(point)
         # note: ParameterData uses python dictionaries, which do not preserve order
         # We assume all keys are provided (using validation) and use the correct order
         # from cmdline_options
@@ -92,14 +137,15 @@ class EQeqParameters(Dict):
 
         return [str(p) for p in parameters]
 
-    def output_files_dict(self, structure_file_name):
+    def output_files_dict(self, structure_file_name, point=None):
         """Returns dictionary with names of output files to be retrieved.
 
         Keys are the file extension, values are the full file name.
 
         :param structure_file_name: Name of input structure (cif format)
+        :param point: (lambda, hI0) combination, required for parameter sweeps
         """
-        pm_dict = self.get_dict()
+        pm_dict = self._point_dict(point)
 
         name = '{s}_EQeq_{m}_{la:.2f}_{h:.2f}'.format(
             s=structure_file_name,
@@ -112,9 +158,10 @@ class EQeqParameters(Dict):
 
         return output_dict
 
-    def output_files(self, structure_file_name):
+    def output_files(self, structure_file_name, point=None):
         """Returns list of expected output files.
 
         :param structure_file_name: Name of input structure (cif format)
+        :param point: (lambda, hI0) combination, required for parameter sweeps
         """
-        return list(self.output_files_dict(structure_file_name).values())
+        return list(self.output_files_dict(structure_file_name, point).values())
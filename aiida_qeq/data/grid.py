@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Volumetric grid (e.g. the electrostatic potential written by egulp) as binary array in the repository.
+
+The text cube file is converted once, streaming, into a ``.npy`` file; the values are then opened memory-mapped,
+such that slices and downsampled grids are read without loading the full grid into memory::
+
+    grid = calc.outputs.potential
+    grid.shape, grid.origin, grid.voxel  # metadata in Angstrom
+    plane = grid.get_values(np.s_[10])  # reads a single plane
+    coarse = grid.downsample(4)  # every fourth point along each axis
+
+Register data types via the "aiida.data" entry point in setup.json.
+"""
+import os
+import tempfile
+
+import numpy as np
+from aiida.orm import Data
+
+VALUES_FILE_NAME = 'values.npy'
+
+
+class GridData(Data):
+    """
+    Values on a regular grid spanning a (periodic) cell, with the atoms of the structure.
+
+    Attributes hold the grid shape, the origin and the voxel vectors (rows) in Angstrom, the atomic numbers and
+    positions (Angstrom) of the atoms and the comment lines of the cube file. Values are stored in the units of the
+    cube file, in C order (third axis fastest).
+    """
+
+    @classmethod
+    def from_chunks(cls, chunks, shape, origin, voxel, numbers, positions, comments=None, dtype=np.float32):  # pylint: disable=too-many-arguments
+        """Create an unstored grid from consecutive chunks of values, without holding the full grid in memory.
+
+        :param chunks: iterable of arrays, whose values in C order fill the grid (third axis fastest)
+        :param shape: number of grid points along the three axes
+        :param origin: cartesian position of the first grid point (Angstrom)
+        :param voxel: 3x3 array of the vectors between neighbouring grid points (rows, Angstrom)
+        :param numbers: atomic numbers of the atoms
+        :param positions: (N, 3) array of cartesian positions of the atoms (Angstrom)
+        :param comments: list of comment lines (optional)
+        :param dtype: data type of the stored values
+        :raises ValueError: if the number of values does not match the shape
+        """
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype)
+        num_values = 0
+        with tempfile.NamedTemporaryFile(suffix='.npy', delete=False) as target:
+            try:
+                np.lib.format.write_array_header_1_0(target, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': shape,
+                })
+                for values in chunks:
+                    values = np.asarray(values, dtype=dtype)
+                    target.write(values.tobytes())
+                    num_values += values.size
+                target.close()
+                if num_values != int(np.prod(shape)):
+                    raise ValueError('Got {} values for a grid of shape {}'.format(num_values, shape))
+
+                grid = cls()
+                grid.put_object_from_file(target.name, VALUES_FILE_NAME)
+            finally:
+                os.remove(target.name)
+
+        grid.set_attribute('shape', list(shape))
+        grid.set_attribute('dtype', dtype.str)
+        grid.set_attribute('origin', np.asarray(origin, dtype=float).tolist())
+        grid.set_attribute('voxel', np.asarray(voxel, dtype=float).tolist())
+        grid.set_attribute('numbers', np.asarray(numbers, dtype=int).tolist())
+        grid.set_attribute('positions', np.asarray(positions, dtype=float).reshape(-1, 3).tolist())
+        grid.set_attribute('comments', list(comments or []))
+        return grid
+
+    @classmethod
+    def from_cube(cls, file, dtype=np.float32):  # pylint: disable=redefined-builtin
+        """Create an unstored grid from a cube file, converting the values in chunks.
+
+        :param file: path or text stream of a cube file
+        :param dtype: data type of the stored values (float32 holds the precision of the cube format)
+        :raises ValueError: if the cube file is incomplete
+        """
+        from aiida_qeq.engines.utils import BOHR
+        from aiida_qeq.utils.cube import iter_cube_values, read_cube_header
+
+        if isinstance(file, str):
+            with open(file, 'r') as handle:
+                return cls.from_cube(handle, dtype)
+
+        header = read_cube_header(file)
+        scale = BOHR if header.unit == 'bohr' else 1.
+        return cls.from_chunks(iter_cube_values(file),
+                               header.shape,
+                               header.origin * scale,
+                               header.voxel * scale,
+                               header.numbers,
+                               header.positions * scale,
+                               comments=header.comments,
+                               dtype=dtype)
+
+    @property
+    def shape(self):
+        """Number of grid points along the three axes."""
+        return tuple(self.get_attribute('shape'))
+
+    @property
+    def origin(self):
+        """Cartesian position of the first grid point (Angstrom)."""
+        return np.array(self.get_attribute('origin'))
+
+    @property
+    def voxel(self):
+        """3x3 array of the vectors between neighbouring grid points along the three axes (rows, Angstrom)."""
+        return np.array(self.get_attribute('voxel'))
+
+    @property
+    def spacing(self):
+        """Distance between neighbouring grid points along the three axes (Angstrom)."""
+        return np.linalg.norm(self.voxel, axis=1)
+
+    @property
+    def cell(self):
+        """3x3 array of the lattice vectors spanned by the grid (rows, Angstrom)."""
+        return self.voxel * np.array(self.shape)[:, None]
+
+    @property
+    def numbers(self):
+        """Atomic numbers of the atoms."""
+        return np.array(self.get_attribute('numbers'), dtype=int)
+
+    @property
+    def positions(self):
+        """(N, 3) array of cartesian positions of the atoms (Angstrom)."""
+        return np.array(self.get_attribute('positions')).reshape(-1, 3)
+
+    @property
+    def values(self):
+        """Read-only memory map of the values, of shape ``self.shape``.
+
+        Only the parts of the grid that are accessed are read from disk.
+        """
+        with self.open(VALUES_FILE_NAME, mode='rb') as handle:
+            if np.lib.format.read_magic(handle) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+            # the memory map stays valid after the file is closed
+            return np.memmap(handle,
+                             dtype=dtype,
+                             mode='r',
+                             offset=handle.tell(),
+                             shape=shape,
+                             order='F' if fortran_order else 'C')
+
+    def get_values(self, key=Ellipsis):
+        """Return a slice of the grid as array, reading only the planes it touches.
+
+        :param key: index or tuple of slices along the three axes, e.g. ``np.s_[10:20, :, 5]``
+        """
+        return np.array(self.values[key])
+
+    def downsample(self, factor):
+        """Return every ``factor``-th grid point along each axis, reading the grid plane by plane.
+
+        :param factor: integer or tuple of three integers
+        :return: tuple (values, voxel), where voxel holds the vectors between the points of the coarse grid
+        """
+        factors = np.broadcast_to(np.asarray(factor, dtype=int), (3,))
+        values = self.values
+        coarse = np.stack([np.array(plane[::factors[1], ::factors[2]]) for plane in values[::factors[0]]])
+        return coarse, self.voxel * factors[:, None]
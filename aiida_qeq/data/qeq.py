@@ -34,11 +34,29 @@ cmdline_options = OrderedDict([
 DEFAULT_PARAM_FILE_NAME = 'GMP.param'
 DEFAULT_CONFIGURE_FILE_NAME = 'configure.input'
 LOG_FILE_NAME = 'qeq.log'
-
-DEFAULT_OUTPUT_FILES = ['charges.cif']
+ENERGY_FILE_NAME = 'energy.dat'
+# lines of the log file read by the parser (see `aiida_qeq.parsers.qeq.parse_log`)
+LOG_SUMMARY_PATTERNS = [
+    '^egulp version',
+    '^Number of atoms is',
+    '^Lattice vector #',
+    '^atom .* is not mapped into the central cell',
+    '^Cycle:',
+    '^SCF (NOT )?CONVERGED',
+]
+
+DEFAULT_OUTPUT_FILES = ['charges.cif', 'charges.dat']
 ALL_OUTPUT_FILES = ['charges.cif', 'charges.dat', 'charges.xyz', 'energy.dat']
 
-output_options = {Optional('retrieve', default=DEFAULT_OUTPUT_FILES): [Any(*ALL_OUTPUT_FILES)]}
+# compress retrieved files above this size (bytes) on the remote, None to disable
+COMPRESS_MIN_SIZE = 2**20
+
+# keep_grids_remote: keep cube grids in the remote folder instead of retrieving them
+output_options = {
+    Optional('retrieve', default=DEFAULT_OUTPUT_FILES): [Any(*ALL_OUTPUT_FILES)],
+    Optional('compress_min_size', default=COMPRESS_MIN_SIZE): Any(None, int),
+    Optional('keep_grids_remote', default=False): bool,
+}
 
 options = dict(cmdline_options)
 options.update(output_options)
@@ -102,6 +120,29 @@ class QeqParameters(Dict):
         pm_dict = self.get_dict()
         return pm_dict['retrieve']
 
+    @property
+    def grid_files(self):
+        """Returns dictionary of the cube grids written by egulp, keyed by output label ('grid', 'potential')."""
+        pm_dict = self.get_dict()
+        grid_files = {}
+        if pm_dict['save_grid'][0]:
+            grid_files['grid'] = pm_dict['save_grid'][1]
+        if pm_dict['calculate_pot'][0]:
+            grid_files['potential'] = pm_dict['calculate_pot'][1]
+        return grid_files
+
+    @property
+    def retrieved_grid_files(self):
+        """Returns dictionary of the cube grids to be retrieved (none if they are kept on the remote)."""
+        if self.get_dict().get('keep_grids_remote', False):
+            return {}
+        return self.grid_files
+
+    @property
+    def compress_min_size(self):
+        """Returns minimum size (bytes) of output files that are compressed before retrieval, or None."""
+        return self.get_dict().get('compress_min_size', None)
+
     @property
     def configure_string(self):
         """Create configure.input string from dictionary.
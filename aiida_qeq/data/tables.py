@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter tables of the elements (GMP.param, ionizationdata.dat, chargecenters.dat) as typed data nodes.
+
+The tables are parsed once into arrays indexed by atomic number, which the in-process engines use directly.
+Calculations write the file format expected by egulp/eqeq on demand in ``prepare_for_submission``.
+
+Identical tables are stored only once: `ParameterTable.get_or_create` looks up a stored node by the hash
+of its (canonical) file content before storing a new one::
+
+    parameters = QeqElementTable.get_or_create()  # GMP.param shipped with the plugin
+    parameters.electronegativity[6]
+
+Register data types via the "aiida.data" entry point in setup.json.
+"""
+import hashlib
+import io
+
+import numpy as np
+from aiida.orm import ArrayData, SinglefileData
+
+from . import DATA_DIR
+from .eqeq import DEFAULT_CHARGE_FILE_NAME, DEFAULT_IONIZATION_FILE_NAME
+from .qeq import DEFAULT_PARAM_FILE_NAME
+
+# Number of ionization energies per element in ionizationdata.dat (electron affinity first)
+NUM_IONIZATION_ENERGIES = 9
+
+
+def read_element_table(handle):
+    """Read a per-element table in GMP.param format.
+
+    The first line contains the number of elements, each following line the atomic number and the values.
+
+    :param handle: file handle or path
+    :return: list of arrays (one per value column) indexed by atomic number, nan for missing elements
+    """
+    table = np.loadtxt(handle, skiprows=1, ndmin=2)
+    numbers = table[:, 0].astype(int)
+    columns = []
+    for values in table[:, 1:].T:
+        column = np.full(numbers.max() + 1, np.nan)
+        column[numbers] = values
+        columns.append(column)
+    return columns
+
+
+class ParameterTable(ArrayData):
+    """
+    Base class of per-element parameter tables.
+
+    Subclasses define the ``DEFAULT_FILE_NAME`` and implement ``_read`` (parse a text stream into arrays and
+    attributes) and ``_write`` (write the file format of the code).
+    """
+
+    DEFAULT_FILE_NAME = None
+
+    def _read(self, handle):
+        """Set arrays and attributes from a text stream."""
+        raise NotImplementedError
+
+    def _write(self, handle):
+        """Write the table in the file format of the code to a text stream."""
+        raise NotImplementedError
+
+    @classmethod
+    def from_file(cls, file=None, filename=None):  # pylint: disable=redefined-builtin
+        """Create an unstored table from a file.
+
+        :param file: path or text stream, defaults to the file shipped with the plugin
+        :param filename: name of the file written for the calculation, defaults to the name of ``file``
+        """
+        if file is None:
+            file = str(DATA_DIR / cls.DEFAULT_FILE_NAME)
+        if isinstance(file, str):
+            filename = filename or file.replace('\\', '/').rsplit('/', 1)[-1]
+            with open(file, 'r') as handle:
+                return cls.from_file(handle, filename)
+
+        table = cls()
+        table._read(file)  # pylint: disable=protected-access
+        table.set_attribute('filename', filename or cls.DEFAULT_FILE_NAME)
+        table.set_attribute('content_hash', hashlib.sha256(table.file_content.encode('utf-8')).hexdigest())
+        return table
+
+    @classmethod
+    def from_node(cls, node):
+        """Return the table of a `SinglefileData` (unstored) or the node itself, if it already is a table.
+
+        :param node: `SinglefileData` or instance of ``cls``
+        """
+        if isinstance(node, cls):
+            return node
+        with node.open() as handle:
+            return cls.from_file(handle, node.filename)
+
+    @classmethod
+    def get_or_create(cls, file=None, filename=None):  # pylint: disable=redefined-builtin
+        """Return the stored table with the content of a file, storing it only if no such table exists yet.
+
+        :param file: path or text stream, defaults to the file shipped with the plugin
+        :param filename: name of the file written for the calculation, defaults to the name of ``file``
+        :return: stored table
+        """
+        from aiida.orm import QueryBuilder
+
+        table = cls.from_file(file, filename)
+        builder = QueryBuilder()
+        builder.append(cls,
+                       subclassing=False,
+                       filters={
+                           'attributes.content_hash': table.content_hash,
+                           'attributes.filename': table.filename,
+                       })
+        existing = builder.first()
+        if existing is not None:
+            return existing[0]
+        return table.store()
+
+    @property
+    def filename(self):
+        """Name of the file written for the calculation."""
+        return self.get_attribute('filename')
+
+    @property
+    def content_hash(self):
+        """sha256 hex digest of the file content."""
+        return self.get_attribute('content_hash')
+
+    @property
+    def file_content(self):
+        """Table in the file format of the code."""
+        with io.StringIO() as handle:
+            self._write(handle)
+            return handle.getvalue()
+
+    def write_to_folder(self, folder):
+        """Write the file (``self.filename``) into a sandbox folder.
+
+        :param folder: `aiida.common.folders.Folder`
+        """
+        with io.StringIO(self.file_content) as handle:
+            folder.create_file_from_filelike(handle, filename=self.filename, mode='w')
+
+
+def local_copy_entries(node, folder):
+    """Make a parameter file input available to a calculation.
+
+    Tables are written into the sandbox folder, files of `SinglefileData` nodes are copied from the repository.
+
+    :param node: `SinglefileData` or `ParameterTable`
+    :param folder: `aiida.common.folders.Folder`
+    :return: list of entries for ``calcinfo.local_copy_list``
+    """
+    if isinstance(node, SinglefileData):
+        return [[node.uuid, node.filename, node.filename]]
+    node.write_to_folder(folder)
+    return []
+
+
+class QeqElementTable(ParameterTable):
+    """
+    Electronegativity and hardness (0.5 J) in eV of the elements, as in the GMP.param file of egulp.
+
+    Arrays are indexed by atomic number, nan for missing elements.
+    """
+
+    DEFAULT_FILE_NAME = DEFAULT_PARAM_FILE_NAME
+    # decimals of the values in the GMP.param format
+    DECIMALS = 4
+
+    @classmethod
+    def from_arrays(cls, electronegativity, hardness, filename=None):
+        """Create an unstored table from arrays indexed by atomic number (nan for missing elements).
+
+        Values are rounded to the precision of the file format, such that egulp and the in-process engines
+        use the same parameters.
+
+        :param filename: name of the file written for the calculation, defaults to ``GMP.param``
+        """
+        table = cls()
+        for name, values in zip(('electronegativity', 'hardness'), (electronegativity, hardness)):
+            table.set_array(name, np.round(np.asarray(values, dtype=float), cls.DECIMALS))
+        table.set_attribute('filename', filename or cls.DEFAULT_FILE_NAME)
+        table.set_attribute('content_hash', hashlib.sha256(table.file_content.encode('utf-8')).hexdigest())
+        return table
+
+    def _read(self, handle):
+        for name, values in zip(('electronegativity', 'hardness'), read_element_table(handle)):
+            self.set_array(name, values)
+
+    def _write(self, handle):
+        electronegativity, hardness = self.electronegativity, self.hardness
+        numbers = np.flatnonzero(~np.isnan(electronegativity))
+        handle.write('{}\n'.format(len(numbers)))
+        for number in numbers:
+            handle.write('{}\t{:.4f}\t{:.4f}\n'.format(number, electronegativity[number], hardness[number]))
+
+    @property
+    def electronegativity(self):
+        """Electronegativity in eV indexed by atomic number."""
+        return self.get_array('electronegativity')
+
+    @property
+    def hardness(self):
+        """Hardness (0.5 J) in eV indexed by atomic number."""
+        return self.get_array('hardness')
+
+
+class EQeqIonizationTable(ParameterTable):
+    """
+    Electron affinity and ionization energies in eV of the elements, as in the ionizationdata.dat file of eqeq.
+
+    The ``energies`` array is indexed by atomic number and ionization state (index 0 is the electron affinity),
+    nan for entries that are not numbers. These entries (e.g. ``np``, ``na``) are kept in the ``tokens``
+    attribute and written back unchanged, together with the status flag of each element. The number of decimals of
+    each value is kept in the ``decimals`` array, such that the file is written back byte for byte.
+    """
+
+    DEFAULT_FILE_NAME = DEFAULT_IONIZATION_FILE_NAME
+
+    def _read(self, handle):
+        rows = [line.split() for line in handle if line.strip()]
+        symbols = {row[1]: int(row[0]) for row in rows}
+        energies = np.full((max(symbols.values()) + 1, NUM_IONIZATION_ENERGIES), np.nan)
+        decimals = np.full(energies.shape, -1, dtype=int)
+        tokens = []
+        for row in rows:
+            for index, value in enumerate(row[3:3 + NUM_IONIZATION_ENERGIES]):
+                try:
+                    energies[int(row[0]), index] = float(value)
+                except ValueError:
+                    tokens.append([int(row[0]), index, value])
+                else:
+                    decimals[int(row[0]), index] = len(value.partition('.')[2])
+        self.set_array('energies', energies)
+        self.set_array('decimals', decimals)
+        self.set_attribute('symbols', symbols)
+        self.set_attribute('status', {row[1]: row[2] for row in rows})
+        self.set_attribute('tokens', tokens)
+
+    def _write(self, handle):
+        energies = self.energies
+        decimals = self.get_array('decimals')
+        status = self.get_attribute('status')
+        tokens = {(number, index): token for number, index, token in self.get_attribute('tokens')}
+        for symbol, number in sorted(self.symbols.items(), key=lambda item: item[1]):
+            values = [
+                tokens.get((number, index), 'na') if np.isnan(value) else '{:.{}f}'.format(value, digits)
+                for index, (value, digits) in enumerate(zip(energies[number], decimals[number]))
+            ]
+            handle.write('\t'.join([str(number), symbol, status[symbol]] + values) + '\n')
+
+    @property
+    def symbols(self):
+        """Dictionary mapping chemical symbols to atomic numbers."""
+        return self.get_attribute('symbols')
+
+    @property
+    def energies(self):
+        """Ionization energies in eV indexed by atomic number and ionization state."""
+        return self.get_array('energies')
+
+
+class EQeqChargeCenterTable(ParameterTable):
+    """
+    Charge centers (common oxidation states) of the elements, as in the chargecenters.dat file of eqeq.
+
+    The ``charge_centers`` array is indexed by atomic number; the elements of the table are listed in the
+    ``symbols`` attribute.
+    """
+
+    DEFAULT_FILE_NAME = DEFAULT_CHARGE_FILE_NAME
+
+    def _read(self, handle):
+        from ase.data import atomic_numbers
+
+        rows = [line.split() for line in handle if line.strip()]
+        symbols = [row[0] for row in rows]
+        charge_centers = np.zeros(max(atomic_numbers[symbol] for symbol in symbols) + 1, dtype=int)
+        for symbol, value in rows:
+            charge_centers[atomic_numbers[symbol]] = int(value)
+        self.set_array('charge_centers', charge_centers)
+        self.set_attribute('symbols', symbols)
+
+    def _write(self, handle):
+        for symbol, value in self.charge_center_dict.items():
+            handle.write('{}\t{}\n'.format(symbol, value))
+
+    @property
+    def symbols(self):
+        """Chemical symbols of the elements in the table."""
+        return self.get_attribute('symbols')
+
+    @property
+    def charge_centers(self):
+        """Charge centers indexed by atomic number."""
+        return self.get_array('charge_centers')
+
+    @property
+    def charge_center_dict(self):
+        """Dictionary mapping chemical symbols to charge centers."""
+        from ase.data import atomic_numbers
+
+        charge_centers = self.charge_centers
+        return {symbol: int(charge_centers[atomic_numbers[symbol]]) for symbol in self.symbols}
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+In-process charge equilibration engines provided by aiida_qeq.
+
+The engines solve the charge equilibration equations with numpy in the current python process,
+i.e. without staging input files and running the external codes through a scheduler.
+"""
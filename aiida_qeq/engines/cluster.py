@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse charge equilibration for large nonperiodic structures (clusters, slab cutouts).
+
+The dense nonperiodic engines compute all N^2 pair interactions. Here, pairs of atoms within a cutoff are found
+with a cell list (atoms binned into cubic cells of the size of the cutoff, such that neighbours lie in the same or
+adjacent cells), and the Coulomb interaction is replaced by the damped shifted force (DSF) potential of Fennell and
+Gezelter (J. Chem. Phys. 124, 234104 (2006)): the damped interaction erfc(alpha r) / r is shifted such that both
+the potential and its derivative vanish at the cutoff, and the remaining long-range interaction is approximated by
+a self term. The interaction matrix is sparse, and assembly and memory are proportional to the number of
+neighbour pairs. The equations are solved by the preconditioned conjugate gradients of the PME engine.
+
+The structure is treated as isolated: the cell of the `CifData` is ignored.
+"""
+import itertools
+
+import numpy as np
+from scipy import sparse
+from scipy.special import erfc  # pylint: disable=no-name-in-module
+from aiida.engine import calcfunction
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_qeq.data.tables import EQeqChargeCenterTable, EQeqIonizationTable, QeqElementTable
+from aiida_qeq.utils.cif import cif_node_with_charges
+from . import eqeq, pme, qeq
+from .utils import COULOMB_CONSTANT, fractional_coordinates, get_arrays, get_symbols
+
+# Cutoff of the pair interactions in Angstrom and damping parameter of the DSF potential in 1/Angstrom
+DEFAULT_CUTOFF = 12.0
+DEFAULT_DAMPING = 0.2
+# Maximum number of candidate pairs held in memory at once by the cell list
+CHUNK_PAIRS = 2**22
+
+# offsets of the adjacent cells, each pair of cells is visited once
+HALF_SHELL = [offset for offset in itertools.product((-1, 0, 1), repeat=3) if offset > (0, 0, 0)]
+
+
+def iter_neighbour_pairs(positions, cutoff):  # pylint: disable=too-many-locals
+    """Iterate over all pairs of atoms closer than ``cutoff``, found with a cell list.
+
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param cutoff: cutoff in Angstrom
+    :return: iterator over tuples (i, j, distances) of arrays, with i < j and each pair returned once
+    """
+    positions = np.asarray(positions, dtype=float)
+    cells = np.floor((positions - positions.min(axis=0)) / cutoff).astype(np.int64)
+    shape = cells.max(axis=0) + 1
+    order = np.argsort(np.ravel_multi_index(cells.T, shape), kind='stable')
+    cells, sorted_positions = cells[order], positions[order]
+    occupied, starts, counts = np.unique(np.ravel_multi_index(cells.T, shape), return_index=True, return_counts=True)
+
+    for offset in [(0, 0, 0)] + HALF_SHELL:
+        neighbours = cells + offset
+        atoms = np.flatnonzero(((neighbours >= 0) & (neighbours < shape)).all(axis=1))
+        index = np.ravel_multi_index(neighbours[atoms].T, shape)
+        found = np.minimum(np.searchsorted(occupied, index), len(occupied) - 1)
+        atoms, found = atoms[occupied[found] == index], found[occupied[found] == index]
+        if offset == (0, 0, 0):
+            # atoms of the same cell: pair each atom with the ones following it in the sorted order
+            first, num = atoms + 1, starts[found] + counts[found] - atoms - 1
+        else:
+            first, num = starts[found], counts[found]
+
+        # split the atoms into chunks of at most CHUNK_PAIRS candidate pairs
+        total = np.cumsum(num)
+        bounds = np.searchsorted(total, np.arange(CHUNK_PAIRS, total[-1] if total.size else 0, CHUNK_PAIRS))
+        for chunk in np.split(np.arange(len(atoms)), bounds):
+            if not num[chunk].sum():
+                continue
+            i = np.repeat(atoms[chunk], num[chunk])
+            j = np.repeat(first[chunk] - np.cumsum(num[chunk]) + num[chunk], num[chunk]) + np.arange(len(i))
+            distances = np.linalg.norm(sorted_positions[i] - sorted_positions[j], axis=1)
+            within = distances < cutoff
+            i, j = order[i[within]], order[j[within]]
+            yield np.minimum(i, j), np.maximum(i, j), distances[within]
+
+
+def shifted_coulomb(distances, cutoff=DEFAULT_CUTOFF, damping=DEFAULT_DAMPING):
+    """Damped shifted force approximation of 1/r (1/Angstrom), potential and force vanish at the cutoff."""
+    shift = erfc(damping * cutoff) / cutoff
+    force = shift / cutoff + 2 * damping / np.sqrt(np.pi) * np.exp(-(damping * cutoff)**2) / cutoff
+    return erfc(damping * distances) / distances - shift + force * (distances - cutoff)
+
+
+def shifted_self_interaction(cutoff=DEFAULT_CUTOFF, damping=DEFAULT_DAMPING):
+    """Diagonal of the DSF interaction matrix (1/Angstrom).
+
+    Corresponds to the self energy -(erfc(alpha rc) / 2 rc + alpha / sqrt(pi)) q^2 of each charge.
+    """
+    return -(erfc(damping * cutoff) / cutoff + 2 * damping / np.sqrt(np.pi))
+
+
+class ClusterCoulombOperator:
+    """
+    Sparse interaction operator in eV of an isolated structure (without the atomic hardness).
+
+    The symmetric matrix is stored as its strict upper triangle, such that memory is proportional to the number
+    of neighbour pairs. Can be used with `aiida_qeq.engines.pme.solve`.
+    """
+
+    def __init__(self, natoms, pairs, self_term):
+        """
+        :param natoms: number of atoms
+        :param pairs: iterable over tuples (i, j, values) of the upper triangle (i < j), in eV
+        :param self_term: diagonal element in eV
+        """
+        rows, columns, values = [], [], []
+        for i, j, value in pairs:
+            rows.append(i.astype(np.int32))
+            columns.append(j.astype(np.int32))
+            values.append(value)
+        if rows:
+            rows, columns, values = np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+        self.upper = sparse.csr_matrix((values, (rows, columns)), shape=(natoms, natoms))
+        self.self_term = self_term
+        self.diagonal = np.full(natoms, self_term)
+
+    @property
+    def num_pairs(self):
+        """Number of interacting pairs."""
+        return self.upper.nnz
+
+    def scaled(self, factor):
+        """Return the operator multiplied by a scalar (e.g. the dielectric screening of EQeq)."""
+        operator = ClusterCoulombOperator(self.upper.shape[0], [], factor * self.self_term)
+        operator.upper = factor * self.upper
+        return operator
+
+    def __call__(self, charges):
+        """Return the potential (eV/e) at each atom."""
+        return self.upper @ charges + self.upper.T @ charges + self.self_term * charges
+
+
+def qeq_operator(positions, numbers, radii=None, cutoff=DEFAULT_CUTOFF, damping=DEFAULT_DAMPING):
+    """Return the sparse QEq interaction operator of an isolated structure, without the atomic hardness.
+
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param radii: orbital radii in Angstrom indexed by atomic number (defaults to the egulp radii)
+    :param cutoff: cutoff of the pair interactions in Angstrom
+    :param damping: damping parameter of the DSF potential in 1/Angstrom
+    :return: `ClusterCoulombOperator`
+    """
+    if radii is None:
+        radii = qeq.default_radii()
+    corrections = qeq.OrbitalCorrections(numbers, radii, cutoff=cutoff)
+    pairs = ((i, j, COULOMB_CONSTANT * shifted_coulomb(distances, cutoff, damping) + corrections(i, j, distances))
+             for i, j, distances in iter_neighbour_pairs(positions, cutoff))
+    return ClusterCoulombOperator(len(numbers), pairs, COULOMB_CONSTANT * shifted_self_interaction(cutoff, damping))
+
+
+def eqeq_operator(positions, hardness, cutoff=DEFAULT_CUTOFF, damping=DEFAULT_DAMPING):
+    """Return the sparse unscreened EQeq interaction operator of an isolated structure (i.e. for lambda = 1).
+
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param hardness: (N,) array of atomic hardness J in eV
+    :return: `ClusterCoulombOperator`
+    """
+    overlap = np.sqrt(np.asarray(hardness, dtype=float) / eqeq.EQEQ_COULOMB_CONSTANT)
+    pairs = ((i, j, eqeq.EQEQ_COULOMB_CONSTANT / 2 *
+              (shifted_coulomb(distances, cutoff, damping) + eqeq.orbital_overlap(distances, overlap[i] * overlap[j])))
+             for i, j, distances in iter_neighbour_pairs(positions, cutoff))
+    return ClusterCoulombOperator(len(hardness), pairs,
+                                  eqeq.EQEQ_COULOMB_CONSTANT / 2 * shifted_self_interaction(cutoff, damping))
+
+
+def compute_qeq_charges(  # pylint: disable=too-many-arguments
+        positions,
+        numbers,
+        electronegativity,
+        hardness,
+        radii=None,
+        cutoff=DEFAULT_CUTOFF,
+        damping=DEFAULT_DAMPING):
+    """Compute QEq charges of an isolated structure.
+
+    :param electronegativity: electronegativities in eV indexed by atomic number
+    :param hardness: hardness 0.5 J in eV indexed by atomic number
+    :param cutoff: cutoff of the pair interactions in Angstrom
+    :param damping: damping parameter of the DSF potential in 1/Angstrom
+    :return: `QeqResult`
+    """
+    numbers = np.asarray(numbers)
+    if radii is None:
+        radii = qeq.default_radii()
+    qeq.check_parameters(numbers, hardness)
+
+    operator = qeq_operator(positions, numbers, radii, cutoff=cutoff, damping=damping)
+    hydrogen_zeta = np.where(numbers == 1, qeq.slater_exponents(numbers, radii), np.nan)
+    return pme.solve(operator, electronegativity[numbers], hardness[numbers], hydrogen_zeta=hydrogen_zeta)
+
+
+def compute_eqeq_charges(  # pylint: disable=too-many-arguments
+        positions,
+        numbers,
+        symbols,
+        energies,
+        charge_centers,
+        parameters,
+        cutoff=DEFAULT_CUTOFF,
+        damping=DEFAULT_DAMPING):
+    """Compute EQeq charges of an isolated structure.
+
+    :param parameters: dictionary validated by `EQeqParameters` (single ``lambda`` and ``hI0`` values)
+    :param cutoff: cutoff of the pair interactions in Angstrom
+    :param damping: damping parameter of the DSF potential in 1/Angstrom
+    :return: `EQeqResult`
+    :raises ValueError: if the conjugate gradients do not converge
+    """
+    electronegativity, hardness = eqeq.element_parameters(numbers, symbols, energies, charge_centers, parameters['hI0'])
+    operator = eqeq_operator(positions, hardness, cutoff=cutoff, damping=damping)
+    result = pme.solve(operator.scaled(parameters['lambda']), electronegativity, hardness / 2)
+    if not result.converged:
+        raise ValueError('Conjugate gradients did not converge')
+    charges = eqeq.round_charges(result.charges, parameters['charge-precision'])
+    return eqeq.EQeqResult(charges, result.energy, None)
+
+
+@calcfunction
+def qeq_charges_cluster(structure, parameters, configure=None, cutoff=None):
+    """Compute QEq charges in-process for a large isolated structure, with interactions truncated at a cutoff.
+
+    Takes the same inputs as `QeqCalculation` and returns the structure with charges as
+    ``structure_with_charges`` output.
+
+    :param structure: `CifData` of the structure (the cell is ignored)
+    :param parameters: `QeqElementTable` or `SinglefileData` with electronegativity and hardness of the elements
+        (GMP.param format)
+    :param configure: `QeqParameters` (optional)
+    :param cutoff: `Float` cutoff of the pair interactions in Angstrom (optional)
+    """
+    QeqParameters = DataFactory('qeq.qeq')  # pylint: disable=invalid-name
+    configure = (configure or QeqParameters()).get_dict()
+    qeq.check_configure(configure)
+
+    table = QeqElementTable.from_node(parameters)
+    cell, positions, numbers = get_arrays(structure)
+    result = compute_qeq_charges(positions,
+                                 numbers,
+                                 table.electronegativity,
+                                 table.hardness,
+                                 cutoff=DEFAULT_CUTOFF if cutoff is None else cutoff.value)
+    if not result.converged:
+        return CalculationFactory('qeq.qeq').exit_codes.ERROR_SCF_NOT_CONVERGED
+
+    fractional = fractional_coordinates(cell, positions)
+    cif = cif_node_with_charges(cell, get_symbols(numbers), fractional, result.charges, method='qeq')
+    return {'structure_with_charges': cif}
+
+
+@calcfunction
+def eqeq_charges_cluster(structure, parameters, ionization_data, charge_data, cutoff=None):
+    """Compute EQeq charges in-process for a large isolated structure, with interactions truncated at a cutoff.
+
+    Takes the same inputs as `EQeqCalculation`, with ``method`` set to ``nonperiodic``, and returns the structure
+    with charges as ``structure_with_charges`` output.
+
+    :param structure: `CifData` of the structure (the cell is ignored)
+    :param parameters: `EQeqParameters` with method ``nonperiodic``
+    :param ionization_data: `EQeqIonizationTable` or `SinglefileData` with ionization data of the elements
+        (ionizationdata.dat format)
+    :param charge_data: `EQeqChargeCenterTable` or `SinglefileData` with charge centers of the elements
+        (chargecenters.dat format)
+    :param cutoff: `Float` cutoff of the pair interactions in Angstrom (optional)
+    """
+    pm_dict = parameters.get_dict()
+    if pm_dict['method'] != 'nonperiodic':
+        raise ValueError("The cluster EQeq engine requires method 'nonperiodic', got '{}'".format(pm_dict['method']))
+    if parameters.is_sweep:
+        raise ValueError('Parameter sweeps are not supported by the cluster EQeq engine')
+
+    ionization_table = EQeqIonizationTable.from_node(ionization_data)
+    charge_centers = EQeqChargeCenterTable.from_node(charge_data).charge_center_dict
+    cell, positions, numbers = get_arrays(structure)
+    result = compute_eqeq_charges(positions,
+                                  numbers,
+                                  ionization_table.symbols,
+                                  ionization_table.energies,
+                                  charge_centers,
+                                  pm_dict,
+                                  cutoff=DEFAULT_CUTOFF if cutoff is None else cutoff.value)
+
+    cif = cif_node_with_charges(cell,
+                                get_symbols(numbers),
+                                fractional_coordinates(cell, positions),
+                                result.charges,
+                                method='eqeq',
+                                filename=structure.filename)
+    return {'structure_with_charges': cif}
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+In-process EQeq engine.
+
+Solves the extended charge equilibration (EQeq) of Wilmer, Kim and Snurr (J. Phys. Chem. Lett. 3, 2506 (2012)):
+electronegativity and hardness of each element are derived from its ionization energies around a common
+oxidation state (the charge center), and the Coulomb interaction, screened by the dielectric parameter lambda,
+is corrected at short range for orbital overlap.
+
+Instead of the fixed ``mr``/``mk``/``eta`` parameters of the eqeq code, the Ewald sum is tuned automatically
+to reach the requested ``charge-precision`` at minimal cost.
+"""
+from collections import namedtuple
+
+import numpy as np
+from aiida.engine import calcfunction
+from aiida.orm import Dict
+
+from aiida_qeq.data.tables import EQeqChargeCenterTable, EQeqIonizationTable
+from aiida_qeq.utils.cif import cif_node_with_charges
+from . import ewald
+from .qeq import solve
+from .utils import fractional_coordinates, get_arrays, get_symbols
+
+# Coulomb constant used by eqeq in eV * Angstrom
+EQEQ_COULOMB_CONSTANT = 14.4
+
+EQeqResult = namedtuple('EQeqResult', ['charges', 'energy', 'ewald_parameters'])
+
+
+def element_parameters(numbers, symbols, energies, charge_centers, hydrogen_affinity):
+    """Return EQeq electronegativity and hardness of each atom.
+
+    For an element with charge center c and ionization energies IP (IP_0 being the electron affinity),
+    J = IP_(c+1) - IP_c and X = (IP_(c+1) + IP_c) / 2 - c J.
+
+    :param numbers: (N,) array of atomic numbers
+    :param symbols: dictionary mapping chemical symbols to atomic numbers
+    :param energies: ionization energies indexed by atomic number and ionization state, see `EQeqIonizationTable`
+    :param charge_centers: dictionary mapping chemical symbols to charge centers
+    :param hydrogen_affinity: electron affinity of hydrogen in eV (``hI0``)
+    :return: tuple (electronegativity, hardness) of (N,) arrays in eV
+    """
+    energies = energies.copy()
+    energies[1, 0] = hydrogen_affinity
+
+    centers = np.zeros(len(energies), dtype=int)
+    for symbol, center in charge_centers.items():
+        if symbol in symbols:
+            centers[symbols[symbol]] = center
+
+    numbers = np.asarray(numbers)
+    if numbers.max() >= len(energies):
+        raise ValueError('No ionization data found for atomic numbers {}'.format(numbers[numbers >= len(energies)]))
+    lower = energies[numbers, centers[numbers]]
+    upper = energies[numbers, centers[numbers] + 1]
+    missing = np.isnan(lower) | np.isnan(upper)
+    if missing.any():
+        raise ValueError('No ionization data found for atomic numbers {}'.format(np.unique(numbers[missing])))
+
+    hardness = upper - lower
+    electronegativity = 0.5 * (upper + lower) - centers[numbers] * hardness
+    return electronegativity, hardness
+
+
+def ewald_accuracy(precision):
+    """Return the relative accuracy of the Ewald sum needed to converge charges to ``precision`` decimals."""
+    return 10.**(-precision - 3)
+
+
+def orbital_overlap(distances, overlap):
+    """Short-range correction to 1/R for the overlap of the orbitals, with overlap = sqrt(J_i J_j) / k."""
+    return np.exp(-(overlap * distances)**2) * (2 * overlap - overlap**2 * distances - 1 / distances)
+
+
+def orbital_corrections(cell, positions, hardness, accuracy):
+    """Return the orbital overlap corrections of all pairs in a periodic structure (1/Angstrom)."""
+    natoms = len(positions)
+    overlap = np.sqrt(hardness) / np.sqrt(EQEQ_COULOMB_CONSTANT)
+    cutoff = np.sqrt(-np.log(accuracy)) / (overlap.min()**2)
+
+    flat = np.zeros(natoms * natoms)
+    for i, j, dist in ewald.iter_pairs(cell, positions, cutoff):
+        values = orbital_overlap(dist, overlap[i] * overlap[j])
+        flat += np.bincount(i * natoms + j, weights=values, minlength=natoms * natoms)
+    return flat.reshape(natoms, natoms)
+
+
+def point_charge_matrix(cell, positions, method='ewald', accuracy=ewald.DEFAULT_ACCURACY):
+    """Return the Coulomb matrix of unit point charges (1/Angstrom), which depends on the structure only.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param method: 'ewald' for periodic structures, 'nonperiodic' for isolated clusters
+    :param accuracy: relative accuracy of the Ewald sum
+    :return: tuple (matrix, ewald_parameters), the latter is None for nonperiodic structures
+    """
+    positions = np.asarray(positions, dtype=float)
+    natoms = len(positions)
+
+    if method == 'nonperiodic':
+        dist = np.linalg.norm(positions[:, None, :] - positions[None, :, :], axis=2)
+        np.fill_diagonal(dist, 1.)
+        matrix = 1 / dist
+        np.fill_diagonal(matrix, 0.)
+        return matrix, None
+
+    alpha, r_cut, k_cut = ewald.optimal_parameters(cell, natoms, accuracy)
+    matrix = ewald.ewald_matrix(cell, positions, alpha=alpha, r_cut=r_cut, k_cut=k_cut, accuracy=accuracy)
+    parameters = {
+        'alpha': alpha,
+        'r_cut': r_cut,
+        'k_cut': k_cut,
+        'num_images': len(ewald.image_shifts(cell, r_cut)),
+        'num_kvectors': len(ewald.reciprocal_vectors(cell, k_cut)),
+    }
+    return matrix, parameters
+
+
+def coulomb_matrix(cell, positions, hardness, method='ewald', accuracy=ewald.DEFAULT_ACCURACY, point_charges=None):  # pylint: disable=too-many-arguments
+    """Return the unscreened EQeq Coulomb matrix in eV (i.e. for lambda = 1), without the hardness on the diagonal.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param hardness: (N,) array of atomic hardness J in eV
+    :param method: 'ewald' for periodic structures, 'nonperiodic' for isolated clusters
+    :param accuracy: relative accuracy of the Ewald sum
+    :param point_charges: result of `point_charge_matrix` for the same structure, to reuse it (optional)
+    :return: tuple (matrix, ewald_parameters), the latter is None for nonperiodic structures
+    """
+    positions = np.asarray(positions, dtype=float)
+    hardness = np.asarray(hardness, dtype=float)
+    matrix, parameters = point_charges or point_charge_matrix(cell, positions, method, accuracy)
+
+    if method == 'nonperiodic':
+        dist = np.linalg.norm(positions[:, None, :] - positions[None, :, :], axis=2)
+        np.fill_diagonal(dist, 1.)
+        overlap = np.sqrt(np.outer(hardness, hardness)) / EQEQ_COULOMB_CONSTANT
+        corrections = orbital_overlap(dist, overlap)
+        np.fill_diagonal(corrections, 0.)
+    else:
+        corrections = orbital_corrections(cell, positions, hardness, accuracy)
+    return EQEQ_COULOMB_CONSTANT / 2 * (matrix + corrections), parameters
+
+
+def round_charges(charges, precision):
+    """Round charges to ``precision`` decimals, keeping their sum.
+
+    As eqeq does, the rounding residual is compensated by adjusting the charges with the largest rounding
+    error by one unit of the last decimal.
+    """
+    unit = 10.**(-precision)
+    rounded = np.round(charges, precision)
+    steps = int(np.round((charges.sum() - rounded.sum()) / unit))
+    if steps:
+        errors = (charges - rounded) * np.sign(steps)
+        adjust = np.argsort(-errors, kind='stable')[:abs(steps)]
+        rounded[adjust] += np.sign(steps) * unit
+    return np.round(rounded, precision)
+
+
+def compute_charges(cell, positions, numbers, symbols, energies, charge_centers, parameters):  # pylint: disable=too-many-arguments
+    """Compute EQeq charges of a structure.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param symbols: dictionary mapping chemical symbols to atomic numbers
+    :param energies: ionization energies indexed by atomic number and ionization state, see `EQeqIonizationTable`
+    :param charge_centers: dictionary mapping chemical symbols to charge centers
+    :param parameters: dictionary validated by `EQeqParameters`
+    :return: `EQeqResult`
+    """
+    electronegativity, hardness = element_parameters(numbers, symbols, energies, charge_centers, parameters['hI0'])
+    matrix, ewald_parameters = coulomb_matrix(cell,
+                                              positions,
+                                              hardness,
+                                              method=parameters['method'],
+                                              accuracy=ewald_accuracy(parameters['charge-precision']))
+    result = solve(parameters['lambda'] * matrix, electronegativity, hardness / 2)
+    charges = round_charges(result.charges, parameters['charge-precision'])
+    return EQeqResult(charges, result.energy, ewald_parameters)
+
+
+def compute_charges_sweep(cell, positions, numbers, symbols, energies, charge_centers, parameters):  # pylint: disable=too-many-arguments,too-many-locals
+    """Compute EQeq charges of a structure for all (lambda, hI0) combinations of a parameter sweep.
+
+    The point charge Coulomb matrix depends on the structure only and is computed once; the orbital overlap
+    corrections depend on the hardness of hydrogen and are computed once per hI0 value.
+
+    :param parameters: `EQeqParameters` (with lists of `lambda` and/or `hI0` values)
+    :return: dictionary mapping (lambda, hI0) to `EQeqResult`
+    """
+    pm_dict = parameters.get_dict()
+    accuracy = ewald_accuracy(pm_dict['charge-precision'])
+    point_charges = point_charge_matrix(cell, positions, method=pm_dict['method'], accuracy=accuracy)
+
+    results = {}
+    matrices = {}
+    for lambda_, hydrogen_affinity in parameters.sweep_points:
+        electronegativity, hardness = element_parameters(numbers, symbols, energies, charge_centers, hydrogen_affinity)
+        if hydrogen_affinity not in matrices:
+            matrices[hydrogen_affinity] = coulomb_matrix(cell,
+                                                         positions,
+                                                         hardness,
+                                                         method=pm_dict['method'],
+                                                         accuracy=accuracy,
+                                                         point_charges=point_charges)[0]
+        result = solve(lambda_ * matrices[hydrogen_affinity], electronegativity, hardness / 2)
+        charges = round_charges(result.charges, pm_dict['charge-precision'])
+        results[lambda_, hydrogen_affinity] = EQeqResult(charges, result.energy, point_charges[1])
+    return results
+
+
+@calcfunction
+def eqeq_charges(structure, parameters, ionization_data, charge_data):
+    """Compute EQeq charges in-process, without running eqeq.
+
+    Takes the same inputs as `EQeqCalculation`. The ``mr``, ``mk`` and ``eta`` parameters are ignored;
+    the Ewald sum is tuned automatically and the selected parameters are returned as ``ewald_parameters``.
+    For a parameter sweep (lists of ``lambda``/``hI0`` values), the Coulomb matrix is shared by all combinations
+    and the structures with charges are returned in the ``structure_with_charges_sweep`` namespace.
+
+    :param structure: `CifData` of the structure
+    :param parameters: `EQeqParameters`
+    :param ionization_data: `EQeqIonizationTable` or `SinglefileData` with ionization data of the elements
+        (ionizationdata.dat format)
+    :param charge_data: `EQeqChargeCenterTable` or `SinglefileData` with charge centers of the elements
+        (chargecenters.dat format)
+    """
+    ionization_table = EQeqIonizationTable.from_node(ionization_data)
+    symbols, energies = ionization_table.symbols, ionization_table.energies
+    charge_centers = EQeqChargeCenterTable.from_node(charge_data).charge_center_dict
+
+    cell, positions, numbers = get_arrays(structure)
+    if parameters.is_sweep:
+        results = compute_charges_sweep(cell, positions, numbers, symbols, energies, charge_centers, parameters)
+        return _sweep_outputs(structure, cell, positions, numbers, results)
+    result = compute_charges(cell, positions, numbers, symbols, energies, charge_centers, parameters.get_dict())
+
+    cif = cif_node_with_charges(cell,
+                                get_symbols(numbers),
+                                fractional_coordinates(cell, positions),
+                                result.charges,
+                                method='eqeq',
+                                filename=structure.filename)
+    outputs = {'structure_with_charges': cif}
+    if result.ewald_parameters is not None:
+        outputs['ewald_parameters'] = Dict(dict=result.ewald_parameters)
+    return outputs
+
+
+def _sweep_outputs(structure, cell, positions, numbers, results):  # pylint: disable=too-many-arguments
+    """Return the outputs of `eqeq_charges` for a parameter sweep, keyed by `sweep_key`."""
+    from aiida_qeq.data.eqeq import sweep_key
+
+    symbols = get_symbols(numbers)
+    fractional = fractional_coordinates(cell, positions)
+    outputs = {'structure_with_charges_sweep': {}}
+    for point, result in results.items():
+        cif = cif_node_with_charges(cell,
+                                    symbols,
+                                    fractional,
+                                    result.charges,
+                                    method='eqeq',
+                                    filename=structure.filename)
+        outputs['structure_with_charges_sweep'][sweep_key(point)] = cif
+    ewald_parameters = next(iter(results.values())).ewald_parameters
+    if ewald_parameters is not None:
+        outputs['ewald_parameters'] = Dict(dict=ewald_parameters)
+    return outputs
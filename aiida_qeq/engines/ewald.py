@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Ewald summation of the periodic Coulomb interaction between unit point charges.
+
+All functions work on a cell matrix with the lattice vectors as rows and cartesian positions in Angstrom,
+and return interactions in units of e^2/Angstrom (multiply by `COULOMB_CONSTANT` to get eV).
+"""
+import numpy as np
+from scipy.special import erfc  # pylint: disable=no-name-in-module
+
+# Relative accuracy of the real- and reciprocal-space sums (egulp uses the same value)
+DEFAULT_ACCURACY = 1e-8
+# Upper bound on the number of float64 elements of temporary arrays
+CHUNK_SIZE = 2**22
+# Cost of one reciprocal-space term (atom pair and k-vector) relative to one real-space term (atom pair and image)
+RECIPROCAL_COST = 0.005
+
+
+def plane_spacings(cell):
+    """Return the distances between opposite faces of the cell.
+
+    :param cell: 3x3 array with the lattice vectors as rows
+    """
+    cell = np.asarray(cell, dtype=float)
+    volume = abs(np.linalg.det(cell))
+    return volume / np.linalg.norm(np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+
+
+def image_shifts(cell, r_cut):
+    """Return the integer lattice translations needed to find all pairs within ``r_cut``.
+
+    Assumes that fractional coordinate differences have been wrapped into [-0.5, 0.5].
+
+    :param cell: 3x3 array with the lattice vectors as rows
+    :param r_cut: cutoff radius in Angstrom
+    :return: (M, 3) integer array, the zero translation comes first
+    """
+    n_max = np.floor(r_cut / plane_spacings(cell) + 0.5).astype(int)
+    ranges = [np.arange(-n, n + 1) for n in n_max]
+    shifts = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+    order = np.argsort(np.abs(shifts).sum(axis=1), kind='stable')
+    return shifts[order]
+
+
+def minimum_image_differences(cell, positions, rows=slice(None)):
+    """Return fractional position differences wrapped into [-0.5, 0.5].
+
+    :param rows: slice or index array selecting the first atom of each pair
+    :return: array of shape (n_rows, N, 3)
+    """
+    frac = np.linalg.solve(np.asarray(cell).T, np.asarray(positions).T).T
+    diff = frac[rows, None, :] - frac[None, :, :]
+    return diff - np.round(diff)
+
+
+def row_blocks(natoms, width):
+    """Yield slices over ``natoms`` rows such that a (rows, width, 3) array stays below `CHUNK_SIZE`."""
+    step = max(1, CHUNK_SIZE // (3 * max(width, 1)))
+    for start in range(0, natoms, step):
+        yield slice(start, min(start + step, natoms))
+
+
+def iter_pairs(cell, positions, r_cut, r_min=1e-8, rows=None):
+    """Iterate over all pairs of atoms (including periodic images) closer than ``r_cut``.
+
+    Pairs are yielded in blocks, both orderings (i, j) and (j, i) are included.
+
+    :param r_min: pairs closer than this (i.e. an atom with itself) are skipped
+    :param rows: indices of the atoms used as first atom of the pairs (defaults to all atoms)
+    :return: generator of tuples (i, j, r) of index and distance arrays, i indexes ``rows``
+    """
+    cell = np.asarray(cell, dtype=float)
+    natoms = len(positions)
+    atoms = np.arange(natoms) if rows is None else np.asarray(rows)
+    shifts = image_shifts(cell, r_cut)
+    for block in row_blocks(len(atoms), natoms):
+        diff = minimum_image_differences(cell, positions, atoms[block])
+        for shift in shifts:
+            dist = np.linalg.norm((diff + shift) @ cell, axis=2)
+            i, j = np.nonzero((dist < r_cut) & (dist > r_min))
+            if i.size:
+                yield i + block.start, j, dist[i, j]
+
+
+def default_parameters(cell, natoms, accuracy=DEFAULT_ACCURACY):
+    """Return Ewald parameters for a given accuracy using the standard balance of real and reciprocal space.
+
+    :return: tuple (alpha, r_cut, k_cut) with alpha in 1/Angstrom, r_cut in Angstrom, k_cut in 1/Angstrom
+    """
+    volume = abs(np.linalg.det(cell))
+    alpha = np.sqrt(np.pi) * (natoms / volume**2)**(1. / 6.)
+    x = np.sqrt(-np.log(accuracy))
+    return alpha, x / alpha, 2 * alpha * x
+
+
+def count_reciprocal_vectors(cell, k_cut):
+    """Estimate the number of reciprocal lattice vectors returned by `reciprocal_vectors`."""
+    volume = abs(np.linalg.det(cell))
+    return 4. / 3. * np.pi * k_cut**3 * volume / (2 * np.pi)**3 / 2
+
+
+def optimal_parameters(cell, natoms, accuracy=DEFAULT_ACCURACY):
+    """Return the Ewald parameters that reach a given accuracy at minimal cost.
+
+    For a given accuracy, every splitting parameter alpha fixes the real- and reciprocal-space cutoffs.
+    The cost of both sums is estimated from the number of lattice images and k-vectors, and the cheapest
+    alpha is selected on a logarithmic grid around the standard balance of `default_parameters`.
+
+    :return: tuple (alpha, r_cut, k_cut) with alpha in 1/Angstrom, r_cut in Angstrom, k_cut in 1/Angstrom
+    """
+    x = np.sqrt(-np.log(accuracy))
+    alpha_0 = default_parameters(cell, natoms, accuracy)[0]
+    candidates = alpha_0 * np.logspace(-0.5, 1, 46)
+
+    costs = [
+        natoms**2 *
+        (len(image_shifts(cell, x / alpha)) + RECIPROCAL_COST * count_reciprocal_vectors(cell, 2 * alpha * x))
+        for alpha in candidates
+    ]
+    alpha = candidates[int(np.argmin(costs))]
+    return alpha, x / alpha, 2 * alpha * x
+
+
+def real_space_matrix(cell, positions, alpha, r_cut, rows=None):
+    """Real-space part of the Ewald sum including the self-interaction correction.
+
+    :param rows: indices of the atoms of the returned rows (defaults to all atoms)
+    """
+    cell = np.asarray(cell, dtype=float)
+    natoms = len(positions)
+    atoms = np.arange(natoms) if rows is None else np.asarray(rows)
+    matrix = np.zeros((len(atoms), natoms))
+    shifts = image_shifts(cell, r_cut)
+    for rows_block in row_blocks(len(atoms), natoms):
+        diff = minimum_image_differences(cell, positions, atoms[rows_block])
+        block = matrix[rows_block]
+        for shift in shifts:
+            dist = np.linalg.norm((diff + shift) @ cell, axis=2)
+            mask = (dist < r_cut) & (dist > 1e-8)
+            block[mask] += erfc(alpha * dist[mask]) / dist[mask]
+    matrix[np.arange(len(atoms)), atoms] -= 2 * alpha / np.sqrt(np.pi)
+    return matrix
+
+
+def reciprocal_vectors(cell, k_cut):
+    """Return the reciprocal lattice vectors within ``k_cut``, one of each pair (k, -k).
+
+    :return: (M, 3) array in 1/Angstrom
+    """
+    cell = np.asarray(cell, dtype=float)
+    recip = 2 * np.pi * np.linalg.inv(cell).T
+    n_max = np.floor(k_cut * np.linalg.norm(cell, axis=1) / (2 * np.pi)).astype(int)
+    ranges = [np.arange(-n, n + 1) for n in n_max]
+    n = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+    # keep half space
+    half = (n[:, 0] > 0) | ((n[:, 0] == 0) & (n[:, 1] > 0)) | ((n[:, 0] == 0) & (n[:, 1] == 0) & (n[:, 2] > 0))
+    kvec = n[half] @ recip
+    return kvec[np.einsum('ij,ij->i', kvec, kvec) < k_cut**2]
+
+
+def reciprocal_space_matrix(cell, positions, alpha, k_cut, rows=None):  # pylint: disable=too-many-locals
+    """Reciprocal-space part of the Ewald sum, built as a product of structure-factor matrices.
+
+    :param rows: indices of the atoms of the returned rows (defaults to all atoms)
+    """
+    cell = np.asarray(cell, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    natoms = len(positions)
+    atoms = np.arange(natoms) if rows is None else np.asarray(rows)
+    volume = abs(np.linalg.det(cell))
+    kvec = reciprocal_vectors(cell, k_cut)
+    matrix = np.zeros((len(atoms), natoms))
+    step = max(1, CHUNK_SIZE // max(natoms, 1))
+    for start in range(0, len(kvec), step):
+        k = kvec[start:start + step]
+        k2 = np.einsum('ij,ij->i', k, k)
+        # factor 2 accounts for -k
+        weight = 2 * 4 * np.pi / volume * np.exp(-0.25 * k2 / alpha**2) / k2
+        phase = positions @ k.T
+        cos, sin = np.cos(phase), np.sin(phase)
+        matrix += (cos[atoms] * weight) @ cos.T + (sin[atoms] * weight) @ sin.T
+    return matrix
+
+
+def ewald_matrix(cell, positions, alpha=None, r_cut=None, k_cut=None, accuracy=DEFAULT_ACCURACY, rows=None):  # pylint: disable=too-many-arguments
+    """Return the periodic Coulomb interaction matrix between unit point charges.
+
+    The uniform neutralising background term is omitted, i.e. the matrix is exact for neutral
+    charge distributions. Parameters not given are taken from `optimal_parameters`.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param rows: indices of the atoms of the returned rows (defaults to all atoms)
+    :return: (N, N) array in e^2/Angstrom, or (len(rows), N) if ``rows`` are given
+    """
+    if alpha is None:
+        alpha = optimal_parameters(cell, len(positions), accuracy)[0]
+    x = np.sqrt(-np.log(accuracy))
+    r_cut = r_cut or x / alpha
+    k_cut = k_cut or 2 * alpha * x
+
+    return (real_space_matrix(cell, positions, alpha, r_cut, rows) +
+            reciprocal_space_matrix(cell, positions, alpha, k_cut, rows))
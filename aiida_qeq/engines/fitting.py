@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Fitting of QEq element parameters to reference charges.
+
+The electronegativity and hardness of the elements of a training set of structures with reference charges (e.g.
+DDEC charges) are optimised by nonlinear least squares. The objective is the squared deviation of the QEq charges
+from the reference charges, summed over all atoms, plus a small penalty on the deviation from the initial
+parameters (the QEq charges are invariant under a common shift of all electronegativities).
+
+The Coulomb matrix of a structure depends only on its geometry and is computed once; every evaluation of the
+objective then costs one dense solve per structure. Derivatives of the charges with respect to the parameters
+are analytic: differentiating the QEq equations K q = -chi (with the total charge constraint) gives
+K' dq = -d chi - dK q, where K' is the matrix of the equations linearised in the charges, i.e. K with the
+charge-dependent hardness of hydrogen differentiated as well. The solves for all parameters share one
+factorisation of K'.
+
+Structures are evaluated in a process pool that holds the Coulomb matrices, such that only the parameters are
+sent to the workers in each iteration.
+"""
+from collections import namedtuple
+
+import numpy as np
+from aiida.engine import calcfunction
+from aiida.orm import Dict
+
+from aiida_qeq.data.tables import QeqElementTable
+from . import qeq
+from .utils import get_symbols
+
+# Weight of the deviation of the parameters from the initial values (e/eV): a deviation of 1 eV costs as much
+# as a charge deviation of 0.01 e
+DEFAULT_REGULARIZATION = 1e-2
+# Lower bound of the fitted hardness in eV
+MIN_HARDNESS = 0.5
+MAX_EVALUATIONS = 200
+
+TrainingStructure = namedtuple('TrainingStructure', ['numbers', 'coulomb', 'hydrogen_zeta', 'reference_charges'])
+QeqFitResult = namedtuple(
+    'QeqFitResult',
+    ['electronegativity', 'hardness', 'elements', 'rmsd', 'initial_rmsd', 'num_evaluations', 'success', 'message'])
+
+
+def training_structure(cell, positions, numbers, reference_charges, radii=None):
+    """Precompute the geometry-dependent part of the QEq equations of a training structure.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param reference_charges: (N,) array of reference charges
+    :param radii: orbital radii in Angstrom indexed by atomic number (defaults to the egulp radii)
+    :return: `TrainingStructure`
+    """
+    numbers = np.asarray(numbers)
+    if radii is None:
+        radii = qeq.default_radii()
+    reference_charges = np.asarray(reference_charges, dtype=float)
+    if len(reference_charges) != len(numbers):
+        raise ValueError('Got {} reference charges for {} atoms'.format(len(reference_charges), len(numbers)))
+    return TrainingStructure(numbers, qeq.coulomb_matrix(cell, positions, numbers, radii),
+                             np.where(numbers == 1, qeq.slater_exponents(numbers, radii), np.nan), reference_charges)
+
+
+def charge_derivatives(structure, electronegativity, hardness, elements, initial_charges=None):
+    """Compute the QEq charges of a training structure and their derivatives with respect to the parameters.
+
+    :param structure: `TrainingStructure`
+    :param electronegativity: electronegativities in eV indexed by atomic number
+    :param hardness: hardness 0.5 J in eV indexed by atomic number
+    :param elements: atomic numbers of the fitted elements
+    :param initial_charges: initial guess for the self-consistency cycle of hydrogen
+    :return: tuple (`QeqResult`, (N, 2 * len(elements)) array with the derivatives of the charges with respect to
+        the electronegativity and then the hardness of the fitted elements)
+    """
+    numbers = structure.numbers
+    natoms = len(numbers)
+    result = qeq.solve(structure.coulomb,
+                       electronegativity[numbers],
+                       hardness[numbers],
+                       hydrogen_zeta=structure.hydrogen_zeta,
+                       initial_charges=initial_charges)
+    charges = result.charges
+
+    hydrogen = ~np.isnan(structure.hydrogen_zeta)
+    scaling = np.ones(natoms)
+    scaling[hydrogen] += charges[hydrogen] / structure.hydrogen_zeta[hydrogen]
+    # d/dq_i of 2 h_i (1 + q_i / zeta_i) q_i
+    tangent = np.zeros(natoms)
+    tangent[hydrogen] = 2 * hardness[numbers[hydrogen]] * (2 * scaling[hydrogen] - 1)
+    tangent[~hydrogen] = 2 * hardness[numbers[~hydrogen]]
+
+    system = np.zeros((natoms + 1, natoms + 1))
+    system[:natoms, :natoms] = structure.coulomb
+    system[np.diag_indices(natoms)] += tangent
+    system[:natoms, natoms] = system[natoms, :natoms] = 1.
+
+    members = (numbers[:, None] == np.asarray(elements)[None, :]).astype(float)
+    rhs = np.zeros((natoms + 1, 2 * len(elements)))
+    rhs[:natoms, :len(elements)] = -members
+    rhs[:natoms, len(elements):] = -2 * (scaling * charges)[:, None] * members
+    return result, np.linalg.solve(system, rhs)[:natoms]
+
+
+def _residuals(structure, electronegativity, hardness, elements, initial_charges=None):
+    """Return deviations from the reference charges, their derivatives with respect to the parameters, the charges
+    and whether the charges are converged."""
+    result, jacobian = charge_derivatives(structure, electronegativity, hardness, elements, initial_charges)
+    return result.charges - structure.reference_charges, jacobian, result.charges, result.converged
+
+
+_STRUCTURES = None
+
+
+def _init_worker(structures):
+    """Store the training structures in a worker process of the pool."""
+    global _STRUCTURES  # pylint: disable=global-statement
+    _STRUCTURES = structures
+
+
+def _evaluate_structure(args):
+    """Evaluate a training structure in a worker process of the pool."""
+    index, electronegativity, hardness, elements, initial_charges = args
+    return _residuals(_STRUCTURES[index], electronegativity, hardness, elements, initial_charges)
+
+
+class _Objective:  # pylint: disable=too-many-instance-attributes
+    """Residuals and Jacobian of the least-squares problem, evaluated together and cached for the last parameters."""
+
+    def __init__(self, structures, electronegativity, hardness, elements, regularization, pool=None):  # pylint: disable=too-many-arguments
+        self.structures = structures
+        self.electronegativity = np.array(electronegativity, dtype=float)
+        self.hardness = np.array(hardness, dtype=float)
+        self.elements = np.asarray(elements)
+        self.initial = np.concatenate([self.electronegativity[self.elements], self.hardness[self.elements]])
+        self.regularization = regularization
+        self.pool = pool
+        self._cache = (None, None)
+        # charges of the previous evaluation, the initial guess of the self-consistency cycle of the next one
+        self.charges = [None] * len(structures)
+        self.converged = True
+
+    def evaluate(self, params):
+        """Return (residuals, jacobian) for parameters (electronegativities, then hardness of the fitted elements)."""
+        if self._cache[0] is not None and np.array_equal(self._cache[0], params):
+            return self._cache[1]
+        nelements = len(self.elements)
+        electronegativity, hardness = self.electronegativity.copy(), self.hardness.copy()
+        electronegativity[self.elements] = params[:nelements]
+        hardness[self.elements] = params[nelements:]
+
+        if self.pool is None:
+            outputs = [
+                _residuals(structure, electronegativity, hardness, self.elements, charges)
+                for structure, charges in zip(self.structures, self.charges)
+            ]
+        else:
+            outputs = list(
+                self.pool.map(_evaluate_structure, [(index, electronegativity, hardness, self.elements, charges)
+                                                    for index, charges in enumerate(self.charges)]))
+        self.charges = [output[2] for output in outputs]
+        self.converged = all(output[3] for output in outputs)
+        residuals = np.concatenate([output[0] for output in outputs] + [self.regularization * (params - self.initial)])
+        jacobian = np.vstack([output[1] for output in outputs] + [self.regularization * np.eye(len(params))])
+        self._cache = (np.array(params), (residuals, jacobian))
+        return residuals, jacobian
+
+    def rmsd(self, params):
+        """Return the root mean square deviation from the reference charges."""
+        num_atoms = sum(len(structure.numbers) for structure in self.structures)
+        return np.sqrt(np.mean(self.evaluate(params)[0][:num_atoms]**2))
+
+
+def fit(  # pylint: disable=too-many-arguments
+        structures,
+        electronegativity,
+        hardness,
+        elements=None,
+        regularization=DEFAULT_REGULARIZATION,
+        max_workers=None):
+    """Fit the electronegativity and hardness of elements to the reference charges of a training set.
+
+    :param structures: list of `TrainingStructure`
+    :param electronegativity: initial electronegativities in eV indexed by atomic number
+    :param hardness: initial hardness 0.5 J in eV indexed by atomic number
+    :param elements: atomic numbers of the fitted elements (defaults to all elements of the training set)
+    :param regularization: weight of the deviation from the initial parameters (e/eV)
+    :param max_workers: number of worker processes, None or 1 to evaluate in the current process
+    :return: `QeqFitResult` with the fitted parameters indexed by atomic number (initial values for the other
+        elements)
+    """
+    from scipy.optimize import least_squares
+
+    all_elements = np.unique(np.concatenate([structure.numbers for structure in structures]))
+    qeq.check_parameters(all_elements, hardness)
+    elements = all_elements if elements is None else np.unique(elements)
+
+    def run(pool):
+        objective = _Objective(structures, electronegativity, hardness, elements, regularization, pool)
+        initial_rmsd = objective.rmsd(objective.initial)
+        lower = np.concatenate([np.full(len(elements), -np.inf), np.full(len(elements), MIN_HARDNESS)])
+        solution = least_squares(lambda params: objective.evaluate(params)[0],
+                                 np.maximum(objective.initial, lower + 1e-6),
+                                 jac=lambda params: objective.evaluate(params)[1],
+                                 bounds=(lower, np.inf),
+                                 max_nfev=MAX_EVALUATIONS)
+        rmsd = objective.rmsd(solution.x)
+        fitted_electronegativity, fitted_hardness = objective.electronegativity, objective.hardness
+        fitted_electronegativity[elements] = solution.x[:len(elements)]
+        fitted_hardness[elements] = solution.x[len(elements):]
+        return QeqFitResult(fitted_electronegativity, fitted_hardness, elements, rmsd, initial_rmsd, solution.nfev,
+                            bool(solution.success and objective.converged), solution.message)
+
+    if not max_workers or max_workers == 1:
+        return run(None)
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(structures,)) as pool:
+        return run(pool)
+
+
+@calcfunction
+def fit_qeq_parameters(parameters, elements=None, regularization=None, max_workers=None, **structures):
+    """Fit QEq element parameters to the reference charges of a training set of structures.
+
+    :param parameters: `QeqElementTable` or `SinglefileData` with the initial electronegativity and hardness of the
+        elements (GMP.param format)
+    :param elements: `List` of chemical symbols of the fitted elements (optional, defaults to all elements of the
+        training set)
+    :param regularization: `Float` weight of the deviation from the initial parameters in e/eV (optional)
+    :param max_workers: `Int` number of worker processes (optional)
+    :param structures: `CifData` nodes with reference charges (``_atom_site_charge``)
+    :return: ``parameters`` output, `QeqElementTable` with the fitted parameters, and ``fit`` output, `Dict`
+        with the root mean square deviations of the charges before and after the fit
+    """
+    from ase.data import atomic_numbers
+
+    if not structures:
+        raise ValueError('No training structures given')
+    table = QeqElementTable.from_node(parameters)
+    training_set = _training_set(structures.values())
+
+    result = fit(training_set,
+                 table.electronegativity,
+                 table.hardness,
+                 elements=[atomic_numbers[symbol] for symbol in elements.get_list()] if elements is not None else None,
+                 regularization=DEFAULT_REGULARIZATION if regularization is None else regularization.value,
+                 max_workers=max_workers.value if max_workers is not None else None)
+    fitted = QeqElementTable.from_arrays(result.electronegativity, result.hardness)
+    summary = {
+        'elements': get_symbols(result.elements),
+        'num_structures': len(training_set),
+        'num_atoms': sum(len(structure.numbers) for structure in training_set),
+        'initial_rmsd': float(result.initial_rmsd),
+        'rmsd': float(result.rmsd),
+        'num_evaluations': int(result.num_evaluations),
+        'success': result.success,
+        'message': str(result.message),
+    }
+    return {'parameters': fitted, 'fit': Dict(dict=summary)}
+
+
+def _training_set(structures):
+    """Return the `TrainingStructure` of each `CifData` with reference charges."""
+    from ase.data import atomic_numbers
+    from aiida_qeq.utils.formats import charge_arrays
+
+    training_set = []
+    for structure in structures:
+        cell, positions, symbols, charges = charge_arrays(structure)
+        numbers = [atomic_numbers[symbol] for symbol in symbols]
+        training_set.append(training_structure(cell, positions, numbers, charges))
+    return training_set
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental in-process QEq engine for variants of a parent structure.
+
+Variants of a framework (functionalised linkers, defects, guest molecules) share most atoms with the parent
+structure. `IncrementalQeq` computes the Coulomb matrix of the parent once and keeps the LU factorisation of its
+QEq system. For a variant in the same cell, atoms are matched to the parent by position and element; only the
+Coulomb matrix rows of the added atoms are computed, and the variant system, which differs from the parent system
+in the rows and columns of the added and removed atoms, is solved by a Woodbury update of rank twice the number
+of changed atoms::
+
+    engine = IncrementalQeq(cell, positions, numbers, electronegativity, hardness)
+    result = engine.compute_charges(variant_positions, variant_numbers)
+
+The change of the charge-dependent hardness of hydrogen atoms with respect to the parent is a small diagonal
+perturbation, which is converged by iterative refinement. If the change is too large (more than
+`MAX_UPDATE_FRACTION` of the parent atoms), or the refinement does not converge, the variant system is assembled
+from the cached parent matrix and solved directly.
+"""
+import numpy as np
+from aiida.engine import calcfunction
+from aiida.plugins import CalculationFactory, DataFactory
+from scipy import linalg
+
+from aiida_qeq.data.tables import QeqElementTable
+from aiida_qeq.utils.cif import cif_node_with_charges
+from . import qeq
+from .utils import fractional_coordinates, get_arrays, get_symbols
+
+# Atoms of a variant closer than this (Angstrom) to a parent atom of the same element are considered unchanged
+POSITION_TOLERANCE = 1e-4
+# Largest number of changed atoms, relative to the number of parent atoms, for which low-rank updates are used
+MAX_UPDATE_FRACTION = 0.1
+# Iterative refinement of the hydrogen hardness perturbation
+REFINEMENT_TOLERANCE = 1e-12
+REFINEMENT_MAX_ITERATIONS = 50
+
+
+class IncrementalQeq:  # pylint: disable=too-many-instance-attributes
+    """
+    QEq solver caching the Coulomb matrix and the factorised QEq system of a parent structure.
+    """
+
+    def __init__(self, cell, positions, numbers, electronegativity, hardness, radii=None):  # pylint: disable=too-many-arguments
+        """
+        :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+        :param positions: (N, 3) array of cartesian positions (Angstrom)
+        :param numbers: (N,) array of atomic numbers
+        :param electronegativity: electronegativities in eV indexed by atomic number
+        :param hardness: hardness 0.5 J in eV indexed by atomic number
+        :param radii: orbital radii in Angstrom indexed by atomic number (defaults to the egulp radii)
+        """
+        self.cell = np.asarray(cell, dtype=float)
+        self.positions = np.asarray(positions, dtype=float)
+        self.numbers = np.asarray(numbers)
+        self.electronegativity = np.asarray(electronegativity, dtype=float)
+        self.hardness = np.asarray(hardness, dtype=float)
+        self.radii = qeq.default_radii() if radii is None else radii
+        qeq.check_parameters(self.numbers, self.hardness)
+
+        self.coulomb = qeq.coulomb_matrix(self.cell, self.positions, self.numbers, self.radii)
+        self.result = qeq.solve(self.coulomb,
+                                self.electronegativity[self.numbers],
+                                self.hardness[self.numbers],
+                                hydrogen_zeta=self._hydrogen_zeta(self.numbers))
+
+        # bordered QEq system of the parent, at the converged hardness of hydrogen
+        natoms = len(self.numbers)
+        self.scaling = self._scaling(self.numbers, self.result.charges)
+        self.system = np.zeros((natoms + 1, natoms + 1))
+        self.system[:natoms, :natoms] = self.coulomb
+        self.system[np.diag_indices(natoms)] += 2 * self.hardness[self.numbers] * self.scaling
+        self.system[:natoms, natoms] = self.system[natoms, :natoms] = 1.
+        self.factors = linalg.lu_factor(self.system)
+
+    @property
+    def charges(self):
+        """Charges of the parent structure."""
+        return self.result.charges
+
+    def _hydrogen_zeta(self, numbers):
+        """Return the Slater exponents of hydrogen atoms and nan elsewhere."""
+        return np.where(numbers == 1, qeq.slater_exponents(numbers, self.radii), np.nan)
+
+    def _scaling(self, numbers, charges):
+        """Return the hardness scaling factors J(q) / J for the given charges."""
+        zeta = self._hydrogen_zeta(numbers)
+        hydrogen = ~np.isnan(zeta)
+        scaling = np.ones(len(numbers))
+        scaling[hydrogen] += charges[hydrogen] / zeta[hydrogen]
+        return scaling
+
+    def match(self, positions, numbers, tolerance=POSITION_TOLERANCE):
+        """Match the atoms of a variant in the parent cell to the atoms of the parent.
+
+        :param positions: (M, 3) array of cartesian positions of the variant (Angstrom)
+        :param numbers: (M,) array of atomic numbers of the variant
+        :param tolerance: maximum distance (Angstrom) of matching atoms
+        :return: tuple (matched, added, removed) of the parent index of each variant atom (-1 if added),
+            the indices of added variant atoms and of removed parent atoms
+        """
+        from scipy.spatial import cKDTree
+
+        parent = fractional_coordinates(self.cell, self.positions) % 1.
+        variant = fractional_coordinates(self.cell, positions) % 1.
+        _, nearest = cKDTree(parent, boxsize=1.).query(variant)
+        diff = variant - parent[nearest]
+        dist = np.linalg.norm((diff - np.round(diff)) @ self.cell, axis=1)
+        matched = np.where((dist < tolerance) & (self.numbers[nearest] == np.asarray(numbers)), nearest, -1)
+        if len(np.unique(matched[matched >= 0])) != np.count_nonzero(matched >= 0):
+            raise ValueError('Several atoms of the variant match the same parent atom')
+        removed = np.setdiff1d(np.arange(len(self.numbers)), matched)
+        return matched, np.flatnonzero(matched < 0), removed
+
+    def compute_charges(self, positions, numbers, cell=None, max_update_fraction=MAX_UPDATE_FRACTION):  # pylint: disable=too-many-locals
+        """Compute QEq charges of a variant of the parent structure.
+
+        :param positions: (M, 3) array of cartesian positions of the variant (Angstrom)
+        :param numbers: (M,) array of atomic numbers of the variant
+        :param cell: cell of the variant, must match the parent cell (optional)
+        :param max_update_fraction: largest number of changed atoms relative to the number of parent atoms for
+            which the low-rank update is used
+        :return: `QeqResult` with the charges of the variant atoms
+        :raises ValueError: if the cell of the variant differs from the parent cell
+        """
+        if cell is not None and not np.allclose(cell, self.cell, atol=POSITION_TOLERANCE):
+            raise ValueError('Incremental updates require the cell of the parent structure')
+        positions = np.asarray(positions, dtype=float)
+        numbers = np.asarray(numbers)
+        qeq.check_parameters(numbers, self.hardness)
+        matched, added, removed = self.match(positions, numbers)
+
+        # extended atoms: parent atoms followed by the added atoms, removed atoms are decoupled with zero charge
+        natoms = len(self.numbers)
+        ext_numbers = np.concatenate([self.numbers, numbers[added]])
+        ext_positions = np.concatenate([self.positions, positions[added]])
+        rows = qeq.coulomb_matrix(self.cell,
+                                  ext_positions,
+                                  ext_numbers,
+                                  self.radii,
+                                  rows=natoms + np.arange(len(added)))
+        kept = np.ones(len(ext_numbers), dtype=bool)
+        kept[removed] = False
+
+        initial = np.concatenate([self.charges, np.zeros(len(added))])
+        initial[removed] = 0.
+        result = None
+        if len(added) + len(removed) <= max_update_fraction * natoms:
+            result = self._solve_low_rank(ext_numbers, rows, removed, initial)
+        if result is None:
+            result = self._solve_dense(ext_numbers, rows, kept, initial)
+
+        ext_index = np.where(matched >= 0, matched, 0)
+        ext_index[added] = natoms + np.arange(len(added))
+        return result._replace(charges=result.charges[ext_index])
+
+    def _solve_dense(self, ext_numbers, rows, kept, initial):
+        """Solve the variant system assembled from the cached parent matrix and the rows of the added atoms.
+
+        :return: `QeqResult` with the charges of the extended atoms (zero for removed atoms)
+        """
+        natoms = len(self.numbers)
+        coulomb = np.zeros((len(ext_numbers), len(ext_numbers)))
+        coulomb[:natoms, :natoms] = self.coulomb
+        coulomb[natoms:] = rows
+        coulomb[:, natoms:] = rows.T
+        result = qeq.solve(coulomb[np.ix_(kept, kept)],
+                           self.electronegativity[ext_numbers[kept]],
+                           self.hardness[ext_numbers[kept]],
+                           hydrogen_zeta=self._hydrogen_zeta(ext_numbers[kept]),
+                           initial_charges=initial[kept])
+        charges = np.zeros(len(ext_numbers))
+        charges[kept] = result.charges
+        return result._replace(charges=charges)
+
+    def _solve_low_rank(self, ext_numbers, rows, removed, initial):  # pylint: disable=too-many-locals
+        """Solve the variant system by a Woodbury update of the factorised parent system.
+
+        The extended system holds the parent system (atoms and charge constraint), followed by the added atoms.
+        It differs from the block-diagonal matrix B = diag(parent system, identity) in the rows and columns S of
+        the removed and added atoms only: A = B + E with E = P_S E_S + F P_S^T, where E_S are the rows S of E and
+        F its columns S with the rows S set to zero.
+
+        :return: `QeqResult` with the charges of the extended atoms (zero for removed atoms),
+            or None if the refinement of the hydrogen hardness does not converge
+        """
+        natoms = len(self.numbers)
+        num_added = len(ext_numbers) - natoms
+        size = natoms + 1 + num_added
+        # index in the extended system of each extended atom (the charge constraint sits at index natoms)
+        atoms = np.concatenate([np.arange(natoms), natoms + 1 + np.arange(num_added)])
+        changed = np.concatenate([removed, natoms + 1 + np.arange(num_added)])
+        hardness = self.hardness[ext_numbers]
+        electronegativity = np.where(np.isin(np.arange(len(ext_numbers)), removed), 0.,
+                                     self.electronegativity[ext_numbers])
+        # hardness scaling contained in the extended system (parent scaling, no scaling for added atoms)
+        base_scaling = np.concatenate([self.scaling, np.ones(num_added)])
+
+        rows_changed = np.zeros((len(changed), size))
+        rows_changed[np.arange(len(removed)), removed] = 1.
+        added_rows = rows_changed[len(removed):]
+        added_rows[:, atoms] = rows
+        added_rows[:, removed] = 0.
+        added_rows[:, natoms] = 1.
+        added_rows[np.arange(num_added), natoms + 1 + np.arange(num_added)] += 2 * hardness[natoms:]
+
+        def apply_base(vectors):
+            """Multiply by B."""
+            result = np.array(vectors, dtype=float)
+            result[:natoms + 1] = self.system @ vectors[:natoms + 1]
+            return result
+
+        def solve_base(vectors):
+            """Solve with B."""
+            result = np.array(vectors, dtype=float)
+            result[:natoms + 1] = linalg.lu_solve(self.factors, vectors[:natoms + 1])
+            return result
+
+        identity = np.eye(size)[:, changed]
+        rows_update = rows_changed - apply_base(identity).T
+        columns_update = rows_update.T.copy()
+        columns_update[changed] = 0.
+        update_left = np.concatenate([identity, columns_update], axis=1)
+        update_right = np.concatenate([rows_update, identity.T], axis=0)
+        left_solved = solve_base(update_left)
+        capacitance = linalg.lu_factor(np.eye(len(update_right)) + update_right @ left_solved)
+
+        def apply(vector):
+            """Multiply by A."""
+            return apply_base(vector) + update_left @ (update_right @ vector)
+
+        def solve_update(vector):
+            """Solve with A (Woodbury identity)."""
+            solved = solve_base(vector)
+            return solved - left_solved @ linalg.lu_solve(capacitance, update_right @ solved)
+
+        rhs = np.zeros(size)
+        rhs[atoms] = -electronegativity
+        state = {'converged': True}
+
+        def solve_fixed(scaling, _charges):
+            # the change of the hydrogen hardness relative to A is diagonal
+            diagonal = np.zeros(size)
+            diagonal[atoms] = 2 * hardness * (scaling - base_scaling)
+            diagonal[removed] = 0.
+            solution = solve_update(rhs)
+            for _ in range(REFINEMENT_MAX_ITERATIONS):
+                residual = rhs - apply(solution) - diagonal * solution
+                if np.abs(residual).max() < REFINEMENT_TOLERANCE * np.abs(rhs).max():
+                    break
+                solution += solve_update(residual)
+            else:
+                state['converged'] = False
+            charges = solution[atoms]
+            matrix_charges = apply(np.where(np.isin(np.arange(size), atoms), solution, 0.)) + diagonal * solution
+            return charges, electronegativity @ charges + 0.5 * charges @ matrix_charges[atoms]
+
+        zeta = self._hydrogen_zeta(ext_numbers)
+        zeta[removed] = np.nan
+        result = qeq.self_consistent_charges(solve_fixed, len(ext_numbers), zeta, initial)
+        return result if state['converged'] else None
+
+
+@calcfunction
+def qeq_charges_variants(parent, parameters, configure=None, **variants):
+    """Compute QEq charges in-process for variants of a parent structure, by low-rank updates of the parent system.
+
+    :param parent: `CifData` of the parent structure
+    :param parameters: `QeqElementTable` or `SinglefileData` with electronegativity and hardness of the elements
+        (GMP.param format)
+    :param configure: `QeqParameters` (optional)
+    :param variants: `CifData` of the variants, in the cell of the parent structure
+    :return: structures with charges, with the link labels of the variants
+    """
+    QeqParameters = DataFactory('qeq.qeq')  # pylint: disable=invalid-name
+    configure = (configure or QeqParameters()).get_dict()
+    qeq.check_configure(configure)
+
+    table = QeqElementTable.from_node(parameters)
+    cell, positions, numbers = get_arrays(parent)
+    engine = IncrementalQeq(cell, positions, numbers, table.electronegativity, table.hardness)
+
+    results = {}
+    for key, structure in variants.items():
+        cell, positions, numbers = get_arrays(structure)
+        result = engine.compute_charges(positions, numbers, cell=cell)
+        if not result.converged:
+            return CalculationFactory('qeq.qeq').exit_codes.ERROR_SCF_NOT_CONVERGED
+        results[key] = cif_node_with_charges(cell,
+                                             get_symbols(numbers),
+                                             fractional_coordinates(cell, positions),
+                                             result.charges,
+                                             method='qeq')
+    return results
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Tabulated Coulomb integrals between the Slater orbitals of pairs of elements.
+
+QEq damps the Coulomb interaction at short range by the overlap of the ns Slater orbitals of the two atoms.
+For each pair of elements, the difference between the Coulomb integral of the orbital densities and the point
+charge interaction is tabulated on a uniform distance grid (see `orbital_correction_table`), and pair interactions
+are interpolated from the tables (see `aiida_qeq.engines.qeq.OrbitalCorrections`).
+
+The orbital exponents follow from the orbital radii, so the tables depend only on the radii table and the grid
+spacing. Tables are computed only for the pairs of elements present in a structure, memoised in the process and
+persisted on disk in one file per radii table (named after the hash of the table and the grid), such that repeated
+runs (e.g. screenings) skip the quadrature.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from aiida_qeq.utils.cache import default_cache_directory
+from .utils import BOHR, COULOMB_CONSTANT, HARTREE
+
+# Scaling factor of the Slater exponents
+SLATER_LAMBDA = 0.4913
+# Range of the orbital overlap corrections in Angstrom (egulp: rqeq)
+ORBITAL_CUTOFF = 15.0
+# Grid spacing of the tabulated orbital overlap corrections in Angstrom
+TABLE_SPACING = 0.02
+
+TABLE_VERSION = 1
+TABLE_EXTENSION = '.npz'
+
+# tables in memory, keyed by table key and pair of atomic numbers
+_TABLES = {}
+
+
+def principal_quantum_numbers(numbers):
+    """Return the principal quantum number of the valence shell of each element."""
+    return np.searchsorted([2, 10, 18, 36, 54, 86], numbers) + 1
+
+
+def slater_exponents(numbers, radii):
+    """Return Slater exponents (1/Bohr) of the ns valence orbitals.
+
+    :param numbers: atomic numbers
+    :param radii: orbital radii in Angstrom indexed by atomic number
+    """
+    n = principal_quantum_numbers(numbers)
+    return SLATER_LAMBDA * (2 * n + 1) / (2 * radii[numbers] / BOHR)
+
+
+def _density_transform(k, n, zeta):
+    """Fourier transform of the normalised density of an ns Slater orbital (atomic units)."""
+    theta = np.arctan2(k, 2 * zeta)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        transform = np.cos(theta)**(2 * n + 1) * np.sin(2 * n * theta) / (2 * n * np.sin(theta))
+    return np.where(k > 0, transform, 1.)
+
+
+def slater_coulomb(distances, n_a, zeta_a, n_b, zeta_b):
+    """Coulomb integral between the densities of two normalised ns Slater orbitals.
+
+    Evaluates J(R) = 2/pi int_0^inf rho_a(k) rho_b(k) sin(kR)/(kR) dk by quadrature.
+
+    :param distances: array of distances in Bohr
+    :return: array of Coulomb integrals in Hartree
+    """
+    distances = np.asarray(distances, dtype=float)
+    k_max = 40 * max(zeta_a, zeta_b)
+    dk = min(0.1, np.pi / (10 * max(distances.max(), 1.)))
+    k = np.arange(0, k_max, dk)
+    weights = _density_transform(k, n_a, zeta_a) * _density_transform(k, n_b, zeta_b) * dk
+    weights[0] *= 0.5
+    return 2 / np.pi * (np.sinc(np.outer(distances, k) / np.pi) @ weights)
+
+
+def orbital_correction_table(n_a, zeta_a, n_b, zeta_b, spacing=TABLE_SPACING, cutoff=ORBITAL_CUTOFF):  # pylint: disable=too-many-arguments
+    """Tabulate the difference between the Slater orbital and the point charge Coulomb interaction.
+
+    The table extends up to ``cutoff`` or until the correction has decayed to below ~1e-10, whichever is shorter.
+    Tables are memoised and persisted by `CoulombIntegralTables`.
+
+    :return: tuple (distances, corrections) with distances in Angstrom and corrections in eV
+    """
+    extent = min(cutoff, 12 * BOHR / min(zeta_a, zeta_b))
+    distances = np.arange(1, int(np.ceil(extent / spacing)) + 1) * spacing
+    coulomb = slater_coulomb(distances / BOHR, n_a, zeta_a, n_b, zeta_b) * HARTREE
+    return distances, coulomb - COULOMB_CONSTANT / distances
+
+
+def default_table_directory():
+    """Return the default directory of persisted tables (``coulomb-integrals`` in the charge cache directory)."""
+    return os.path.join(default_cache_directory(), 'coulomb-integrals')
+
+
+def table_key(radii, spacing=TABLE_SPACING):
+    """Return sha256 hex digest of the orbital radii and grid spacing, which determine the tables.
+
+    :param radii: orbital radii in Angstrom indexed by atomic number
+    :param spacing: grid spacing in Angstrom
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps([TABLE_VERSION, spacing, ORBITAL_CUTOFF, SLATER_LAMBDA]).encode('utf-8'))
+    sha.update(np.ascontiguousarray(radii, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+class CoulombIntegralTables:
+    """
+    Orbital overlap corrections of pairs of elements, tabulated up to `ORBITAL_CUTOFF`.
+
+    Usage::
+
+        tables = CoulombIntegralTables(radii)
+        tables.require(numbers)  # computes or loads the tables of all pairs of elements of a structure
+        tables[6, 8]  # corrections in eV at distances (1, 2, ...) * tables.spacing
+    """
+
+    def __init__(self, radii, spacing=TABLE_SPACING, directory=None):
+        """
+        :param radii: orbital radii in Angstrom indexed by atomic number
+        :param spacing: grid spacing in Angstrom
+        :param directory: directory of persisted tables, defaults to `default_table_directory`.
+            Pass False to keep the tables in memory only.
+        """
+        self.radii = np.asarray(radii, dtype=float)
+        self.spacing = spacing
+        self.key = table_key(self.radii, spacing)
+        self.directory = default_table_directory() if directory is None else directory
+        self.tables = _TABLES.setdefault(self.key, {})
+
+    @property
+    def path(self):
+        """Path of the file with the persisted tables, or None."""
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, self.key + TABLE_EXTENSION)
+
+    @staticmethod
+    def _pair(z_a, z_b):
+        return (int(z_a), int(z_b)) if z_a <= z_b else (int(z_b), int(z_a))
+
+    def __getitem__(self, pair):
+        """Return the corrections in eV of a pair of atomic numbers (the array must not be modified)."""
+        return self.tables[self._pair(*pair)]
+
+    def _read(self):
+        """Return the persisted tables, keyed by pair of atomic numbers."""
+        try:
+            with np.load(self.path) as handle:
+                return {tuple(int(z) for z in name.split('-')): handle[name] for name in handle.files}
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, tables):
+        """Add tables to the persisted ones. Failures are ignored, the tables are only recomputed next time."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            content = self._read()
+            content.update(tables)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'wb') as handle:
+                np.savez(handle, **{'{}-{}'.format(*pair): values for pair, values in content.items()})
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def require(self, numbers):
+        """Make the tables of all pairs of elements of a structure available.
+
+        Tables missing in memory are read from disk, the remaining ones are computed and persisted.
+
+        :param numbers: atomic numbers
+        """
+        species = np.unique(numbers)
+        missing = [(a, b) for i, a in enumerate(species) for b in species[i:] if self._pair(a, b) not in self.tables]
+        if not missing:
+            return
+        if self.path is not None:
+            self.tables.update(self._read())
+        missing = [self._pair(a, b) for a, b in missing if self._pair(a, b) not in self.tables]
+        if not missing:
+            return
+
+        n = principal_quantum_numbers(np.arange(len(self.radii)))
+        zeta = slater_exponents(np.arange(len(self.radii)), self.radii)
+        computed = {}
+        for z_a, z_b in missing:
+            computed[z_a, z_b] = orbital_correction_table(n[z_a], zeta[z_a], n[z_b], zeta[z_b], spacing=self.spacing)[1]
+        self.tables.update(computed)
+        if self.path is not None:
+            self._write(computed)
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Matrix-free QEq solver for large periodic structures.
+
+The dense engine in `aiida_qeq.engines.qeq` stores the N x N Coulomb matrix and solves it directly, which needs
+O(N^2) memory and O(N^3) time. Here the Coulomb operator is only ever applied to a vector of charges:
+
+ * real-space Ewald terms and orbital overlap corrections are short ranged and stored as a sparse matrix,
+   with the pairs of atoms found by a k-d tree search over periodic images,
+ * the reciprocal-space Ewald sum is evaluated by smooth particle-mesh Ewald (Essmann et al.,
+   J. Chem. Phys. 103, 8577 (1995)): charges are spread onto a mesh with cardinal B-splines and the
+   convolution with the Ewald kernel is done by FFT,
+
+and the QEq equations, constrained to a fixed total charge, are solved by preconditioned conjugate gradients.
+Both memory and time per iteration scale as O(N log N).
+"""
+import numpy as np
+from scipy import fft, sparse
+from scipy.special import erfc  # pylint: disable=no-name-in-module
+from aiida.engine import calcfunction
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_qeq.data.tables import QeqElementTable
+from aiida_qeq.utils.cif import cif_node_with_charges
+from . import ewald, qeq
+from .utils import COULOMB_CONSTANT, fractional_coordinates, get_arrays, get_symbols
+
+# Relative accuracy of the real-space Ewald sum
+DEFAULT_ACCURACY = 1e-6
+# Real-space cutoff in Angstrom (extended to the range of the orbital overlap corrections if needed)
+DEFAULT_CUTOFF = 12.0
+# Order of the B-spline interpolation (must be even)
+DEFAULT_ORDER = 6
+# Mesh spacing times Ewald splitting parameter; 0.28 gives a relative accuracy of ~1e-6 for order 6
+MESH_FACTOR = 0.28
+# Conjugate gradient iterations stop when the projected residual has dropped by this factor
+PCG_TOLERANCE = 1e-8
+PCG_MAX_ITERATIONS = 1000
+
+
+def bspline_weights(offsets, order):
+    """Return cardinal B-spline weights M_n(w + j), j = 0, ..., n-1, for fractional offsets w in [0, 1).
+
+    :param offsets: (N,) array of offsets w
+    :param order: order n of the B-spline
+    :return: (N, n) array
+    """
+    weights = np.zeros((len(offsets), order))
+    weights[:, 0] = offsets
+    weights[:, 1] = 1 - offsets
+    for k in range(3, order + 1):
+        previous = weights.copy()
+        for j in range(k):
+            x = offsets + j
+            upper = previous[:, j] if j < k - 1 else 0.
+            lower = previous[:, j - 1] if j > 0 else 0.
+            weights[:, j] = (x * upper + (k - x) * lower) / (k - 1)
+    return weights
+
+
+def bspline_moduli(size, order):
+    """Return |b(m)|^2 of the smooth PME method for mesh indices m = 0, ..., size-1.
+
+    :param size: number of mesh points along one lattice vector
+    :param order: order of the B-spline (even, otherwise b(m) diverges at the Nyquist frequency)
+    """
+    # values M_n(1), ..., M_n(n-1) at the integer knots
+    knots = bspline_weights(np.zeros(1), order)[0, 1:]
+    m = np.arange(size)
+    factor = np.exp(2j * np.pi * np.outer(m, np.arange(order - 1)) / size) @ knots
+    return 1. / np.abs(factor)**2
+
+
+def mesh_size(cell, alpha, order=DEFAULT_ORDER):
+    """Return the number of mesh points along each lattice vector for a given Ewald splitting parameter."""
+    spacing = MESH_FACTOR / alpha * DEFAULT_ORDER / order
+    sizes = np.ceil(np.linalg.norm(cell, axis=1) / spacing).astype(int)
+    return tuple(fft.next_fast_len(max(int(size), 2 * order)) for size in sizes)
+
+
+class ReciprocalOperator:  # pylint: disable=too-few-public-methods
+    """
+    Reciprocal-space Ewald sum between unit point charges (e^2/Angstrom), applied by smooth particle-mesh Ewald.
+
+    Equivalent to `aiida_qeq.engines.ewald.reciprocal_space_matrix`, but never forms the matrix.
+    """
+
+    def __init__(self, cell, positions, alpha, mesh=None, order=DEFAULT_ORDER):  # pylint: disable=too-many-arguments,too-many-locals
+        """
+        :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+        :param positions: (N, 3) array of cartesian positions (Angstrom)
+        :param alpha: Ewald splitting parameter (1/Angstrom)
+        :param mesh: number of mesh points along each lattice vector, defaults to `mesh_size`
+        :param order: order of the B-spline interpolation
+        """
+        if order % 2:
+            raise ValueError('Order of the B-spline interpolation must be even, got {}'.format(order))
+        cell = np.asarray(cell, dtype=float)
+        self.mesh = tuple(mesh or mesh_size(cell, alpha, order))
+        natoms = len(positions)
+
+        # mesh points and weights of each atom
+        scaled = (fractional_coordinates(cell, positions) % 1.) * self.mesh
+        floor = np.floor(scaled).astype(int)
+        indices, weights = np.zeros((natoms, 1), dtype=int), np.ones((natoms, 1))
+        for axis, size in enumerate(self.mesh):
+            axis_indices = (floor[:, axis, None] - np.arange(order)) % size
+            axis_weights = bspline_weights(scaled[:, axis] - floor[:, axis], order)
+            indices = (indices[:, :, None] * size + axis_indices[:, None, :]).reshape(natoms, -1)
+            weights = (weights[:, :, None] * axis_weights[:, None, :]).reshape(natoms, -1)
+        self.indices, self.weights = indices, weights
+
+        # Ewald kernel 4 pi / V exp(-k^2 / 4 alpha^2) / k^2 on the half mesh of the real FFT
+        volume = abs(np.linalg.det(cell))
+        recip = 2 * np.pi * np.linalg.inv(cell).T
+        freqs = [np.fft.fftfreq(size, 1. / size) for size in self.mesh[:2]] + [np.arange(self.mesh[2] // 2 + 1)]
+        grid = np.meshgrid(*freqs, indexing='ij')
+        k2 = sum(np.multiply.outer(grid[a] * grid[b], recip[a] @ recip[b]) for a in range(3) for b in range(3))
+        k2[0, 0, 0] = 1.
+        kernel = 4 * np.pi / volume * np.exp(-k2 / (4 * alpha**2)) / k2
+        kernel[0, 0, 0] = 0.
+        moduli = [bspline_moduli(size, order) for size in self.mesh]
+        kernel *= np.multiply.outer(np.multiply.outer(moduli[0], moduli[1]), moduli[2][:self.mesh[2] // 2 + 1])
+        self.kernel = kernel * np.prod(self.mesh)
+
+        # diagonal element (the same for all atoms): the full-mesh sum of the kernel without B-spline moduli
+        full = np.meshgrid(*[np.fft.fftfreq(size, 1. / size) for size in self.mesh], indexing='ij')
+        k2 = sum(np.multiply.outer(full[a] * full[b], recip[a] @ recip[b]) for a in range(3) for b in range(3))
+        k2[0, 0, 0] = np.inf
+        self.diagonal = np.sum(4 * np.pi / volume * np.exp(-k2 / (4 * alpha**2)) / k2)
+
+    def __call__(self, charges):
+        """Return the reciprocal-space potential (e/Angstrom) at each atom."""
+        mesh_charges = np.bincount(self.indices.ravel(),
+                                   weights=(self.weights * charges[:, None]).ravel(),
+                                   minlength=np.prod(self.mesh)).reshape(self.mesh)
+        potential = fft.irfftn(fft.rfftn(mesh_charges) * self.kernel, s=self.mesh)
+        return np.einsum('ij,ij->i', np.ravel(potential)[self.indices], self.weights)
+
+
+def neighbor_pairs(cell, positions, cutoff, r_min=1e-8):
+    """Return all pairs of atoms (including periodic images) closer than ``cutoff``.
+
+    Periodic images within ``cutoff`` of the cell are added explicitly and searched with a k-d tree,
+    which takes O(N log N) time for a fixed cutoff. Both orderings (i, j) and (j, i) are included.
+
+    :param r_min: pairs closer than this (i.e. an atom with itself) are skipped
+    :return: tuple (i, j, r) of index and distance arrays
+    """
+    from scipy.spatial import cKDTree
+
+    cell = np.asarray(cell, dtype=float)
+    fractional = fractional_coordinates(cell, positions) % 1.
+    padding = cutoff / ewald.plane_spacings(cell)
+    n_max = np.ceil(padding).astype(int)
+    ranges = [np.arange(-n, n + 1) for n in n_max]
+    shifts = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    images = (fractional[None, :, :] + shifts[:, None, :]).reshape(-1, 3)
+    indices = np.tile(np.arange(len(fractional)), len(shifts))
+    inside = np.all((images > -padding) & (images < 1 + padding), axis=1)
+    images, indices = images[inside], indices[inside]
+
+    pairs = cKDTree(fractional @ cell).sparse_distance_matrix(cKDTree(images @ cell), cutoff, output_type='ndarray')
+    pairs = pairs[pairs['v'] > r_min]
+    return pairs['i'], indices[pairs['j']], pairs['v']
+
+
+def short_range_matrix(cell, positions, alpha, cutoff, corrections=None):
+    """Return the real-space Ewald terms plus orbital overlap corrections as sparse matrix in eV.
+
+    :param cutoff: real-space cutoff in Angstrom
+    :param corrections: `aiida_qeq.engines.qeq.OrbitalCorrections`, or None
+    :return: `scipy.sparse.csr_matrix` of shape (N, N) (without the Ewald self-interaction term)
+    """
+    natoms = len(positions)
+    i, j, dist = neighbor_pairs(cell, positions, cutoff)
+    values = COULOMB_CONSTANT * erfc(alpha * dist) / dist
+    if corrections is not None:
+        values += corrections(i, j, dist)
+    # images of the same pair are summed up
+    return sparse.csr_matrix((values, (i, j)), shape=(natoms, natoms))
+
+
+class CoulombOperator:  # pylint: disable=too-few-public-methods
+    """
+    Periodic QEq Coulomb operator in eV (without the atomic hardness), applied matrix-free.
+
+    Equivalent to `aiida_qeq.engines.qeq.coulomb_matrix`.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            cell,
+            positions,
+            numbers,
+            radii=None,
+            cutoff=DEFAULT_CUTOFF,
+            accuracy=DEFAULT_ACCURACY,
+            order=DEFAULT_ORDER):
+        """
+        :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+        :param positions: (N, 3) array of cartesian positions (Angstrom)
+        :param numbers: (N,) array of atomic numbers
+        :param radii: orbital radii in Angstrom indexed by atomic number (defaults to the egulp radii)
+        :param cutoff: real-space cutoff in Angstrom, extended to the range of the orbital corrections if shorter
+        :param accuracy: relative accuracy of the real-space sum, determines the Ewald splitting parameter
+        :param order: order of the B-spline interpolation
+        """
+        if radii is None:
+            radii = qeq.default_radii()
+        corrections = qeq.OrbitalCorrections(numbers, radii)
+        self.cutoff = max(cutoff, corrections.extent)
+        self.alpha = np.sqrt(-np.log(accuracy)) / self.cutoff
+
+        self.short_range = short_range_matrix(cell, positions, self.alpha, self.cutoff, corrections)
+        self.reciprocal = ReciprocalOperator(cell, positions, self.alpha, order=order)
+        self.self_term = -2 * self.alpha / np.sqrt(np.pi)
+        self.diagonal = self.short_range.diagonal() + COULOMB_CONSTANT * (self.reciprocal.diagonal + self.self_term)
+
+    def __call__(self, charges):
+        """Return the Coulomb potential (eV/e) at each atom."""
+        return self.short_range @ charges + COULOMB_CONSTANT * (self.reciprocal(charges) + self.self_term * charges)
+
+
+def constrained_cg(apply, rhs, diagonal, initial, tolerance=PCG_TOLERANCE, max_iterations=PCG_MAX_ITERATIONS):  # pylint: disable=too-many-arguments,too-many-locals
+    """Minimise 1/2 q A q - rhs q subject to sum(q) = sum(initial) by preconditioned conjugate gradients.
+
+    The constant part of the residual (the Lagrange multiplier of the constraint, i.e. the electronegativity
+    of the structure) is removed in the metric of the Jacobi preconditioner, such that all search directions
+    conserve the total charge. Removing it from the residual itself, rather than only from the preconditioned
+    residual, avoids cancellation errors that otherwise stall the iterations close to convergence.
+
+    :param apply: function returning A q
+    :param rhs: (N,) array
+    :param diagonal: (N,) array with the diagonal of A
+    :param initial: (N,) array with the initial guess, fixes the total charge
+    :return: tuple (solution, number of iterations, converged)
+    """
+    inverse = 1. / diagonal
+    inverse_sum = inverse.sum()
+
+    def project(residual):
+        return residual - (inverse @ residual) / inverse_sum
+
+    charges = np.array(initial, dtype=float)
+    residual = project(rhs - apply(charges))
+    preconditioned = inverse * residual
+    direction = preconditioned.copy()
+    product = residual @ preconditioned
+    reference = np.sqrt(project(rhs) @ (inverse * project(rhs))) or 1.
+
+    for iteration in range(max_iterations):
+        if np.sqrt(product) < tolerance * reference:
+            return charges, iteration, True
+        image = apply(direction)
+        step = product / (direction @ image)
+        charges += step * direction
+        residual = project(residual - step * image)
+        preconditioned = inverse * residual
+        new_product = residual @ preconditioned
+        direction = preconditioned + new_product / product * direction
+        product = new_product
+
+    return charges, max_iterations, False
+
+
+def solve(operator, electronegativity, hardness, hydrogen_zeta=None, total_charge=0., initial_charges=None):  # pylint: disable=too-many-arguments
+    """Solve the QEq equations with a matrix-free Coulomb operator.
+
+    Parameters as for `aiida_qeq.engines.qeq.solve`, with the Coulomb matrix replaced by a `CoulombOperator`.
+    Each conjugate gradient solve is started from the charges of the previous self-consistency cycle.
+
+    :return: `aiida_qeq.engines.qeq.QeqResult`, not converged if any conjugate gradient solve did not converge
+    """
+    electronegativity = np.asarray(electronegativity, dtype=float)
+    hardness = np.asarray(hardness, dtype=float)
+    natoms = len(electronegativity)
+    state = {'converged': True}
+
+    def solve_fixed(scaling, charges):
+        diagonal = 2 * hardness * scaling
+
+        def apply(vector):
+            return operator(vector) + diagonal * vector
+
+        initial = charges + (total_charge - charges.sum()) / natoms
+        charges, _iterations, converged = constrained_cg(apply, -electronegativity, operator.diagonal + diagonal,
+                                                         initial)
+        state['converged'] &= converged
+        return charges, electronegativity @ charges + 0.5 * charges @ apply(charges)
+
+    result = qeq.self_consistent_charges(solve_fixed, natoms, hydrogen_zeta, initial_charges)
+    return result._replace(converged=result.converged and state['converged'])
+
+
+def compute_charges(cell, positions, numbers, electronegativity, hardness, radii=None, initial_charges=None):  # pylint: disable=too-many-arguments
+    """Compute QEq charges of a periodic structure without forming the Coulomb matrix.
+
+    Parameters as for `aiida_qeq.engines.qeq.compute_charges`.
+
+    :return: `aiida_qeq.engines.qeq.QeqResult`
+    """
+    numbers = np.asarray(numbers)
+    if radii is None:
+        radii = qeq.default_radii()
+    qeq.check_parameters(numbers, hardness)
+
+    operator = CoulombOperator(cell, positions, numbers, radii)
+    hydrogen_zeta = np.where(numbers == 1, qeq.slater_exponents(numbers, radii), np.nan)
+    return solve(operator,
+                 electronegativity[numbers],
+                 hardness[numbers],
+                 hydrogen_zeta=hydrogen_zeta,
+                 initial_charges=initial_charges)
+
+
+@calcfunction
+def qeq_charges_pme(structure, parameters, configure=None):
+    """Compute QEq charges in-process with the matrix-free solver, for structures too large for `qeq_charges`.
+
+    Takes the same inputs as `QeqCalculation` and returns the structure with charges as
+    ``structure_with_charges`` output.
+
+    :param structure: `CifData` of the structure
+    :param parameters: `QeqElementTable` or `SinglefileData` with electronegativity and hardness of the elements
+        (GMP.param format)
+    :param configure: `QeqParameters` (optional)
+    """
+    QeqParameters = DataFactory('qeq.qeq')  # pylint: disable=invalid-name
+    configure = (configure or QeqParameters()).get_dict()
+    qeq.check_configure(configure)
+
+    table = QeqElementTable.from_node(parameters)
+    electronegativity, hardness = table.electronegativity, table.hardness
+    cell, positions, numbers = get_arrays(structure)
+    result = compute_charges(cell, positions, numbers, electronegativity, hardness)
+    if not result.converged:
+        return CalculationFactory('qeq.qeq').exit_codes.ERROR_SCF_NOT_CONVERGED
+
+    cif = cif_node_with_charges(cell,
+                                get_symbols(numbers),
+                                fractional_coordinates(cell, positions),
+                                result.charges,
+                                method='qeq')
+    return {'structure_with_charges': cif}
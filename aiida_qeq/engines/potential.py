@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Electrostatic potential of a charged periodic structure on a regular grid, without rerunning egulp.
+
+The grid and the region of interest follow the options of `QeqParameters`: points are spaced by ``grid_spacing``
+along the lattice vectors and the potential is evaluated only in the van der Waals shell given by ``vdw_factors``
+(points at least ``vdw_factors[1]`` and at most ``vdw_factors[2]`` times the vdW radius away from the nearest atom,
+as used for fitting charges to the potential), or, if the shell is switched off, at points at least ``offset``
+Angstrom away from all atoms. All other points are nan.
+
+The periodic potential of the point charges is computed by Ewald summation:
+
+ * the real-space sum runs over the atoms within a cutoff of each point, found by a k-d tree search,
+ * the reciprocal-space sum is evaluated exactly at the grid points by FFT: the structure factor is computed once,
+   and for each Fourier index along the first lattice vector the 2D transform over the other two is stored,
+   such that any plane of the grid is a short sum over these transforms.
+
+The grid is processed in chunks of planes, which bounds the memory to the size of a chunk (plus the 2D transforms),
+and chunks can be distributed over a process pool. The potential is returned in V (eV/e).
+"""
+import numpy as np
+from scipy.special import erfc  # pylint: disable=no-name-in-module
+from aiida.engine import calcfunction
+from aiida.plugins import DataFactory
+
+from . import ewald
+from .pme import DEFAULT_ACCURACY, DEFAULT_CUTOFF
+from .utils import COULOMB_CONSTANT, fractional_coordinates
+
+# used for elements without tabulated vdW radius (Angstrom)
+DEFAULT_VDW_RADIUS = 2.0
+# approximate number of grid points per chunk of planes
+CHUNK_POINTS = 2**18
+# upper bound on the number of (point, atom) pairs of the real-space sum held in memory at once
+CHUNK_PAIRS = 2**22
+# number of chunks submitted per worker ahead of the chunk being written
+POOL_PREFETCH = 2
+
+
+def vdw_radii(numbers):
+    """Return the van der Waals radii of Alvarez (Dalton Trans. 42, 8617 (2013)) in Angstrom."""
+    from ase.data.vdw_alvarez import vdw_radii as radii
+    radii = np.asarray(radii)[np.asarray(numbers)]
+    return np.where(np.isnan(radii), DEFAULT_VDW_RADIUS, radii)
+
+
+def grid_shape(cell, spacing):
+    """Return the number of grid points along each lattice vector, such that the spacing does not exceed ``spacing``.
+
+    :param spacing: float or sequence of three floats (Angstrom)
+    """
+    lengths = np.linalg.norm(np.asarray(cell, dtype=float), axis=1)
+    return tuple(int(n) for n in np.maximum(np.ceil(lengths / np.asarray(spacing, dtype=float)), 1))
+
+
+def periodic_images(cell, positions, cutoff):
+    """Return the positions of the atoms and their periodic images within ``cutoff`` of the cell.
+
+    :return: tuple (images, indices) of the (M, 3) cartesian positions and the index of the atom of each image
+    """
+    fractional = fractional_coordinates(cell, positions) % 1.
+    padding = cutoff / ewald.plane_spacings(cell)
+    n_max = np.ceil(padding).astype(int)
+    grid = np.meshgrid(*[np.arange(-n, n + 1) for n in n_max], indexing='ij')
+    shifts = np.stack([axis.ravel() for axis in grid], axis=1)
+    images = (fractional[None, :, :] + shifts[:, None, :]).reshape(-1, 3)
+    indices = np.tile(np.arange(len(fractional)), len(shifts))
+    inside = np.all((images > -padding) & (images < 1 + padding), axis=1)
+    return images[inside] @ cell, indices[inside]
+
+
+class PotentialEvaluator:  # pylint: disable=too-many-instance-attributes
+    """
+    Ewald potential of point charges on the points of a regular grid spanning the cell (V).
+
+    ``evaluator.planes(start, stop)`` returns the potential on the planes ``start:stop`` along the first lattice
+    vector; points outside the region of interest are nan.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-locals
+            self,
+            cell,
+            positions,
+            numbers,
+            charges,
+            shape,
+            shell=None,
+            offset=0.,
+            accuracy=DEFAULT_ACCURACY,
+            cutoff=DEFAULT_CUTOFF):
+        """
+        :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+        :param positions: (N, 3) array of cartesian positions (Angstrom)
+        :param numbers: (N,) array of atomic numbers
+        :param charges: (N,) array of charges
+        :param shape: number of grid points along the three lattice vectors
+        :param shell: tuple (f_min, f_max) of multiples of the vdW radius delimiting the region of interest,
+            or None to use all points at least ``offset`` away from the atoms
+        :param offset: minimum distance of the points from the atoms (Angstrom), if ``shell`` is None
+        :param accuracy: relative accuracy of the real-space sum (sets the Ewald splitting parameter)
+        :param cutoff: real-space cutoff (Angstrom)
+        """
+        from scipy.spatial import cKDTree
+
+        self.cell = np.asarray(cell, dtype=float)
+        self.shape = tuple(shape)
+        self.charges = np.asarray(charges, dtype=float)
+        self.shell, self.offset = shell, offset
+        self.radii = vdw_radii(numbers)
+        self.cutoff = cutoff
+        self.alpha = np.sqrt(-np.log(accuracy)) / cutoff
+        k_cut = 2 * self.alpha * np.sqrt(-np.log(accuracy))
+        volume = abs(np.linalg.det(self.cell))
+
+        # atoms and images within the real-space cutoff (or the region of interest) of the cell
+        reach = max(cutoff, shell[1] * self.radii.max() if shell else offset)
+        images, self.image_indices = periodic_images(self.cell, positions, reach)
+        self.tree = cKDTree(images)
+        density = len(positions) / volume
+        self.pairs_per_point = max(1., density * 4. / 3. * np.pi * cutoff**3)
+
+        # neutralising background of a charged cell
+        self.background = -np.pi * self.charges.sum() / (volume * self.alpha**2)
+
+        # 2D transforms of the reciprocal-space coefficients for each Fourier index along the first axis
+        kvec = ewald.reciprocal_vectors(self.cell, k_cut)
+        indices = np.rint(kvec @ self.cell.T / (2 * np.pi)).astype(int) % np.array(self.shape)
+        k2 = np.einsum('ij,ij->i', kvec, kvec)
+        weight = 4 * np.pi / volume * np.exp(-0.25 * k2 / self.alpha**2) / k2
+        positions = np.asarray(positions, dtype=float)
+        coefficients = np.empty(len(kvec), dtype=complex)
+        step = max(1, ewald.CHUNK_SIZE // max(len(positions), 1))
+        for start in range(0, len(kvec), step):
+            phase = kvec[start:start + step] @ positions.T
+            # conjugate structure factor, the factor 2 accounts for -k
+            coefficients[start:start + step] = 2 * weight[start:start + step] * (np.exp(-1j * phase) @ self.charges)
+        self.frequencies = np.unique(indices[:, 0])
+        self.transforms = np.zeros((len(self.frequencies), self.shape[1], self.shape[2]), dtype=complex)
+        rows = np.searchsorted(self.frequencies, indices[:, 0])
+        np.add.at(self.transforms, (rows, indices[:, 1], indices[:, 2]), coefficients)
+        self.transforms = np.fft.ifft2(self.transforms, axes=(1, 2)) * (self.shape[1] * self.shape[2])
+
+    def points(self, start, stop):
+        """Return the cartesian positions of the grid points on the planes ``start:stop``, shape (M, 3)."""
+        grid = np.meshgrid(np.arange(start, stop) / self.shape[0],
+                           np.arange(self.shape[1]) / self.shape[1],
+                           np.arange(self.shape[2]) / self.shape[2],
+                           indexing='ij')
+        return np.stack([axis.ravel() for axis in grid], axis=1) @ self.cell
+
+    def mask(self, points):
+        """Return whether points lie in the region of interest."""
+        if self.shell is None:
+            if self.offset <= 0:
+                return np.ones(len(points), dtype=bool)
+            distances, _ = self.tree.query(points, distance_upper_bound=self.offset)
+            return np.isinf(distances)
+        f_min, f_max = self.shell
+        ratios = np.full(len(points), np.inf)
+        pairs = self._pairs(points, f_max * self.radii.max())
+        np.minimum.at(ratios, pairs['i'], pairs['v'] / self.radii[self.image_indices[pairs['j']]])
+        return (ratios >= f_min) & (ratios <= f_max)
+
+    def _pairs(self, points, radius):
+        """Return (point, image) pairs closer than ``radius`` as structured array with fields i, j, v."""
+        from scipy.spatial import cKDTree
+        return cKDTree(points).sparse_distance_matrix(self.tree, radius, output_type='ndarray')
+
+    def real_space(self, points):
+        """Return the real-space part of the Ewald potential at the given points (e/Angstrom)."""
+        potential = np.zeros(len(points))
+        step = max(1, int(CHUNK_PAIRS // self.pairs_per_point))
+        for start in range(0, len(points), step):
+            pairs_points = points[start:start + step]
+            pairs = self._pairs(pairs_points, self.cutoff)
+            dist = np.maximum(pairs['v'], 1e-8)
+            values = self.charges[self.image_indices[pairs['j']]] * erfc(self.alpha * dist) / dist
+            potential[start:start + step] = np.bincount(pairs['i'], weights=values, minlength=len(pairs_points))
+        return potential
+
+    def reciprocal_space(self, start, inside):
+        """Return the reciprocal-space part of the Ewald potential at the selected points of the planes from ``start``.
+
+        :param inside: boolean array of shape (planes, n2, n3)
+        """
+        plane, row, column = np.nonzero(inside)
+        phases = np.exp(2j * np.pi * np.outer(self.frequencies, plane + start) / self.shape[0])
+        return np.real(np.einsum('fm,fm->m', phases, self.transforms[:, row, column]))
+
+    def planes(self, start, stop):
+        """Return the potential (V) on the planes ``start:stop``, nan outside the region of interest."""
+        points = self.points(start, stop)
+        inside = self.mask(points)
+        values = np.full(len(points), np.nan)
+        selected = points[inside]
+        inside = inside.reshape(stop - start, self.shape[1], self.shape[2])
+        values[inside.ravel()] = COULOMB_CONSTANT * (self.real_space(selected) + self.reciprocal_space(start, inside) +
+                                                     self.background)
+        return values.reshape(stop - start, self.shape[1], self.shape[2])
+
+
+_EVALUATOR = None
+
+
+def _init_worker(evaluator):
+    """Store the evaluator in a worker process of the pool."""
+    global _EVALUATOR  # pylint: disable=global-statement
+    _EVALUATOR = evaluator
+
+
+def _evaluate_planes(bounds):
+    """Evaluate planes in a worker process of the pool."""
+    return _EVALUATOR.planes(*bounds)
+
+
+def iter_potential(evaluator, max_workers=None):
+    """Iterate over chunks of planes of the potential grid, in order.
+
+    :param evaluator: `PotentialEvaluator`
+    :param max_workers: number of worker processes, None or 1 to evaluate in the current process
+    :return: iterator over arrays of shape (planes, n2, n3)
+    """
+    step = max(1, CHUNK_POINTS // (evaluator.shape[1] * evaluator.shape[2]))
+    bounds = [(start, min(start + step, evaluator.shape[0])) for start in range(0, evaluator.shape[0], step)]
+    if not max_workers or max_workers == 1:
+        for start, stop in bounds:
+            yield evaluator.planes(start, stop)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    from collections import deque
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(evaluator,)) as pool:
+        # only a bounded number of chunks is computed ahead of the one being consumed
+        futures = deque()
+        for chunk in bounds:
+            futures.append(pool.submit(_evaluate_planes, chunk))
+            if len(futures) >= POOL_PREFETCH * max_workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def potential_evaluator(cell, positions, numbers, charges, configure):
+    """Return the `PotentialEvaluator` for the grid options of a configure dictionary validated by `QeqParameters`."""
+    use_vdw, f_min, f_max = configure['vdw_factors']
+    return PotentialEvaluator(cell,
+                              positions,
+                              numbers,
+                              charges,
+                              grid_shape(cell, configure['grid_spacing']),
+                              shell=(f_min, f_max) if use_vdw else None,
+                              offset=configure['offset'])
+
+
+@calcfunction
+def potential_grid(structure, configure=None, charges=None, max_workers=None):
+    """Compute the electrostatic potential of a structure with charges on a grid, in-process.
+
+    :param structure: `CifData` with charges (e.g. ``structure_with_charges`` output), or the input structure if
+        ``charges`` are given
+    :param configure: `QeqParameters` with the grid options ``grid_spacing``, ``vdw_factors`` and ``offset``
+    :param charges: `ArrayData` with array ``charges`` (e.g. ``charges`` output), optional
+    :param max_workers: `Int` number of worker processes (optional)
+    :return: ``potential`` output, `GridData` with the potential in V (nan outside the region of interest)
+    """
+    from ase.data import atomic_numbers
+    from aiida_qeq.utils.formats import charge_arrays
+
+    QeqParameters = DataFactory('qeq.qeq')  # pylint: disable=invalid-name
+    GridData = DataFactory('qeq.grid')  # pylint: disable=invalid-name
+    configure = (configure or QeqParameters()).get_dict()
+
+    cell, positions, symbols, charge_values = charge_arrays(structure, charges)
+    numbers = np.array([atomic_numbers[symbol] for symbol in symbols])
+    evaluator = potential_evaluator(cell, positions, numbers, charge_values, configure)
+    grid = GridData.from_chunks(iter_potential(evaluator, max_workers.value if max_workers is not None else None),
+                                evaluator.shape,
+                                np.zeros(3),
+                                cell / np.array(evaluator.shape)[:, None],
+                                numbers,
+                                positions,
+                                comments=['Electrostatic potential (V)', 'aiida-qeq Ewald summation'])
+    return {'potential': grid}
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+In-process QEq engine.
+
+Solves the QEq charge equilibration of Rappe and Goddard (J. Phys. Chem. 95, 3358 (1991)) along the lines of egulp:
+periodic Coulomb interactions are computed by Ewald summation and corrected at short range for the overlap of
+ns Slater orbitals, and the charge-dependent hardness of hydrogen is converged self-consistently.
+
+For the HKUST-1 test structure, charges agree with the ones computed by egulp to within 0.05 e.
+"""
+import functools
+from collections import namedtuple
+
+import numpy as np
+from aiida.engine import calcfunction
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_qeq.data import DATA_DIR
+from aiida_qeq.data.tables import QeqElementTable, read_element_table
+from aiida_qeq.utils.cif import cif_node_with_charges
+from . import ewald
+from .integrals import ORBITAL_CUTOFF, TABLE_SPACING, CoulombIntegralTables, slater_exponents
+from .utils import COULOMB_CONSTANT, fractional_coordinates, get_arrays, get_symbols
+
+DEFAULT_RADII_FILE_NAME = 'qeq_radii.dat'
+
+# Self-consistency cycle for the charge-dependent hardness of hydrogen (same defaults as egulp)
+CONVERGENCE = 1e-5
+MIXING = 0.3
+MAX_ITERATIONS = 50
+
+# configure.input options that require egulp
+UNSUPPORTED_OPTIONS = ('build_grid', 'calculate_pot_diff', 'skip_everything', 'point_charges_present', 'include_pceq')
+
+QeqResult = namedtuple('QeqResult', ['charges', 'energy', 'energies', 'converged'])
+
+
+@functools.lru_cache(maxsize=None)
+def default_radii():
+    """Return the orbital radii (Angstrom) used by egulp, indexed by atomic number."""
+    return read_element_table(str(DATA_DIR / DEFAULT_RADII_FILE_NAME))[0]
+
+
+class OrbitalCorrections:  # pylint: disable=too-few-public-methods
+    """
+    Tabulated orbital overlap corrections for all pairs of elements of a structure.
+
+    The tables of all pairs of elements are stacked into one array with a row per pair (padded with zeros),
+    such that the corrections of any set of pairs of atoms are interpolated in a single vectorised step.
+    """
+
+    def __init__(self, numbers, radii, cutoff=ORBITAL_CUTOFF, spacing=TABLE_SPACING):
+        """
+        :param numbers: (N,) array of atomic numbers
+        :param radii: orbital radii in Angstrom indexed by atomic number
+        :param cutoff: maximum range of the corrections in Angstrom
+        :param spacing: grid spacing of the tables in Angstrom
+        """
+        species, self.kinds = np.unique(numbers, return_inverse=True)
+        self.kinds = self.kinds.ravel()
+        self.num_species = len(species)
+        self.spacing = spacing
+        tables = CoulombIntegralTables(radii, spacing=spacing)
+        tables.require(species)
+
+        # the table of a pair ends at the cutoff, or where the correction has decayed
+        limit = int(np.ceil(min(cutoff, ORBITAL_CUTOFF) / spacing))
+        rows = [tables[a, b][:limit] for a in species for b in species]
+        self.lengths = np.array([len(row) for row in rows])
+        # one column of zeros beyond the longest table
+        self.table = np.zeros((len(rows), self.lengths.max() + 1))
+        for row, values in zip(self.table, rows):
+            row[:len(values)] = values
+        self.extent = self.lengths.max() * spacing
+
+    def __call__(self, i, j, dist):
+        """Return the corrections in eV for pairs of atoms (i, j) at distance ``dist`` (Angstrom)."""
+        pair = self.kinds[i] * self.num_species + self.kinds[j]
+        # grid point k lies at distance (k + 1) * spacing; closer distances take the value of the first point
+        position = np.maximum(np.asarray(dist, dtype=float) / self.spacing - 1, 0.)
+        index = np.minimum(position.astype(np.int64), self.table.shape[1] - 2)
+        weight = position - index
+        values = (1 - weight) * self.table[pair, index] + weight * self.table[pair, index + 1]
+        # zero beyond the end of the table of the pair
+        values[position > self.lengths[pair] - 1] = 0.
+        return values
+
+
+def orbital_corrections(cell, positions, numbers, radii, cutoff=ORBITAL_CUTOFF, rows=None):  # pylint: disable=too-many-arguments
+    """Return the short-range orbital overlap corrections to the Coulomb matrix in eV.
+
+    :param rows: indices of the atoms of the returned rows (defaults to all atoms)
+    """
+    natoms = len(numbers)
+    atoms = np.arange(natoms) if rows is None else np.asarray(rows)
+    corrections = OrbitalCorrections(numbers, radii, cutoff=cutoff)
+
+    flat = np.zeros(len(atoms) * natoms)
+    for i, j, dist in ewald.iter_pairs(cell, positions, corrections.extent, rows=atoms):
+        flat += np.bincount(i * natoms + j, weights=corrections(atoms[i], j, dist), minlength=len(atoms) * natoms)
+    return flat.reshape(len(atoms), natoms)
+
+
+def coulomb_matrix(cell, positions, numbers, radii=None, accuracy=ewald.DEFAULT_ACCURACY, rows=None):  # pylint: disable=too-many-arguments
+    """Return the QEq Coulomb interaction matrix in eV, without the atomic hardness on the diagonal.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param radii: orbital radii in Angstrom indexed by atomic number (defaults to the egulp radii)
+    :param rows: indices of the atoms of the returned rows (defaults to all atoms)
+    """
+    if radii is None:
+        radii = default_radii()
+    matrix = COULOMB_CONSTANT * ewald.ewald_matrix(cell, positions, accuracy=accuracy, rows=rows)
+    return matrix + orbital_corrections(cell, positions, numbers, radii, rows=rows)
+
+
+def self_consistent_charges(solve_fixed, natoms, hydrogen_zeta=None, initial_charges=None):
+    """Converge the charge-dependent hardness of hydrogen, J(q) = J (1 + q / zeta), by linear mixing.
+
+    :param solve_fixed: function solving the QEq equations for fixed hardness. Takes the (N,) array of
+        hardness scaling factors and the current charges, returns tuple (charges, energy).
+    :param natoms: number of atoms
+    :param hydrogen_zeta: (N,) array with the Slater exponents (1/Bohr) of hydrogen atoms and nan elsewhere
+    :param initial_charges: initial guess for the self-consistency cycle
+    :return: `QeqResult`
+    """
+    hydrogen = np.zeros(natoms, dtype=bool) if hydrogen_zeta is None else ~np.isnan(hydrogen_zeta)
+    charges = np.zeros(natoms) if initial_charges is None else np.asarray(initial_charges, dtype=float)
+
+    energies = []
+    for iteration in range(MAX_ITERATIONS if hydrogen.any() else 1):
+        scaling = np.ones(natoms)
+        if hydrogen.any():
+            scaling[hydrogen] += charges[hydrogen] / hydrogen_zeta[hydrogen]
+
+        new_charges, energy = solve_fixed(scaling, charges)
+        energies.append(energy)
+        if np.abs(new_charges - charges).max() < CONVERGENCE or not hydrogen.any():
+            return QeqResult(new_charges, energies[-1], energies, True)
+        if iteration == 0 and initial_charges is None:
+            charges = new_charges
+        else:
+            charges = charges + MIXING * (new_charges - charges)
+
+    return QeqResult(charges, energies[-1], energies, False)
+
+
+def solve(  # pylint: disable=too-many-arguments
+        coulomb,
+        electronegativity,
+        hardness,
+        hydrogen_zeta=None,
+        total_charge=0.,
+        initial_charges=None,
+        multiplicities=None):
+    """Solve the QEq equations for a given Coulomb matrix.
+
+    With ``multiplicities``, the unknowns are the charges of groups of equivalent atoms (e.g. symmetry orbits):
+    ``coulomb`` then holds the interaction of group a with all atoms of group b, multiplied by the size of group a
+    (a symmetric matrix), and the energy is that of all atoms.
+
+    :param coulomb: (N, N) Coulomb matrix in eV (without hardness on the diagonal)
+    :param electronegativity: (N,) array of atomic electronegativities in eV
+    :param hardness: (N,) array of atomic hardness 0.5 J in eV
+    :param hydrogen_zeta: (N,) array with the Slater exponents (1/Bohr) of hydrogen atoms and nan elsewhere.
+        If given, the hardness of hydrogen atoms is J(q) = J (1 + q / zeta) and is converged self-consistently.
+    :param total_charge: total charge of the system
+    :param initial_charges: initial guess for the self-consistency cycle
+    :param multiplicities: (N,) array with the number of atoms of each group (defaults to single atoms)
+    :return: `QeqResult`
+    """
+    electronegativity = np.asarray(electronegativity, dtype=float)
+    natoms = len(electronegativity)
+    weights = np.ones(natoms) if multiplicities is None else np.asarray(multiplicities, dtype=float)
+    # hardness and electronegativity enter once per atom of a group
+    hardness = weights * np.asarray(hardness, dtype=float)
+    electronegativity = weights * electronegativity
+    system = np.zeros((natoms + 1, natoms + 1))
+    system[:natoms, :natoms] = coulomb
+    system[:natoms, natoms] = system[natoms, :natoms] = weights
+    rhs = np.append(-electronegativity, total_charge)
+    diagonal = np.diag(coulomb) + 2 * hardness
+
+    def solve_fixed(scaling, _charges):
+        system[np.diag_indices(natoms + 1)] = np.append(diagonal + 2 * hardness * (scaling - 1), 0.)
+        charges = np.linalg.solve(system, rhs)[:natoms]
+        return charges, electronegativity @ charges + 0.5 * charges @ system[:natoms, :natoms] @ charges
+
+    return self_consistent_charges(solve_fixed, natoms, hydrogen_zeta, initial_charges)
+
+
+def check_configure(configure):
+    """Check that the configure.input options can be handled by the in-process engine.
+
+    :param configure: dictionary validated by `QeqParameters`
+    :raises ValueError: for options that require egulp
+    """
+    for option in UNSUPPORTED_OPTIONS:
+        if configure[option]:
+            raise ValueError("Option '{}' is not supported by the in-process QEq engine".format(option))
+    if configure['save_grid'][0] or configure['calculate_pot'][0]:
+        raise ValueError('Potential grids are not supported by the in-process QEq engine')
+    if configure['imethod'] != 0:
+        raise ValueError("Only 'imethod 0' (QEq) is supported by the in-process QEq engine")
+
+
+def check_parameters(numbers, hardness):
+    """Check that QEq parameters are available for all elements.
+
+    :param numbers: (N,) array of atomic numbers
+    :param hardness: hardness in eV indexed by atomic number
+    :raises ValueError: for missing elements
+    """
+    missing = [z for z in np.unique(numbers) if z >= len(hardness) or np.isnan(hardness[z])]
+    if missing:
+        raise ValueError('No QEq parameters found for atomic numbers {}'.format(missing))
+
+
+def compute_charges(cell, positions, numbers, electronegativity, hardness, radii=None, initial_charges=None):  # pylint: disable=too-many-arguments
+    """Compute QEq charges of a periodic structure.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param electronegativity: electronegativities in eV indexed by atomic number
+    :param hardness: hardness 0.5 J in eV indexed by atomic number
+    :param radii: orbital radii in Angstrom indexed by atomic number (defaults to the egulp radii)
+    :param initial_charges: initial guess for the self-consistency cycle of hydrogen
+    :return: `QeqResult`
+    """
+    numbers = np.asarray(numbers)
+    if radii is None:
+        radii = default_radii()
+    check_parameters(numbers, hardness)
+
+    coulomb = coulomb_matrix(cell, positions, numbers, radii)
+    hydrogen_zeta = np.where(numbers == 1, slater_exponents(numbers, radii), np.nan)
+    return solve(coulomb,
+                 electronegativity[numbers],
+                 hardness[numbers],
+                 hydrogen_zeta=hydrogen_zeta,
+                 initial_charges=initial_charges)
+
+
+@calcfunction
+def qeq_charges(structure, parameters, configure=None):
+    """Compute QEq charges in-process, without running egulp.
+
+    Takes the same inputs as `QeqCalculation` and returns the structure with charges as
+    ``structure_with_charges`` output.
+
+    :param structure: `CifData` of the structure
+    :param parameters: `QeqElementTable` or `SinglefileData` with electronegativity and hardness of the elements
+        (GMP.param format)
+    :param configure: `QeqParameters` (optional)
+    """
+    QeqParameters = DataFactory('qeq.qeq')  # pylint: disable=invalid-name
+    configure = (configure or QeqParameters()).get_dict()
+    check_configure(configure)
+
+    table = QeqElementTable.from_node(parameters)
+    electronegativity, hardness = table.electronegativity, table.hardness
+    cell, positions, numbers = get_arrays(structure)
+    result = compute_charges(cell, positions, numbers, electronegativity, hardness)
+    if not result.converged:
+        return CalculationFactory('qeq.qeq').exit_codes.ERROR_SCF_NOT_CONVERGED
+
+    cif = cif_node_with_charges(cell,
+                                get_symbols(numbers),
+                                fractional_coordinates(cell, positions),
+                                result.charges,
+                                method='qeq')
+    return {'structure_with_charges': cif}
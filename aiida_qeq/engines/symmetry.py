@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Symmetry-reduced in-process QEq engine.
+
+Symmetry-equivalent atoms carry the same charge. The space group of the structure is detected with spglib, and
+the QEq equations are solved for one charge per orbit of equivalent atoms: only the rows of the Coulomb matrix
+of one representative atom per orbit are computed and summed over the atoms of each orbit. The reduced system
+is smaller than the P1 system by the multiplicity of the orbits (48 for the Cu atoms of HKUST-1), and the charges
+expanded back to P1 are exactly symmetric.
+
+Requires spglib (``pip install aiida-qeq[symmetry]``).
+"""
+from collections import namedtuple
+
+import numpy as np
+from aiida.engine import calcfunction
+from aiida.orm import Dict
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_qeq.data.tables import QeqElementTable
+from aiida_qeq.utils.cif import cif_node_with_charges
+from . import qeq
+from .utils import fractional_coordinates, get_arrays, get_symbols
+
+# Distance tolerance (Angstrom) for the detection of symmetry operations; atoms of near-symmetric structures
+# displaced by less than this are treated as equivalent
+DEFAULT_SYMPREC = 1e-2
+
+SymmetryOrbits = namedtuple('SymmetryOrbits', ['representatives', 'orbits', 'multiplicities', 'space_group'])
+
+
+def symmetry_orbits(cell, positions, numbers, symprec=DEFAULT_SYMPREC):
+    """Return the orbits of symmetry-equivalent atoms of a periodic structure.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param symprec: distance tolerance in Angstrom
+    :return: `SymmetryOrbits` with the index of one representative atom per orbit, the orbit index of each atom,
+        the number of atoms per orbit and the international symbol of the space group
+    :raises ValueError: if the symmetry cannot be determined
+    """
+    import spglib
+
+    dataset = spglib.get_symmetry_dataset((cell, fractional_coordinates(cell, positions), numbers), symprec=symprec)
+    if dataset is None:
+        raise ValueError('Could not determine the symmetry of the structure: {}'.format(spglib.get_error_message()))
+    representatives, orbits, multiplicities = np.unique(dataset.equivalent_atoms,
+                                                        return_inverse=True,
+                                                        return_counts=True)
+    return SymmetryOrbits(representatives, orbits.ravel(), multiplicities, dataset.international)
+
+
+def compute_charges(cell, positions, numbers, electronegativity, hardness, radii=None, symprec=DEFAULT_SYMPREC):  # pylint: disable=too-many-arguments
+    """Compute QEq charges of a periodic structure, solving only for symmetry-unique atoms.
+
+    Takes the same arguments as `aiida_qeq.engines.qeq.compute_charges`.
+
+    :param symprec: distance tolerance in Angstrom for the detection of symmetry operations
+    :return: tuple (`QeqResult` with the charges of all atoms, `SymmetryOrbits`)
+    """
+    numbers = np.asarray(numbers)
+    if radii is None:
+        radii = qeq.default_radii()
+    qeq.check_parameters(numbers, hardness)
+
+    symmetry = symmetry_orbits(cell, positions, numbers, symprec)
+    rows = symmetry.representatives
+    # interaction of the representative of each orbit with all atoms of each orbit
+    coulomb = qeq.coulomb_matrix(cell, positions, numbers, radii, rows=rows)
+    reduced = np.zeros((len(rows), len(rows)))
+    np.add.at(reduced.T, symmetry.orbits, coulomb.T)
+    reduced *= symmetry.multiplicities[:, None]
+    reduced = 0.5 * (reduced + reduced.T)
+
+    unique_numbers = numbers[rows]
+    hydrogen_zeta = np.where(unique_numbers == 1, qeq.slater_exponents(unique_numbers, radii), np.nan)
+    result = qeq.solve(reduced,
+                       electronegativity[unique_numbers],
+                       hardness[unique_numbers],
+                       hydrogen_zeta=hydrogen_zeta,
+                       multiplicities=symmetry.multiplicities)
+    return result._replace(charges=result.charges[symmetry.orbits]), symmetry
+
+
+@calcfunction
+def qeq_charges_symmetric(structure, parameters, configure=None, symprec=None):
+    """Compute QEq charges in-process for the symmetry-unique atoms of a structure.
+
+    Takes the same inputs as `QeqCalculation` and returns the structure with charges as
+    ``structure_with_charges`` output, and the space group and number of unique atoms as ``symmetry`` output.
+
+    :param structure: `CifData` of the structure
+    :param parameters: `QeqElementTable` or `SinglefileData` with electronegativity and hardness of the elements
+        (GMP.param format)
+    :param configure: `QeqParameters` (optional)
+    :param symprec: `Float` distance tolerance in Angstrom for the detection of symmetry operations (optional)
+    """
+    QeqParameters = DataFactory('qeq.qeq')  # pylint: disable=invalid-name
+    configure = (configure or QeqParameters()).get_dict()
+    qeq.check_configure(configure)
+
+    table = QeqElementTable.from_node(parameters)
+    cell, positions, numbers = get_arrays(structure)
+    result, symmetry = compute_charges(cell,
+                                       positions,
+                                       numbers,
+                                       table.electronegativity,
+                                       table.hardness,
+                                       symprec=DEFAULT_SYMPREC if symprec is None else symprec.value)
+    if not result.converged:
+        return CalculationFactory('qeq.qeq').exit_codes.ERROR_SCF_NOT_CONVERGED
+
+    fractional = fractional_coordinates(cell, positions)
+    cif = cif_node_with_charges(cell, get_symbols(numbers), fractional, result.charges, method='qeq')
+    summary = {
+        'space_group': symmetry.space_group,
+        'num_atoms': len(numbers),
+        'num_unique_atoms': len(symmetry.representatives),
+    }
+    return {'structure_with_charges': cif, 'symmetry': Dict(dict=summary)}
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the in-process charge equilibration engines.
+"""
+import numpy as np
+
+# e^2 / (4 pi epsilon_0) in eV * Angstrom
+COULOMB_CONSTANT = 14.3996454
+# Bohr radius in Angstrom
+BOHR = 0.529177211
+# Hartree energy in eV
+HARTREE = 27.2113862
+
+
+def get_arrays(structure):
+    """Return cell, cartesian positions and atomic numbers of a structure.
+
+    :param structure: a `CifData` node or an `ase.Atoms` instance
+    :return: tuple (cell, positions, numbers) of numpy arrays, cell holds the lattice vectors as rows
+    """
+    atoms = structure.get_ase() if hasattr(structure, 'get_ase') else structure
+    return np.array(atoms.cell[:], dtype=float), np.array(atoms.positions, dtype=float), np.array(atoms.numbers)
+
+
+def get_symbols(numbers):
+    """Return chemical symbols for an array of atomic numbers."""
+    from ase.data import chemical_symbols
+    return [chemical_symbols[z] for z in numbers]
+
+
+def fractional_coordinates(cell, positions):
+    """Convert cartesian positions to fractional coordinates.
+
+    :param cell: 3x3 array with the lattice vectors as rows
+    :param positions: (N, 3) array of cartesian positions
+    """
+    return np.linalg.solve(np.asarray(cell).T, np.asarray(positions).T).T
@@ -4,11 +4,17 @@ Parsers provided by aiida_qeq.
 
 Register parsers via the "aiida.parsers" entry point in setup.json.
 """
+import os
+
 from aiida.parsers.parser import Parser
 from aiida.common import exceptions
 
 from aiida.plugins import CalculationFactory, DataFactory
 
+from aiida_qeq.utils.charges import read_charges_json, charges_array
+from aiida_qeq.utils.cif import check_charges_cif, cif_node_from_structure, structure_arrays
+from aiida_qeq.utils.metrics import instrumented
+
 EQeqCalculation = CalculationFactory('qeq.eqeq')
 SinglefileData = DataFactory('singlefile')
 
@@ -23,45 +29,170 @@ class EQeqParser(Parser):
         Initialize Parser instance
         """
         super(EQeqParser, self).__init__(node)  # pylint: disable=super-with-arguments
+        # filled while parsing and stored as ``metrics`` output, see `instrumented`
+        self.metrics = {}
         if not issubclass(node.process_class, EQeqCalculation):
             raise exceptions.ParsingError('Can only parse EQeqCalculation')
 
+    @instrumented
     def parse(self, **kwargs):  # pylint: disable=inconsistent-return-statements
         """
         Parse outputs, store results in database.
 
         :returns: an exit code, if parsing fails (or nothing if parsing succeeds)
         """
-        CifData = DataFactory('cif')  # pylint: disable=invalid-name
-
         # Check that the retrieved folder is there
         try:
             output_folder = self.retrieved
         except exceptions.NotExistent:
             return self.exit_codes.ERROR_NO_RETRIEVED_FOLDER
 
+        retrieved_temporary_folder = kwargs.pop('retrieved_temporary_folder', None)
+        if self.node.inputs.parameters.is_sweep:
+            return self._parse_sweep(retrieved_temporary_folder)
+
         # Check the folder content is as expected
-        list_of_files = output_folder.list_object_names()
         output_dict = self.node.inputs.parameters.output_files_dict(self.node.inputs.structure.filename)
+        json_file = output_dict.pop('json', None)
         output_files = list(output_dict.values())
         # Note: set(A) <= set(B) checks whether A is a subset
-        if set(output_files) <= set(list_of_files):
+        if set(output_files) <= set(output_folder.list_object_names()):
             pass
         else:
             self.logger.error('Not all expected output files {} were found'.format(output_files))
 
-        for ext in output_dict.keys():
-            fname = output_dict[ext]
+        # eqeq does not write atomic numbers, take them from the input structure
+        numbers = structure_arrays(self.node.inputs.structure)[2]
+        self.metrics['num_atoms'] = len(numbers)
+
+        charges = self._read_json(json_file, retrieved_temporary_folder)
+        if charges is not None:
+            exit_code = self._parse_charges(charges, numbers, assemble_cif='cif' not in output_dict)
+            if exit_code is not None:
+                return exit_code
+
+        for ext, fname in output_dict.items():
             if ext == 'cif':
-                # add cif file
-                with output_folder.open(fname, 'rb') as handle:
-                    cif = CifData(file=handle, parse_policy='lazy')
-                # Note: we might want to either contribute this attribute upstream
-                # or set up our own CifData class
-                cif.set_attribute('partial_charge_method', 'eqeq')
-                self.out('structure_with_charges', cif)
+                exit_code = self._parse_cif(fname, charges, numbers)
+                if exit_code is not None:
+                    return exit_code
             else:
-                # add as singlefile
+                # formats requested explicitly in `retrieve` (see `aiida_qeq.utils.formats` to write them on demand)
                 with output_folder.open(fname, 'rb') as handle:
                     node = SinglefileData(file=handle)
                 self.out('{}_with_charges'.format(ext), node)
+
+    def _parse_charges(self, charges, numbers, assemble_cif):
+        """Add the charges read from the JSON file written by eqeq.
+
+        :param numbers: atomic numbers of the input structure
+        :param assemble_cif: whether to assemble the structure with charges locally (if the CIF file is not retrieved)
+        :returns: an exit code, if the charges do not match the input structure (or None)
+        """
+        if len(charges) != len(numbers):
+            self.logger.error('Got {} charges for {} atoms'.format(len(charges), len(numbers)))
+            return self.exit_codes.ERROR_CHARGES_INCONSISTENT
+        self.out('charges', charges_array(charges, numbers, method='eqeq'))
+
+        if assemble_cif:
+            try:
+                cif = cif_node_from_structure(self.node.inputs.structure,
+                                              charges,
+                                              method='eqeq',
+                                              filename=self.node.inputs.structure.filename)
+            except ValueError as exc:
+                self.logger.error(str(exc))
+                return self.exit_codes.ERROR_CHARGES_INCONSISTENT
+            self.out('structure_with_charges', cif)
+        return None
+
+    def _parse_cif(self, fname, charges, numbers):
+        """Add the structure with charges of a retrieved CIF file written by eqeq.
+
+        :param charges: charges read from the JSON file, or None to take the charges from the CIF file
+        :param numbers: atomic numbers of the input structure
+        :returns: an exit code, if the CIF file does not match the input structure (or None)
+        """
+        CifData = DataFactory('cif')  # pylint: disable=invalid-name
+
+        try:
+            with self.retrieved.open(fname, 'r') as handle:
+                cif_charges = check_charges_cif(handle, len(numbers)).charges
+        except ValueError as exc:
+            self.logger.error(str(exc))
+            return self.exit_codes.ERROR_CHARGES_INCONSISTENT
+        if charges is None:
+            # no JSON output requested, take the charges from the CIF file
+            self.out('charges', charges_array(cif_charges, numbers, method='eqeq'))
+        # add cif file
+        with self.retrieved.open(fname, 'rb') as handle:
+            cif = CifData(file=handle, parse_policy='lazy')
+        # Note: we might want to either contribute this attribute upstream
+        # or set up our own CifData class
+        cif.set_attribute('partial_charge_method', 'eqeq')
+        self.out('structure_with_charges', cif)
+        return None
+
+    def _read_json(self, json_file, retrieved_temporary_folder):
+        """Read charges from a JSON file written by eqeq, or return None if it is not available.
+
+        The JSON file is retrieved into the temporary folder (older calculations stored it in the retrieved folder).
+        """
+        if json_file is None:
+            return None
+        if retrieved_temporary_folder and os.path.isfile(os.path.join(retrieved_temporary_folder, json_file)):
+            with open(os.path.join(retrieved_temporary_folder, json_file), 'r') as handle:
+                return read_charges_json(handle)
+        if json_file in self.retrieved.list_object_names():
+            with self.retrieved.open(json_file, 'r') as handle:
+                return read_charges_json(handle)
+        return None
+
+    def _parse_sweep(self, retrieved_temporary_folder):
+        """Parse the outputs of all (lambda, hI0) combinations of a parameter sweep.
+
+        Charges are added to the `charges_sweep` namespace and, if the CIF files are retrieved, the structures
+        with charges to the `structure_with_charges_sweep` namespace, both keyed by `sweep_key`.
+
+        :returns: an exit code, if the charges of a point do not match the input structure or no point has charges
+            (or None)
+        """
+        from aiida_qeq.data.eqeq import sweep_key
+        CifData = DataFactory('cif')  # pylint: disable=invalid-name
+
+        parameters = self.node.inputs.parameters
+        numbers = structure_arrays(self.node.inputs.structure)[2]
+        self.metrics['num_atoms'] = len(numbers)
+        missing = []
+        for point in parameters.sweep_points:
+            key = sweep_key(point)
+            output_dict = parameters.output_files_dict(self.node.inputs.structure.filename, point)
+            charges = self._read_json(output_dict.get('json'), retrieved_temporary_folder)
+            if 'cif' in output_dict:
+                try:
+                    with self.retrieved.open(output_dict['cif'], 'r') as handle:
+                        cif_charges = check_charges_cif(handle, len(numbers)).charges
+                except (IOError, OSError):
+                    missing.append(output_dict['cif'])
+                    continue
+                except ValueError as exc:
+                    self.logger.error(str(exc))
+                    return self.exit_codes.ERROR_CHARGES_INCONSISTENT
+                charges = cif_charges if charges is None else charges
+                with self.retrieved.open(output_dict['cif'], 'rb') as handle:
+                    cif = CifData(file=handle, parse_policy='lazy')
+                cif.set_attribute('partial_charge_method', 'eqeq')
+                self.out('structure_with_charges_sweep.{}'.format(key), cif)
+            if charges is None:
+                missing.append(output_dict.get('json'))
+                continue
+            if len(charges) != len(numbers):
+                self.logger.error('Got {} charges for {} atoms ({})'.format(len(charges), len(numbers), key))
+                return self.exit_codes.ERROR_CHARGES_INCONSISTENT
+            self.out('charges_sweep.{}'.format(key), charges_array(charges, numbers, method='eqeq'))
+
+        if missing:
+            self.logger.error('Not all expected output files {} were found'.format(missing))
+        if len(missing) == len(parameters.sweep_points):
+            return self.exit_codes.ERROR_MISSING_OUTPUT
+        return None
@@ -6,14 +6,93 @@ Register parsers via the "aiida.parsers" entry point in setup.json.
 """
 import os
 
+import math
+
 from aiida.parsers.parser import Parser
 from aiida.common import exceptions
+from aiida.orm import Dict
 from aiida.plugins import CalculationFactory, DataFactory
 
-from aiida_qeq.data.qeq import LOG_FILE_NAME
+from aiida_qeq.data.qeq import ENERGY_FILE_NAME, LOG_FILE_NAME
+from aiida_qeq.utils.charges import read_charges_dat, charges_array
+from aiida_qeq.utils.cif import check_charges_cif, cif_node_from_structure, structure_arrays
+from aiida_qeq.utils.metrics import instrumented
+from aiida_qeq.utils.transfer import LOG_SUMMARY_FILE_NAME, LOG_TAIL_FILE_NAME, open_retrieved, retrieved_file_names
 
 QeqCalculation = CalculationFactory('qeq.qeq')
 SinglefileData = DataFactory('singlefile')
+GridData = DataFactory('qeq.grid')
+
+CHUNK_SIZE = 2**16
+CHARGES_FILE_NAME = 'charges.dat'
+
+
+def _to_float(value):
+    """Convert string to float, using None for nan (not JSON serializable)."""
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def stream_contains(handle, text, chunk_size=CHUNK_SIZE):
+    """Check whether ``text`` occurs in a text stream.
+
+    The stream is read in chunks of ``chunk_size`` characters, stopping at the first occurrence.
+    """
+    overlap = len(text) - 1
+    tail = ''
+    for chunk in iter(lambda: handle.read(chunk_size), ''):
+        window = tail + chunk
+        if text in window:
+            return True
+        tail = window[-overlap:] if overlap else ''
+    return False
+
+
+def parse_log(handle):
+    """Parse egulp log file line by line, stopping once the SCF verdict is known.
+
+    Extracts the lattice vectors, the number of atoms, the (1-based) indices of atoms that egulp mapped into the
+    central cell and the charge difference of each SCF cycle.
+
+    :param handle: text stream of the log file
+    :return: dictionary, ``scf_converged`` is only present if egulp reported the SCF verdict
+    """
+    results = {'cell': [], 'remapped_atoms': [], 'scf_qdiff': []}
+    for line in handle:
+        if line.startswith('Cycle:'):
+            results['scf_qdiff'].append(_to_float(line.split()[3]))
+        elif line.startswith('atom ') and 'is not mapped into the central cell' in line:
+            results['remapped_atoms'].append(int(line.split()[1]))
+        elif line.startswith('Lattice vector #'):
+            results['cell'].append([float(value) for value in line.split()[3:6]])
+        elif line.startswith('Number of atoms is'):
+            results['num_atoms'] = int(line.split()[4])
+        elif line.startswith('egulp version'):
+            results['egulp_version'] = line.split()[2]
+        elif line.startswith('SCF NOT CONVERGED'):
+            results['scf_converged'] = False
+            break
+        elif line.startswith('SCF CONVERGED'):
+            results['scf_converged'] = True
+            break
+    results['num_scf_cycles'] = len(results['scf_qdiff'])
+    return results
+
+
+def parse_energy_file(handle):
+    """Parse energy.dat written by egulp.
+
+    :param handle: text stream of the energy file
+    :return: dictionary with the energy of each SCF cycle and the final energy (eV)
+    """
+    results = {'scf_energies': []}
+    for line in handle:
+        words = line.split()
+        if len(words) == 3 and words[0].isdigit():
+            results['scf_energies'].append(_to_float(words[1]))
+        elif line.startswith('FINAL CONFIGURATIONAL'):
+            results['energy'] = _to_float(words[2])
+    return results
 
 
 class QeqParser(Parser):
@@ -26,9 +105,12 @@ class QeqParser(Parser):
         Initialize Parser instance
         """
         super(QeqParser, self).__init__(node)  # pylint: disable=super-with-arguments
+        # filled while parsing and stored as ``metrics`` output, see `instrumented`
+        self.metrics = {}
         if not issubclass(node.process_class, QeqCalculation):
             raise exceptions.ParsingError('Can only parse EQeqCalculation')
 
+    @instrumented
     def parse(self, **kwargs):  # pylint: disable=inconsistent-return-statements
         """
         Parse outputs, store results in database.
@@ -41,13 +123,14 @@ class QeqParser(Parser):
         except exceptions.NotExistent:
             return self.exit_codes.ERROR_NO_RETRIEVED_FOLDER
 
-        # Check the folder content is as expected
-        list_of_files = output_folder.list_object_names()
+        # Check the folder content is as expected (large files may have been compressed on the remote)
+        list_of_files = retrieved_file_names(output_folder)
 
         if 'configure' in self.node.inputs:
-            output_files = self.node.inputs.configure.output_files
+            configure = self.node.inputs.configure
         else:
-            output_files = DataFactory('qeq.qeq')().output_files
+            configure = DataFactory('qeq.qeq')()
+        output_files = configure.output_files
 
         # Note: set(A) <= set(B) checks whether A is a subset
         if set(output_files) <= set(list_of_files):
@@ -56,33 +139,144 @@ class QeqParser(Parser):
             self.logger.error('Not all expected output files {} were found'.format(output_files))
 
         # Check code didn't segfault
+        retrieved_temporary_folder = kwargs.pop('retrieved_temporary_folder', None)
         with output_folder.open(self.node.get_option('scheduler_stderr'), 'r') as handle:
-            stderr = handle.read()
-        if 'Segmentation fault' in stderr:
-            return self.exit_codes.ERROR_SEGFAULT
+            if stream_contains(handle, 'Segmentation fault'):
+                self.report_log_tail(retrieved_temporary_folder)
+                return self.exit_codes.ERROR_SEGFAULT
 
         # Check log file for error detection
-        retrieved_temporary_folder = kwargs.pop('retrieved_temporary_folder', None)
         if retrieved_temporary_folder:
-            with open(os.path.join(retrieved_temporary_folder, LOG_FILE_NAME), 'r') as handle:
-                log = handle.read()
-            # Check that calculation converged
-            if 'SCF NOT CONVERGED' in log:
-                return self.exit_codes.ERROR_SCF_NOT_CONVERGED
+            exit_code = self._parse_log(list_of_files, retrieved_temporary_folder)
+            if exit_code is not None:
+                return exit_code
 
-        CifData = DataFactory('cif')  # pylint: disable=invalid-name
+        if CHARGES_FILE_NAME in list_of_files:
+            exit_code = self._parse_charges(assemble_cif='charges.cif' not in output_files)
+            if exit_code is not None:
+                return exit_code
+
+        exit_code = self._parse_output_files(output_files)
+        if exit_code is not None:
+            return exit_code
+
+        self._parse_grids(configure.retrieved_grid_files, list_of_files)
 
+    def _parse_log(self, list_of_files, retrieved_temporary_folder):
+        """Add the data of the log (and energy file) as ``output_parameters`` and check that the SCF converged.
+
+        :param list_of_files: names of the retrieved files (see `retrieved_file_names`)
+        :returns: an exit code, if the SCF did not converge (or None)
+        """
+        # only the summary of the log is retrieved (older calculations retrieved the full log)
+        log_path = os.path.join(retrieved_temporary_folder, LOG_SUMMARY_FILE_NAME)
+        if not os.path.isfile(log_path):
+            log_path = os.path.join(retrieved_temporary_folder, LOG_FILE_NAME)
+        with open(log_path, 'r') as handle:
+            log_data = parse_log(handle)
+        if ENERGY_FILE_NAME in list_of_files:
+            with open_retrieved(self.retrieved, ENERGY_FILE_NAME) as handle:
+                log_data.update(parse_energy_file(handle))
+        elif os.path.isfile(os.path.join(retrieved_temporary_folder, ENERGY_FILE_NAME)):
+            with open(os.path.join(retrieved_temporary_folder, ENERGY_FILE_NAME), 'r') as handle:
+                log_data.update(parse_energy_file(handle))
+        self.out('output_parameters', Dict(dict=log_data))
+
+        self.metrics['num_atoms'] = log_data.get('num_atoms')
+        if 'scf_energies' in log_data:
+            self.metrics['num_scf_iterations'] = len(log_data['scf_energies'])
+        else:
+            self.metrics['num_scf_iterations'] = log_data.get('num_scf_cycles')
+
+        # Check that calculation converged
+        if log_data.get('scf_converged') is False:
+            self.report_log_tail(retrieved_temporary_folder)
+            return self.exit_codes.ERROR_SCF_NOT_CONVERGED
+        return None
+
+    def _parse_charges(self, assemble_cif):
+        """Add the charges of charges.dat.
+
+        :param assemble_cif: whether to assemble the structure with charges locally (if charges.cif is not retrieved)
+        :returns: an exit code, if the charges do not match the input structure (or None)
+        """
+        with open_retrieved(self.retrieved, CHARGES_FILE_NAME) as handle:
+            numbers, charges = read_charges_dat(handle)
+        self.out('charges', charges_array(charges, numbers, method='qeq'))
+        if self.metrics.get('num_atoms') is None:
+            self.metrics['num_atoms'] = len(charges)
+
+        if assemble_cif:
+            try:
+                cif = cif_node_from_structure(self.node.inputs.structure, charges, method='qeq', numbers=numbers)
+            except ValueError as exc:
+                self.logger.error(str(exc))
+                return self.exit_codes.ERROR_CHARGES_INCONSISTENT
+            self.out('structure_with_charges', cif)
+        return None
+
+    def _parse_output_files(self, output_files):
+        """Add the structure with charges of charges.cif and the other output files as `SinglefileData`.
+
+        :returns: an exit code, if charges.cif does not match the input structure (or None)
+        """
         for fname in output_files:
             if fname == 'charges.cif':
-                # add cif file
-                with output_folder.open(fname, 'rb') as handle:
-                    cif = CifData(file=handle, parse_policy='lazy')
-                # Note: we might want to either contribute this attribute upstream
-                # or set up our own CifData class
-                cif.set_attribute('partial_charge_method', 'qeq')
-                self.out('structure_with_charges', cif)
-            else:
-                # add as singlefile
-                with output_folder.open(fname, 'rb') as handle:
-                    node = SinglefileData(file=handle)
-                self.out(fname, node)
+                exit_code = self._parse_cif(fname)
+                if exit_code is not None:
+                    return exit_code
+            elif fname != CHARGES_FILE_NAME:
+                # add as singlefile (a '.' in the link label would create a namespace, e.g. clashing with `charges`)
+                with open_retrieved(self.retrieved, fname, 'rb') as handle:
+                    node = SinglefileData(file=handle, filename=fname)
+                self.out(fname.replace('.', '_'), node)
+        return None
+
+    def _parse_cif(self, fname):
+        """Add the structure with charges of the retrieved charges.cif.
+
+        :returns: an exit code, if the CIF file does not match the input structure (or None)
+        """
+        CifData = DataFactory('cif')  # pylint: disable=invalid-name
+
+        if self.metrics.get('num_atoms') is None:
+            self.metrics['num_atoms'] = len(structure_arrays(self.node.inputs.structure)[2])
+        try:
+            with open_retrieved(self.retrieved, fname) as handle:
+                check_charges_cif(handle, self.metrics['num_atoms'])
+        except ValueError as exc:
+            self.logger.error(str(exc))
+            return self.exit_codes.ERROR_CHARGES_INCONSISTENT
+        # add cif file
+        with open_retrieved(self.retrieved, fname, 'rb') as handle:
+            cif = CifData(file=handle, filename=fname, parse_policy='lazy')
+        # Note: we might want to either contribute this attribute upstream
+        # or set up our own CifData class
+        cif.set_attribute('partial_charge_method', 'qeq')
+        self.out('structure_with_charges', cif)
+        return None
+
+    def _parse_grids(self, grid_files, list_of_files):
+        """Add the retrieved cube grids, decompressed and converted to binary arrays in a single pass.
+
+        :param grid_files: dictionary of grid file names by output label
+        :param list_of_files: names of the retrieved files (see `retrieved_file_names`)
+        """
+        for label, fname in grid_files.items():
+            if fname not in list_of_files:
+                self.logger.error('Grid file {} was not retrieved'.format(fname))
+                continue
+            try:
+                with open_retrieved(self.retrieved, fname) as handle:
+                    self.out(label, GridData.from_cube(handle))
+            except ValueError as exc:
+                self.logger.error('Grid file {} cannot be read: {}'.format(fname, exc))
+
+    def report_log_tail(self, retrieved_temporary_folder):
+        """Log the last lines of the egulp log, which are retrieved for error reports."""
+        if not retrieved_temporary_folder:
+            return
+        tail_path = os.path.join(retrieved_temporary_folder, LOG_TAIL_FILE_NAME)
+        if os.path.isfile(tail_path):
+            with open(tail_path, 'r') as handle:
+                self.logger.error('End of {}:\n{}'.format(LOG_FILE_NAME, handle.read()))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Parsers provided by aiida_qeq for batched QEQ calculations.
+
+Register parsers via the "aiida.parsers" entry point in setup.json.
+"""
+import os
+
+from aiida.parsers.parser import Parser
+from aiida.common import exceptions
+from aiida.orm import Dict
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_qeq.calculations.qeq_batch import EXIT_STATUS_FILE_NAME, STDERR_FILE_NAME
+from aiida_qeq.data.qeq import LOG_FILE_NAME
+from aiida_qeq.parsers.qeq import parse_log
+
+QeqBatchCalculation = CalculationFactory('qeq.qeq_batch')
+CifData = DataFactory('cif')
+
+# exit status of a process killed by SIGSEGV, as reported by the shell
+SEGFAULT_EXIT_STATUS = 139
+
+
+def _read_text(path):
+    """Return content of a text file, or None if it does not exist."""
+    try:
+        with open(path, 'r') as handle:
+            return handle.read()
+    except (IOError, OSError):
+        return None
+
+
+class QeqBatchParser(Parser):
+    """
+    Parser class for parsing output of a batched QEQ calculation.
+
+    Failures of single structures are reported in the ``failures`` output instead of failing the whole batch.
+    """
+
+    def __init__(self, node):
+        """
+        Initialize Parser instance
+        """
+        super(QeqBatchParser, self).__init__(node)  # pylint: disable=super-with-arguments
+        if not issubclass(node.process_class, QeqBatchCalculation):
+            raise exceptions.ParsingError('Can only parse QeqBatchCalculation')
+
+    @staticmethod
+    def parse_structure(key, output_folder, temporary_folder):
+        """
+        Parse outputs of the structure with input key ``key``.
+
+        :param output_folder: retrieved `FolderData` with a subfolder per structure
+        :param temporary_folder: path of the retrieved temporary folder with a subfolder per structure, or None
+        :returns: `CifData` with charges, or a label describing the failure (e.g. ERROR_SCF_NOT_CONVERGED)
+        """
+        if temporary_folder:
+            exit_status = _read_text(os.path.join(temporary_folder, key, EXIT_STATUS_FILE_NAME))
+            stderr = _read_text(os.path.join(temporary_folder, key, STDERR_FILE_NAME)) or ''
+            if (exit_status or '').strip() == str(SEGFAULT_EXIT_STATUS) or 'Segmentation fault' in stderr:
+                return 'ERROR_SEGFAULT'
+
+            log_path = os.path.join(temporary_folder, key, LOG_FILE_NAME)
+            if os.path.isfile(log_path):
+                with open(log_path, 'r') as handle:
+                    if parse_log(handle).get('scf_converged') is False:
+                        return 'ERROR_SCF_NOT_CONVERGED'
+
+        try:
+            with output_folder.open(os.path.join(key, 'charges.cif'), 'rb') as handle:
+                cif = CifData(file=handle, parse_policy='lazy')
+        except (IOError, OSError):
+            return 'ERROR_MISSING_OUTPUT'
+
+        cif.set_attribute('partial_charge_method', 'qeq')
+        return cif
+
+    def parse(self, **kwargs):
+        """
+        Parse outputs, store results in database.
+
+        :returns: an exit code, if parsing fails (or nothing if parsing succeeds)
+        """
+        try:
+            output_folder = self.retrieved
+        except exceptions.NotExistent:
+            return self.exit_codes.ERROR_NO_RETRIEVED_FOLDER
+
+        temporary_folder = kwargs.pop('retrieved_temporary_folder', None)
+
+        failures = {}
+        for key in sorted(self.node.inputs.structures.keys()):
+            result = self.parse_structure(key, output_folder, temporary_folder)
+            if isinstance(result, CifData):
+                self.out('structure_with_charges.{}'.format(key), result)
+            else:
+                self.logger.warning('Structure {}: {}'.format(key, result))
+                failures[key] = result
+
+        if failures:
+            self.out('failures', Dict(dict=failures))
+            if len(failures) == len(self.node.inputs.structures):
+                return self.exit_codes.ERROR_ALL_STRUCTURES_FAILED
+
+        return None
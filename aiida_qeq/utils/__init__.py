@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Utilities shared by the calculations, parsers and engines of aiida_qeq.
+"""
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of computed partial charges.
+
+Charged structures are stored under a key derived from
+
+ * a canonical hash of the structure (cell, wrapped fractional coordinates and atomic numbers in the order of the
+   atoms, independent of the formatting of the CIF file),
+ * the content hash of the parameter files (e.g. ``GMP.param``) and
+ * the validated options of the calculation (output selection excluded).
+
+The cache lives in a local directory, is bounded in size (least recently used entries are evicted first)
+and keeps hit/miss statistics.
+"""
+import hashlib
+import io
+import json
+import os
+import time
+
+import numpy as np
+
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 2**30  # bytes
+DEFAULT_DECIMALS = 4
+STATS_FILE_NAME = 'stats.json'
+ENTRY_EXTENSION = '.cif'
+
+# entry point name : (partial charge method, file inputs, options input)
+CACHED_CALCULATIONS = {
+    'qeq.qeq': ('qeq', ('parameters',), 'configure'),
+    'qeq.eqeq': ('eqeq', ('ionization_data', 'charge_data'), 'parameters'),
+}
+# options that only select (or compress) the retrieved files and do not change the charges
+IGNORED_OPTIONS = ('retrieve', 'compress_min_size', 'keep_grids_remote')
+
+
+def default_cache_directory():
+    """Return the default cache directory (``$XDG_CACHE_HOME/aiida-qeq``)."""
+    root = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(root, 'aiida-qeq')
+
+
+def _integers(values, decimals):
+    """Round float array to integer multiples of 10^-decimals (avoids -0.0 and float formatting issues)."""
+    return np.round(np.asarray(values, dtype=float) * 10**decimals).astype(np.int64)
+
+
+def structure_hash(cell, positions, numbers, decimals=DEFAULT_DECIMALS):
+    """Return canonical hash of a periodic structure.
+
+    The hash does not depend on translations of atoms by lattice vectors. It does depend on the order of the atoms,
+    since the charges of a cached structure are used in the order of the atoms of the structure that was computed.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param decimals: number of decimals of cell (Angstrom) and fractional coordinates taken into account
+    :return: hex digest
+    """
+    cell = np.asarray(cell, dtype=float)
+    fractional = np.linalg.solve(cell.T, np.asarray(positions, dtype=float).T).T
+    scale = 10**decimals
+    fractional = _integers(fractional, decimals) % scale
+    numbers = np.asarray(numbers, dtype=np.int64)
+
+    sha = hashlib.sha256()
+    sha.update(_integers(cell, decimals).tobytes())
+    sha.update(numbers.tobytes())
+    sha.update(np.ascontiguousarray(fractional).tobytes())
+    return sha.hexdigest()
+
+
+def file_hash(node):
+    """Return sha256 hex digest of the content of a `SinglefileData` node or of the file written by a table.
+
+    :param node: `SinglefileData` or `aiida_qeq.data.tables.ParameterTable`
+    """
+    content_hash = getattr(node, 'content_hash', None)
+    if content_hash is not None:
+        return content_hash
+    sha = hashlib.sha256()
+    with node.open(mode='rb') as handle:
+        for chunk in iter(lambda: handle.read(2**16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def options_hash(options):
+    """Return sha256 hex digest of a dictionary of validated options."""
+    options = {key: value for key, value in options.items() if key not in IGNORED_OPTIONS}
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def cache_key(entry_point, structure_digest, file_digests, options_digest):
+    """Combine hashes of calculation type, structure, parameter files and options into a cache key."""
+    content = json.dumps([CACHE_VERSION, entry_point, structure_digest, list(file_digests), options_digest])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def inputs_cache_key(process_class, inputs):
+    """Return cache key of the inputs of a `QeqCalculation` or `EQeqCalculation`.
+
+    :param process_class: calculation class
+    :param inputs: process builder or ``node.inputs`` of a calculation node
+    :return: tuple (key, method), where method is the partial charge method
+    """
+    from aiida.plugins import CalculationFactory, DataFactory
+    from ..engines.utils import get_arrays
+
+    entry_points = [name for name in CACHED_CALCULATIONS if issubclass(process_class, CalculationFactory(name))]
+    if not entry_points:
+        raise ValueError('Charge cache does not support {}'.format(process_class))
+    entry_point = entry_points[0]
+    method, file_inputs, options_input = CACHED_CALCULATIONS[entry_point]
+
+    if options_input in inputs:
+        options = getattr(inputs, options_input).get_dict()
+    else:
+        options = DataFactory(entry_point)().get_dict()
+
+    key = cache_key(entry_point, structure_hash(*get_arrays(inputs.structure)),
+                    [file_hash(getattr(inputs, name)) for name in file_inputs], options_hash(options))
+    return key, method
+
+
+class ChargeCache:
+    """
+    Local on-disk cache of charged CIF files with size-bounded LRU eviction.
+
+    Usage::
+
+        cache = ChargeCache(max_size=100 * 2**20)
+        cif = run_cached(builder, cache)
+        cache.stats
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param directory: cache directory, defaults to `default_cache_directory`
+        :param max_size: maximum total size of cached files in bytes
+        """
+        self.directory = directory or default_cache_directory()
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        """Return path of the cache entry with key ``key``."""
+        return os.path.join(self.directory, key[:2], key + ENTRY_EXTENSION)
+
+    def _entries(self):
+        """Return list of (access time in ns, size, path) of all cache entries."""
+        entries = []
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(ENTRY_EXTENSION):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def _read_counters(self):
+        """Return persisted hit/miss counters."""
+        try:
+            with open(os.path.join(self.directory, STATS_FILE_NAME), 'r') as handle:
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            return {'hits': 0, 'misses': 0}
+
+    def _count(self, name):
+        """Increment persisted counter ``name``."""
+        counters = self._read_counters()
+        counters[name] = counters.get(name, 0) + 1
+        path = os.path.join(self.directory, STATS_FILE_NAME)
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(counters, handle)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _touch(path):
+        """Mark entry as most recently used (the modification time serves as access time)."""
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def get(self, key):
+        """Return cached content of ``key`` (bytes), or None.
+
+        A hit marks the entry as most recently used.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as handle:
+                content = handle.read()
+        except (IOError, OSError):
+            self._count('misses')
+            return None
+        self._touch(path)
+        self._count('hits')
+        return content
+
+    def put(self, key, content):
+        """Store content (bytes) under ``key`` and evict least recently used entries beyond ``max_size``."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as handle:
+            handle.write(content)
+        os.replace(path + '.tmp', path)
+        self._touch(path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits into ``max_size``.
+
+        :return: number of removed entries
+        """
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for _atime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            os.remove(path)
+            size -= entry_size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """Remove all entries and reset statistics."""
+        for _atime, _size, path in self._entries():
+            os.remove(path)
+        stats_path = os.path.join(self.directory, STATS_FILE_NAME)
+        if os.path.exists(stats_path):
+            os.remove(stats_path)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    @property
+    def stats(self):
+        """Dictionary with number of hits and misses, number of entries and total size in bytes."""
+        entries = self._entries()
+        stats = self._read_counters()
+        stats['entries'] = len(entries)
+        stats['size'] = sum(entry[1] for entry in entries)
+        return stats
+
+
+def cached_charges(builder, cache):
+    """Look up the charged structure for the inputs of a process builder.
+
+    :param builder: builder of a `QeqCalculation` or `EQeqCalculation`
+    :param cache: `ChargeCache`
+    :return: unstored `CifData` with charges, or None
+    """
+    from aiida.plugins import DataFactory
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+
+    key, method = inputs_cache_key(builder.process_class, builder)
+    content = cache.get(key)
+    if content is None:
+        return None
+
+    filename = 'charges.cif' if method == 'qeq' else builder.structure.filename
+    with io.BytesIO(content) as handle:
+        cif = CifData(file=handle, filename=filename, parse_policy='lazy')
+    cif.set_attribute('partial_charge_method', method)
+    cif.set_attribute('charge_cache_key', key)
+    return cif
+
+
+def store_charges(node, cache):
+    """Add the charged structure of a finished calculation to the cache.
+
+    :param node: `CalcJobNode` of a `QeqCalculation` or `EQeqCalculation`
+    :param cache: `ChargeCache`
+    :return: True if the charges were added
+    """
+    if not node.is_finished_ok or 'structure_with_charges' not in node.outputs:
+        return False
+    key, _method = inputs_cache_key(node.process_class, node.inputs)
+    with node.outputs.structure_with_charges.open(mode='rb') as handle:
+        cache.put(key, handle.read())
+    return True
+
+
+def run_cached(builder, cache=None):
+    """Return charged structure from the cache, running the calculation only on a cache miss.
+
+    :param builder: builder of a `QeqCalculation` or `EQeqCalculation`
+    :param cache: `ChargeCache`, defaults to the cache in `default_cache_directory`
+    :return: `CifData` with charges
+    """
+    from aiida import engine
+
+    cache = cache or ChargeCache()
+    cif = cached_charges(builder, cache)
+    if cif is not None:
+        return cif
+
+    result, node = engine.run_get_node(builder)
+    if not node.is_finished_ok:
+        raise RuntimeError('Calculation<{}> failed with exit status {}'.format(node.pk, node.exit_status))
+    store_charges(node, cache)
+    return result['structure_with_charges']
+
+
+def submit_cached(builder, cache=None):
+    """Submit the calculation only on a cache miss.
+
+    Once the submitted calculation has finished, add it to the cache with `store_charges`.
+
+    :param builder: builder of a `QeqCalculation` or `EQeqCalculation`
+    :param cache: `ChargeCache`, defaults to the cache in `default_cache_directory`
+    :return: `CifData` with charges on a hit, otherwise the node of the submitted calculation
+    """
+    from aiida import engine
+
+    cache = cache or ChargeCache()
+    cif = cached_charges(builder, cache)
+    if cif is not None:
+        return cif
+    return engine.submit(builder)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-flight canonicalisation of input structures.
+
+egulp relies on ``_atom_site_charge`` being the last column of the atom loop and remaps atoms outside of the
+central cell, and crashes on CIF layouts it does not support (exit code ``ERROR_SEGFAULT``).
+`canonical_structure` rewrites any `CifData` into the minimal P1 layout of `write_cif_with_charges`, with
+fractional coordinates wrapped into [0, 1), and rejects structures that cannot be parsed or are unphysical
+before anything is submitted.
+
+The canonical structure is created by the `canonicalize` calcfunction and records the content hash of the input
+file in the ``canonical_source`` attribute; further calls for the same file content return the stored node.
+"""
+import numpy as np
+from aiida.engine import calcfunction
+from aiida.plugins import DataFactory
+
+from .cif import cif_node_with_charges
+
+# Atoms closer than this (Angstrom) are considered overlapping (e.g. unresolved disorder)
+MIN_DISTANCE = 0.5
+# Number of decimals of the fractional coordinates in the canonical CIF
+FRACTIONAL_DECIMALS = 7
+
+
+def wrap_fractional(fractional, decimals=FRACTIONAL_DECIMALS):
+    """Wrap fractional coordinates into [0, 1), such that they stay in range after rounding to ``decimals``."""
+    fractional = np.round(np.asarray(fractional, dtype=float) % 1., decimals)
+    fractional[fractional >= 1.] -= 1.
+    return fractional
+
+
+def check_structure(cell, positions, numbers, min_distance=MIN_DISTANCE):
+    """Check that a periodic structure can be handed to egulp or eqeq.
+
+    :param cell: 3x3 array with the lattice vectors as rows (Angstrom)
+    :param positions: (N, 3) array of cartesian positions (Angstrom)
+    :param numbers: (N,) array of atomic numbers
+    :param min_distance: minimum distance between atoms (including periodic images) in Angstrom
+    :raises ValueError: if the structure has no atoms, unknown elements, a degenerate cell or overlapping atoms
+    """
+    from aiida_qeq.engines.pme import neighbor_pairs
+
+    numbers = np.asarray(numbers)
+    if not len(numbers):  # pylint: disable=len-as-condition
+        raise ValueError('Structure has no atoms')
+    if np.any(numbers < 1):
+        raise ValueError('Structure contains atoms of unknown elements')
+    if not np.all(np.isfinite(positions)) or not np.all(np.isfinite(cell)):
+        raise ValueError('Structure contains non-finite coordinates')
+    if abs(np.linalg.det(cell)) < 1e-6:
+        raise ValueError('Cell of the structure is degenerate')
+
+    i, j, dist = neighbor_pairs(cell, positions, min_distance, r_min=-1.)
+    overlapping = (i != j) | (dist > 1e-8)
+    if np.any(overlapping):
+        first = np.flatnonzero(overlapping)[0]
+        raise ValueError('Atoms {} and {} are only {:.3f} Angstrom apart'.format(i[first], j[first], dist[first]))
+
+
+def structure_charges(structure, num_atoms):
+    """Return the ``_atom_site_charge`` values of a P1 `CifData`, or zeros if it has none (or they do not fit)."""
+    if '_atom_site_charge' in structure.get_content():
+        values = next(iter(structure.values.values()))
+        charges = values.get('_atom_site_charge', [])
+        if len(charges) == num_atoms:
+            try:
+                return np.array([float(str(charge).split('(')[0]) for charge in charges])
+            except ValueError:
+                pass
+    return np.zeros(num_atoms)
+
+
+@calcfunction
+def canonicalize(structure):
+    """Return the structure in the minimal P1 CIF layout read reliably by egulp and eqeq.
+
+    Charges of the input (``_atom_site_charge``) are kept, e.g. as initial guess for ``point_charges_present``.
+
+    :param structure: `CifData`
+    :raises ValueError: if the structure cannot be parsed or fails `check_structure`
+    """
+    from aiida_qeq.engines.utils import fractional_coordinates, get_arrays, get_symbols
+    from .cache import file_hash
+
+    try:
+        cell, positions, numbers = get_arrays(structure)
+    except Exception as exception:  # pylint: disable=broad-except
+        raise ValueError('Structure cannot be parsed: {}'.format(exception)) from exception
+    check_structure(cell, positions, numbers)
+
+    cif = cif_node_with_charges(cell,
+                                get_symbols(numbers),
+                                wrap_fractional(fractional_coordinates(cell, positions)),
+                                structure_charges(structure, len(numbers)),
+                                method=None,
+                                filename=structure.filename)
+    cif.set_attribute('canonical_source', file_hash(structure))
+    return cif
+
+
+def canonical_structure(structure):
+    """Return the canonical form of a structure, reusing a stored one for the same file content.
+
+    :param structure: `CifData`
+    :return: `CifData` in canonical layout (the structure itself, if it already is canonical)
+    :raises ValueError: if the structure cannot be parsed or fails `check_structure`
+    """
+    from aiida.orm import QueryBuilder
+    from .cache import file_hash
+
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    if structure.get_attribute('canonical_source', None) is not None:
+        return structure
+
+    builder = QueryBuilder()
+    builder.append(CifData, filters={'attributes.canonical_source': file_hash(structure)})
+    existing = builder.first()
+    if existing is not None:
+        return existing[0]
+    return canonicalize(structure)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized loaders for the charge files written by egulp and eqeq.
+"""
+import numpy as np
+
+
+def read_charges_dat(handle):
+    """Read the ``charges.dat`` file written by egulp.
+
+    Each line contains the (1-based) index, the atomic number and the charge of an atom.
+
+    :param handle: text stream
+    :return: tuple (numbers, charges) of (N,) arrays
+    """
+    table = np.array(handle.read().split(), dtype=float).reshape(-1, 3)
+    return table[:, 1].astype(int), table[:, 2]
+
+
+def read_charges_json(handle):
+    """Read the JSON file written by eqeq (a flat list of charges).
+
+    :param handle: text stream
+    :return: (N,) array of charges
+    """
+    return np.fromstring(handle.read().strip().strip('[]'), dtype=float, sep=',')
+
+
+def charges_array(charges, numbers, method):
+    """Create an `ArrayData` node with partial charges.
+
+    :param charges: (N,) array of charges, in the order of the atoms of the structure
+    :param numbers: (N,) array of atomic numbers, or None if not known
+    :param method: name of the partial charge method, stored as ``partial_charge_method`` attribute
+    :return: unstored `ArrayData` with arrays ``charges`` and (if known) ``atomic_numbers``
+    """
+    from aiida.orm import ArrayData
+
+    array = ArrayData()
+    array.set_array('charges', np.asarray(charges, dtype=float))
+    if numbers is not None:
+        array.set_array('atomic_numbers', np.asarray(numbers, dtype=int))
+    array.set_attribute('partial_charge_method', method)
+    return array
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal CIF reader and writer for structures with partial charges.
+
+Writes the simple P1 layout produced by egulp (``charges.cif``), with the charge as last column of the atom loop.
+`read_p1_cif` reads this layout (and the one written by eqeq) in a single pass, much faster than the
+general-purpose CIF parsers.
+"""
+import io
+from collections import namedtuple
+
+import numpy as np
+
+CIF_HEADER = """data_crystal
+
+_cell_length_a   {a:.7f}
+_cell_length_b   {b:.7f}
+_cell_length_c   {c:.7f}
+_cell_angle_alpha   {alpha:.7f}
+_cell_angle_beta   {beta:.7f}
+_cell_angle_gamma   {gamma:.7f}
+
+_symmetry_space_group_name_Hall 'P 1'
+_symmetry_space_group_name_H-M  'P 1'
+
+loop_
+_symmetry_equiv_pos_as_xyz
+ 'x,y,z'
+
+loop_
+_atom_site_label
+_atom_site_type_symbol
+_atom_site_fract_x
+_atom_site_fract_y
+_atom_site_fract_z
+_atom_site_charge
+"""
+ATOM_SITE_FORMAT = '{0:<3} {1:<3} {2:13.7f} {3:13.7f} {4:13.7f} {5:13.7f}\n'
+
+CELL_KEYS = ('_cell_length_a', '_cell_length_b', '_cell_length_c', '_cell_angle_alpha', '_cell_angle_beta',
+             '_cell_angle_gamma')
+SYMMETRY_KEYS = ('_symmetry_equiv_pos_as_xyz', '_space_group_symop_operation_xyz')
+SPACE_GROUP_KEYS = ('_symmetry_space_group_name_h-m', '_space_group_name_h-m_alt')
+FRACTIONAL_KEYS = ('_atom_site_fract_x', '_atom_site_fract_y', '_atom_site_fract_z')
+P1_OPERATIONS = ('x,y,z', '+x,+y,+z')
+
+P1Cif = namedtuple('P1Cif',
+                   ['cell_parameters', 'symbols', 'fractional', 'charges', 'symmetry_operations', 'space_group'])
+
+
+def cell_parameters(cell):
+    """Return cell lengths and angles (in degrees) of a 3x3 cell matrix (lattice vectors as rows).
+
+    :param cell: 3x3 array-like
+    :return: tuple (a, b, c, alpha, beta, gamma)
+    """
+    cell = np.asarray(cell, dtype=float)
+    lengths = np.linalg.norm(cell, axis=1)
+    angles = [
+        np.degrees(np.arccos(np.dot(cell[j], cell[k]) / (lengths[j] * lengths[k]))) for j, k in ((1, 2), (0, 2), (0, 1))
+    ]
+    return tuple(lengths) + tuple(angles)
+
+
+def cell_matrix(parameters):
+    """Return 3x3 cell matrix (lattice vectors as rows) from cell lengths and angles (in degrees).
+
+    The first lattice vector points along x, the second one lies in the xy plane (as in ase).
+
+    :param parameters: cell parameters (a, b, c, alpha, beta, gamma)
+    """
+    a, b, c = parameters[:3]
+    cos_alpha, cos_beta, cos_gamma = np.cos(np.radians(parameters[3:]))
+    sin_gamma = np.sin(np.radians(parameters[5]))
+    c_y = c * (cos_alpha - cos_beta * cos_gamma) / sin_gamma
+    return np.array([
+        [a, 0., 0.],
+        [b * cos_gamma, b * sin_gamma, 0.],
+        [c * cos_beta, c_y, np.sqrt(max(c**2 - (c * cos_beta)**2 - c_y**2, 0.))],
+    ])
+
+
+def _cif_float(value):
+    """Convert CIF number to float, dropping the standard uncertainty, e.g. ``1.234(5)``."""
+    return float(value.split('(', 1)[0])
+
+
+def read_p1_cif(handle):
+    """Read cell, atoms and charges from a CIF file with a simple atom loop in a single pass.
+
+    Supports the layout written by egulp, eqeq and `write_cif_with_charges` (one data block, one value per line
+    outside of loops, unquoted values in the atom loop). Symmetry operations are returned but not applied.
+
+    :param handle: text stream
+    :return: `P1Cif` tuple of cell parameters (a, b, c, alpha, beta, gamma), list of chemical symbols,
+        (N, 3) array of fractional coordinates, (N,) array of charges (None without ``_atom_site_charge``),
+        list of symmetry operations and Hermann-Mauguin symbol of the space group (None if not given)
+    :raises ValueError: if the cell or the atom loop is missing or incomplete
+    """
+    items = {}  # values of the data items outside of loops
+    symmetry_operations = []
+    in_loop = False
+    columns = []  # column labels of the current loop
+    in_body = False  # whether the values of the current loop have started
+    atom_columns = None
+    rows = []
+
+    for line in handle:
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        if line == 'loop_':
+            in_loop, columns, in_body = True, [], False
+        elif line[0] == '_':
+            if in_loop and not in_body:
+                columns.append(line.split()[0].lower())
+                continue
+            # a tag outside of the loop header ends the loop
+            in_loop = False
+            words = line.split(None, 1)
+            if len(words) == 2:
+                items[words[0].lower()] = words[1]
+        elif line.startswith('data_'):
+            in_loop = False
+        elif in_loop:
+            if not in_body:
+                in_body = True
+                if FRACTIONAL_KEYS[0] in columns:
+                    atom_columns = columns
+            if columns is atom_columns:
+                rows.append(line.split())
+            else:
+                symmetry_operations += _symmetry_operations(line, columns)
+
+    return _p1_cif(items, symmetry_operations, rows, atom_columns)
+
+
+def is_p1(cif):
+    """Return whether a `P1Cif` has no symmetry operations other than the identity."""
+    if cif.symmetry_operations:
+        return set(cif.symmetry_operations) <= set(P1_OPERATIONS)
+    return cif.space_group in (None, 'P1')
+
+
+def structure_arrays(structure):
+    """Return cell, cartesian positions and atomic numbers of a structure.
+
+    P1 CIF files are read with `read_p1_cif`, other structures are converted with ase
+    (see `aiida_qeq.engines.utils.get_arrays`).
+
+    :param structure: a `CifData` node or an `ase.Atoms` instance
+    :return: tuple (cell, positions, numbers) of numpy arrays, cell holds the lattice vectors as rows
+    """
+    from ase.data import atomic_numbers
+    from aiida_qeq.engines.utils import get_arrays
+
+    if hasattr(structure, 'open'):
+        try:
+            with structure.open() as handle:
+                cif = read_p1_cif(handle)
+            if is_p1(cif):
+                numbers = np.array(
+                    [atomic_numbers[symbol[:2].rstrip('0123456789+-').capitalize()] for symbol in cif.symbols])
+                cell = cell_matrix(cif.cell_parameters)
+                # ase wraps the atoms into the cell as well
+                return cell, (cif.fractional % 1.) @ cell, numbers
+        except (ValueError, KeyError):
+            pass
+    return get_arrays(structure)
+
+
+def check_charges_cif(handle, num_atoms):
+    """Check that a CIF file with charges written by egulp or eqeq is complete.
+
+    :param handle: text stream
+    :param num_atoms: expected number of atoms
+    :return: `P1Cif`
+    :raises ValueError: if the file cannot be read, the number of atoms differs or charges are missing or not finite
+    """
+    cif = read_p1_cif(handle)
+    if len(cif.symbols) != num_atoms:
+        raise ValueError('CIF with charges contains {} atoms instead of {}'.format(len(cif.symbols), num_atoms))
+    if cif.charges is None:
+        raise ValueError('CIF contains no charges')
+    if not np.all(np.isfinite(cif.charges)):
+        raise ValueError('CIF contains charges that are not finite')
+    return cif
+
+
+def _symmetry_operations(line, columns):
+    """Return the symmetry operations in a row of a loop, without quotes and spaces (empty for other loops)."""
+    import shlex
+    indices = [columns.index(key) for key in SYMMETRY_KEYS if key in columns]
+    if not indices:
+        return []
+    tokens = shlex.split(line)
+    # unquoted operations may contain spaces, e.g. x, y, z
+    return [''.join(tokens[index:index + 1 + len(tokens) - len(columns)]).replace(' ', '').lower() for index in indices]
+
+
+def _p1_cif(items, symmetry_operations, rows, columns):
+    """Return `P1Cif` from the data items, the symmetry operations and the rows and columns of the atom loop.
+
+    :raises ValueError: if the cell or the atom loop is missing or incomplete
+    """
+    missing = [key for key in CELL_KEYS if key not in items]
+    if missing:
+        raise ValueError('CIF lacks cell parameters {}'.format(missing))
+    cell = np.array([_cif_float(items[key].split()[0]) for key in CELL_KEYS])
+    space_groups = [items[key].strip('\'" ').replace(' ', '') for key in SPACE_GROUP_KEYS if key in items]
+    symbols, fractional, charges = _atom_site_arrays(rows, columns)
+    return P1Cif(cell, symbols, fractional, charges, symmetry_operations, space_groups[0] if space_groups else None)
+
+
+def _atom_site_arrays(rows, columns):
+    """Return symbols, fractional coordinates and charges (None if missing) of the rows of the atom loop.
+
+    :raises ValueError: if there are no rows or their number of values does not match the columns
+    """
+    if columns is None or not rows:
+        raise ValueError('CIF contains no atom loop with fractional coordinates')
+    if any(len(row) != len(columns) for row in rows):
+        raise ValueError('Rows of the atom loop do not match its {} columns'.format(len(columns)))
+
+    table = np.array(rows)
+    fractional = _float_columns(table, [columns.index(key) for key in FRACTIONAL_KEYS])
+    if '_atom_site_type_symbol' in columns:
+        symbols = table[:, columns.index('_atom_site_type_symbol')].tolist()
+    else:
+        symbols = [label.rstrip('0123456789') for label in table[:, columns.index('_atom_site_label')]]
+    if '_atom_site_charge' in columns:
+        charges = _float_columns(table, [columns.index('_atom_site_charge')])[:, 0]
+    else:
+        charges = None
+    return symbols, fractional, charges
+
+
+def _float_columns(table, indices):
+    """Convert columns of a table of strings to floats (values with uncertainties are converted one by one)."""
+    columns = table[:, indices]
+    try:
+        return columns.astype(float)
+    except ValueError:
+        return np.vectorize(_cif_float, otypes=[float])(columns)
+
+
+def write_cif_with_charges(cell, symbols, fractional, charges):
+    """Write a P1 CIF string with an ``_atom_site_charge`` column.
+
+    :param cell: 3x3 array-like with the lattice vectors as rows
+    :param symbols: list of chemical symbols
+    :param fractional: (N, 3) array of fractional coordinates
+    :param charges: (N,) array of partial charges
+    :return: CIF content as string
+    """
+    a, b, c, alpha, beta, gamma = cell_parameters(cell)
+    # formatting python floats row by row is several times faster than formatting numpy scalars
+    table = np.column_stack([np.asarray(fractional, dtype=float), np.asarray(charges, dtype=float)]).tolist()
+    lines = [ATOM_SITE_FORMAT.format(s, s, *row) for s, row in zip(symbols, table)]
+    return CIF_HEADER.format(a=a, b=b, c=c, alpha=alpha, beta=beta, gamma=gamma) + ''.join(lines)
+
+
+def cif_node_with_charges(cell, symbols, fractional, charges, method, filename='charges.cif'):  # pylint: disable=too-many-arguments
+    """Create a `CifData` node with partial charges.
+
+    :param method: name of the partial charge method, stored as ``partial_charge_method`` attribute (if not None)
+    :param filename: file name of the CIF inside the node repository
+    :return: unstored `CifData` node
+    """
+    from aiida.plugins import DataFactory
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+
+    content = write_cif_with_charges(cell, symbols, fractional, charges)
+    with io.BytesIO(content.encode('utf-8')) as handle:
+        cif = CifData(file=handle, filename=filename, parse_policy='lazy')
+    if method is not None:
+        cif.set_attribute('partial_charge_method', method)
+    return cif
+
+
+def cif_node_from_structure(structure, charges, method, numbers=None, filename='charges.cif'):
+    """Create a `CifData` node by attaching partial charges to the atoms of an input structure.
+
+    :param structure: `CifData` node (or `ase.Atoms`) the charges were computed for
+    :param charges: (N,) array of partial charges, in the order of the atoms of the structure
+    :param method: name of the partial charge method, stored as ``partial_charge_method`` attribute
+    :param numbers: (N,) array of atomic numbers belonging to the charges, checked against the structure if given
+    :param filename: file name of the CIF inside the node repository
+    :return: unstored `CifData` node
+    :raises ValueError: if the charges do not match the atoms of the structure
+    """
+    from aiida_qeq.engines.utils import fractional_coordinates, get_symbols
+
+    cell, positions, structure_numbers = structure_arrays(structure)
+    if len(charges) != len(structure_numbers):
+        raise ValueError('Got {} charges for {} atoms'.format(len(charges), len(structure_numbers)))
+    if numbers is not None and np.any(np.asarray(numbers) != structure_numbers):
+        raise ValueError('Atomic numbers of charges do not match the structure')
+
+    return cif_node_with_charges(cell,
+                                 get_symbols(structure_numbers),
+                                 fractional_coordinates(cell, positions),
+                                 charges,
+                                 method=method,
+                                 filename=filename)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Reader for the Gaussian cube files written by egulp (``save_grid``, ``calculate_pot``).
+
+Grids may be kept on the remote computer (``keep_grids_remote`` option of `QeqParameters`). `read_remote_cube_slab`
+then fetches only the requested planes of the grid from the ``remote_folder`` of the calculation::
+
+    header, planes = read_remote_cube_slab(calc.outputs.remote_folder, 'repeat.cube', start=10, stop=12)
+
+The data lines are assumed to follow the standard layout (a new line for every row along the third axis, at most
+``VALUES_PER_LINE`` values per line), such that the lines of a plane can be located without reading the file.
+"""
+import itertools
+import shlex
+from collections import namedtuple
+
+import numpy as np
+
+VALUES_PER_LINE = 6
+# number of data lines converted at once when streaming the values of a cube file
+CHUNK_LINES = 2**16
+
+CubeHeader = namedtuple('CubeHeader',
+                        ['comments', 'origin', 'shape', 'voxel', 'numbers', 'positions', 'num_lines', 'unit'])
+
+
+def read_cube_header(handle):
+    """Read the header of a cube file.
+
+    :param handle: text stream, positioned at the start of the file
+    :return: `CubeHeader` with comment lines, origin, grid shape, voxel vectors (rows), atomic numbers and positions
+        of the atoms (in the length unit of the file), the number of header lines and the length unit
+        ('bohr', or 'angstrom' if the number of points along the first axis is negative)
+    :raises ValueError: if the header is incomplete
+    """
+    try:
+        comments = [next(handle).rstrip('\n'), next(handle).rstrip('\n')]
+        words = next(handle).split()
+        num_atoms, origin = int(words[0]), [float(value) for value in words[1:4]]
+        shape, voxel = [], []
+        for _ in range(3):
+            words = next(handle).split()
+            shape.append(int(words[0]))
+            voxel.append([float(value) for value in words[1:4]])
+        atoms = np.array([next(handle).split()[:5] for _ in range(abs(num_atoms))], dtype=float).reshape(-1, 5)
+    except (StopIteration, ValueError, IndexError) as exc:
+        raise ValueError('Incomplete cube header') from exc
+    # a negative number of atoms indicates an additional line with orbital indices
+    num_lines = 6 + abs(num_atoms) + (1 if num_atoms < 0 else 0)
+    return CubeHeader(comments, np.array(origin), tuple(abs(n) for n in shape), np.array(voxel),
+                      atoms[:, 0].astype(int), atoms[:, 2:5], num_lines, 'angstrom' if shape[0] < 0 else 'bohr')
+
+
+def iter_cube_values(handle, chunk_lines=CHUNK_LINES):
+    """Iterate over the values of a cube file in chunks, without reading the whole file into memory.
+
+    :param handle: text stream, positioned after the header (see `read_cube_header`)
+    :param chunk_lines: number of lines per chunk
+    :return: iterator over (M,) float arrays, in the order of the file (third axis fastest)
+    """
+    for lines in iter(lambda: list(itertools.islice(handle, chunk_lines)), []):
+        yield np.fromstring(' '.join(lines), dtype=float, sep=' ')
+
+
+def plane_lines(header, start, stop):
+    """Return the range of (1-based, inclusive) line numbers holding the planes ``start:stop`` along the first axis."""
+    rows = header.shape[1] * -(-header.shape[2] // VALUES_PER_LINE)
+    return header.num_lines + start * rows + 1, header.num_lines + stop * rows
+
+
+def _remote_output(remote_folder, command):
+    """Run a shell command in the remote folder and return its standard output."""
+    with remote_folder.get_authinfo().get_transport() as transport:
+        transport.chdir(remote_folder.get_remote_path())
+        retval, stdout, stderr = transport.exec_command_wait(command)
+    if retval != 0:
+        raise IOError('Command "{}" failed on the remote: {}'.format(command, stderr))
+    return stdout
+
+
+def read_remote_cube_header(remote_folder, filename):
+    """Read the header of a cube file in a `RemoteData` folder.
+
+    The number of atoms is read first, so that only the header lines are transferred.
+    """
+    import io
+    first_lines = _remote_output(remote_folder, 'head -n 3 {}'.format(shlex.quote(filename))).splitlines()
+    try:
+        num_atoms = abs(int(first_lines[2].split()[0]))
+    except (IndexError, ValueError) as exc:
+        raise ValueError('{} is not a cube file'.format(filename)) from exc
+    content = _remote_output(remote_folder, 'head -n {} {}'.format(7 + num_atoms, shlex.quote(filename)))
+    return read_cube_header(io.StringIO(content))
+
+
+def read_remote_cube_slab(remote_folder, filename, start, stop=None):
+    """Read planes of a cube file in a `RemoteData` folder, transferring only the lines of these planes.
+
+    :param remote_folder: `RemoteData`, e.g. the ``remote_folder`` output of a `QeqCalculation`
+    :param filename: name of the cube file
+    :param start: index of the first plane along the first grid axis
+    :param stop: index after the last plane (defaults to ``start + 1``)
+    :return: tuple (`CubeHeader`, array of shape (stop - start, n2, n3))
+    :raises ValueError: if the plane indices are out of range or the file does not have the standard layout
+    """
+    header = read_remote_cube_header(remote_folder, filename)
+    stop = start + 1 if stop is None else stop
+    if not 0 <= start < stop <= header.shape[0]:
+        raise ValueError('Planes {}:{} out of range for grid of shape {}'.format(start, stop, header.shape))
+    first, last = plane_lines(header, start, stop)
+    content = _remote_output(remote_folder, "sed -n '{0},{1}p;{1}q' {2}".format(first, last, shlex.quote(filename)))
+    values = np.fromstring(content, dtype=float, sep=' ')
+    expected = (stop - start) * header.shape[1] * header.shape[2]
+    if values.size != expected:
+        raise ValueError('Read {} values instead of {}, unsupported cube layout'.format(values.size, expected))
+    return header, values.reshape(stop - start, header.shape[1], header.shape[2])
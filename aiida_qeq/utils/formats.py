@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Structure files with partial charges in other formats, written on demand from stored charges.
+
+Calculations store the charges as arrays (``charges`` output) and as CIF (``structure_with_charges``).
+Instead of retrieving and storing further formats for every calculation, write them when needed::
+
+    from aiida_qeq.utils.formats import charges_file_content
+    with open('HKUST1.pdb', 'w') as handle:
+        handle.write(charges_file_content(calc.outputs.structure_with_charges, 'pdb'))
+"""
+import numpy as np
+
+from .cif import cell_matrix, cell_parameters, read_p1_cif, structure_arrays
+
+CAR_HEADER = """!BIOSYM archive 3
+PBC=ON
+Partial charges
+!DATE
+PBC{:10.4f}{:10.4f}{:10.4f}{:10.4f}{:10.4f}{:10.4f} (P1)
+"""
+CAR_ATOM_FORMAT = '{0:<5s}{1:15.9f}{2:15.9f}{3:15.9f} XXXX 1      xx      {4:<2s}{5:7.3f}\n'
+PDB_CRYST1_FORMAT = 'CRYST1{:9.3f}{:9.3f}{:9.3f}{:7.2f}{:7.2f}{:7.2f} P 1           1\n'
+# the charge is written in the temperature factor column
+PDB_ATOM_FORMAT = 'ATOM  {0:5d} {1:<4s} MOL     1    {2:8.3f}{3:8.3f}{4:8.3f}  1.00{5:6.3f}          {6:>2s}\n'
+XYZ_HEADER = '{}\nLattice="{}" Properties=species:S:1:pos:R:3:initial_charges:R:1 pbc="T T T"\n'
+XYZ_ATOM_FORMAT = '{0:<2s} {1:15.8f} {2:15.8f} {3:15.8f} {4:12.7f}\n'
+
+
+def _element(label):
+    """Return the chemical symbol of a CIF atom label or type symbol, e.g. ``Cu1`` or ``O2-``."""
+    return label[:2].rstrip('0123456789+-').capitalize()
+
+
+def charge_arrays(structure, charges=None):
+    """Return cell, cartesian positions, chemical symbols and charges of a structure with charges.
+
+    :param structure: `CifData` with charges (e.g. ``structure_with_charges`` output), or the input structure
+        if ``charges`` are given
+    :param charges: `ArrayData` with array ``charges`` (e.g. ``charges`` output) or array of charges, in the order
+        of the atoms of ``structure``
+    :return: tuple (cell, positions, symbols, charges), cell holds the lattice vectors as rows
+    :raises ValueError: if the structure contains no charges or the number of charges does not match
+    """
+    from aiida_qeq.engines.utils import get_symbols
+
+    if charges is None:
+        with structure.open() as handle:
+            cif = read_p1_cif(handle)
+        if cif.charges is None:
+            raise ValueError('Structure contains no charges')
+        cell = cell_matrix(cif.cell_parameters)
+        return cell, cif.fractional @ cell, [_element(symbol) for symbol in cif.symbols], cif.charges
+
+    if hasattr(charges, 'get_array'):
+        charges = charges.get_array('charges')
+    cell, positions, numbers = structure_arrays(structure)
+    if len(charges) != len(numbers):
+        raise ValueError('Got {} charges for {} atoms'.format(len(charges), len(numbers)))
+    return cell, positions, get_symbols(numbers), np.asarray(charges, dtype=float)
+
+
+def _standard_orientation(cell, positions):
+    """Return cell parameters and positions rotated such that the first lattice vector points along x.
+
+    CAR and PDB files give the cell by its parameters only, which implies this orientation.
+    """
+    parameters = cell_parameters(cell)
+    fractional = np.linalg.solve(np.asarray(cell, dtype=float).T, np.asarray(positions, dtype=float).T).T
+    return parameters, fractional @ cell_matrix(parameters)
+
+
+def write_car(cell, positions, symbols, charges):
+    """Write a Materials Studio CAR string, with the first lattice vector along x."""
+    parameters, positions = _standard_orientation(cell, positions)
+    lines = [
+        CAR_ATOM_FORMAT.format('{}{}'.format(symbol, index + 1), *row, symbol, charge)
+        for index, (symbol, row, charge) in enumerate(zip(symbols, positions.tolist(), charges.tolist()))
+    ]
+    return CAR_HEADER.format(*parameters) + ''.join(lines) + 'end\nend\n'
+
+
+def write_pdb(cell, positions, symbols, charges):
+    """Write a PDB string with the charges in the temperature factor column."""
+    parameters, positions = _standard_orientation(cell, positions)
+    lines = [
+        PDB_ATOM_FORMAT.format((index + 1) % 100000, symbol, *row, charge, symbol.upper())
+        for index, (symbol, row, charge) in enumerate(zip(symbols, positions.tolist(), charges.tolist()))
+    ]
+    return PDB_CRYST1_FORMAT.format(*parameters) + ''.join(lines) + 'END\n'
+
+
+def write_xyz(cell, positions, symbols, charges):
+    """Write an extended XYZ string with the charges as ``initial_charges`` column (read by ase)."""
+    lattice = ' '.join('{:.8f}'.format(value) for value in np.asarray(cell, dtype=float).ravel())
+    header = XYZ_HEADER.format(len(symbols), lattice)
+    rows = np.asarray(positions, dtype=float).tolist()
+    lines = [
+        XYZ_ATOM_FORMAT.format(symbol, *row, charge) for symbol, row, charge in zip(symbols, rows, charges.tolist())
+    ]
+    return header + ''.join(lines)
+
+
+WRITERS = {'car': write_car, 'pdb': write_pdb, 'xyz': write_xyz}
+
+
+def charges_file_content(structure, fmt, charges=None):
+    """Write a structure with partial charges in the given file format.
+
+    :param structure: `CifData` with charges, or the input structure if ``charges`` are given
+    :param fmt: file format, one of ``WRITERS``
+    :param charges: `ArrayData` with array ``charges`` or array of charges (optional)
+    :return: file content as string
+    :raises ValueError: if the format is not supported or the structure has no (matching) charges
+    """
+    if fmt not in WRITERS:
+        raise ValueError('Unsupported format {}, choose one of {}'.format(fmt, sorted(WRITERS)))
+    return WRITERS[fmt](*charge_arrays(structure, charges))
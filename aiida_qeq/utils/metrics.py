@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and size metrics of charge calculations.
+
+The job script records the wall time of the executable in `TIMING_FILE_NAME` (see `timing_texts`), and parse methods
+decorated with `instrumented` add a ``metrics`` output `Dict` with the wall time, the parse time, the sizes of the
+retrieved files and the metrics collected by the parser in ``self.metrics``. Being attributes of a `Dict`, the metrics
+can be queried across calculations, e.g.::
+
+    qb = QueryBuilder()
+    qb.append(CalcJobNode, tag='calc')
+    qb.append(Dict, with_incoming='calc', edge_filters={'label': 'metrics'},
+              filters={'attributes.wall_seconds': {'>': 600}})
+"""
+import functools
+import io
+import os
+import time
+
+TIMING_FILE_NAME = '_timing.txt'
+# shell variable holding the start time until the executable has finished
+TIMING_START_VARIABLE = 'AIIDA_QEQ_START'
+PROFILE_NUM_LINES = 50
+
+
+def timing_texts():
+    """Return tuple (prepend_text, append_text) recording start and end time of the executable in `TIMING_FILE_NAME`.
+
+    The start time is kept in a shell variable and both times are written after the executable has finished,
+    such that the working directory of the executable only contains the inputs.
+    """
+    prepend_text = '{}=$(date +%s.%N)'.format(TIMING_START_VARIABLE)
+    append_text = '\n'.join([
+        'echo "end $(date +%s.%N)" > {}'.format(TIMING_FILE_NAME),
+        'echo "start ${}" >> {}'.format(TIMING_START_VARIABLE, TIMING_FILE_NAME),
+    ])
+    return prepend_text, append_text
+
+
+def read_timing(handle):
+    """Return wall time in seconds recorded in the timing file, or None if the executable did not finish.
+
+    :param handle: text stream
+    """
+    times = {}
+    for line in handle:
+        words = line.split()
+        if len(words) == 2:
+            try:
+                times[words[0]] = float(words[1])
+            except ValueError:
+                pass
+    if 'start' in times and 'end' in times:
+        return times['end'] - times['start']
+    return None
+
+
+def folder_sizes(folder):
+    """Return list of [file name, size in bytes] of the files in a `FolderData`.
+
+    A list is used since file names may contain dots, which are not allowed in attribute keys.
+    """
+    sizes = []
+    for name in sorted(folder.list_object_names()):
+        with folder.open(name, 'rb') as handle:
+            handle.seek(0, os.SEEK_END)
+            sizes.append([name, handle.tell()])
+    return sizes
+
+
+def instrumented(parse):
+    """Decorate the ``parse`` method of a `Parser` to add a ``metrics`` output.
+
+    The parser may add entries to ``self.metrics`` (e.g. ``num_atoms``). If the calculation option ``profile_parser``
+    is set, ``parse`` runs under cProfile and the statistics are added as ``parser_profile`` output.
+    """
+
+    @functools.wraps(parse)
+    def wrapper(self, **kwargs):
+        from aiida.common import exceptions
+        from aiida.orm import Dict, SinglefileData
+
+        self.metrics = {}
+        temporary_folder = kwargs.get('retrieved_temporary_folder', None)
+        profiler = None
+        if self.node.get_option('profile_parser'):
+            import cProfile
+            profiler = cProfile.Profile()
+
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            exit_code = parse(self, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        self.metrics['parse_seconds'] = time.perf_counter() - start
+
+        if temporary_folder and os.path.isfile(os.path.join(temporary_folder, TIMING_FILE_NAME)):
+            with open(os.path.join(temporary_folder, TIMING_FILE_NAME), 'r') as handle:
+                self.metrics['wall_seconds'] = read_timing(handle)
+        try:
+            sizes = folder_sizes(self.retrieved)
+        except exceptions.NotExistent:
+            sizes = []
+        self.metrics['retrieved_files'] = sizes
+        self.metrics['retrieved_bytes'] = sum(size for _name, size in sizes)
+        self.out('metrics', Dict(dict=self.metrics))
+
+        if profiler is not None:
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_NUM_LINES)
+            with io.BytesIO(stream.getvalue().encode('utf-8')) as handle:
+                self.out('parser_profile', SinglefileData(file=handle, filename='parser_profile.txt'))
+
+        return exit_code
+
+    return wrapper
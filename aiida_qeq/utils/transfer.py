@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Reduce the data transferred from the remote computer.
+
+The job script compresses large output files with gzip before they are retrieved (`compress_text`) and extracts
+the lines of the log file that the parser needs (`log_summary_text`), such that neither the transfer nor the file
+repository grows with the size of the cube grids or of the log. Parsers read retrieved files with `open_retrieved`,
+which decompresses ``<name>.gz`` on the fly.
+"""
+import contextlib
+import gzip
+import io
+
+COMPRESSED_SUFFIX = '.gz'
+# retrieved files larger than this (bytes) are compressed on the remote
+COMPRESS_MIN_SIZE = 2**20
+LOG_SUMMARY_FILE_NAME = '_log_summary.txt'
+LOG_TAIL_FILE_NAME = '_log_tail.txt'
+LOG_TAIL_NUM_LINES = 50
+
+
+def compress_text(file_names, min_size=COMPRESS_MIN_SIZE):
+    """Return job script lines compressing the given files in place, if they are larger than ``min_size`` bytes.
+
+    :param file_names: list of file names in the working directory
+    :param min_size: minimum size in bytes
+    """
+    names = ' '.join("'{}'".format(name) for name in file_names)
+    return '\n'.join([
+        'for name in {}; do'.format(names),
+        '  if [ -f "$name" ] && [ "$(wc -c < "$name")" -ge {} ]; then gzip -f "$name"; fi'.format(min_size),
+        'done',
+    ])
+
+
+def retrieve_names(file_names, compressed=True):
+    """Return the names to retrieve for the given files, including the names of their compressed versions.
+
+    Files that do not exist on the remote are skipped by the engine.
+    """
+    if not compressed:
+        return list(file_names)
+    return [name for file_name in file_names for name in (file_name, file_name + COMPRESSED_SUFFIX)]
+
+
+def log_summary_text(log_file_name, patterns, num_tail_lines=LOG_TAIL_NUM_LINES):
+    """Return job script lines writing the matching lines and the last lines of a log file to separate files.
+
+    :param log_file_name: name of the log file
+    :param patterns: list of extended regular expressions (grep -E) of the lines to keep
+    :param num_tail_lines: number of lines at the end of the log to keep (e.g. for error messages)
+    """
+    return '\n'.join([
+        "grep -E '{}' {} > {}".format('|'.join(patterns), log_file_name, LOG_SUMMARY_FILE_NAME),
+        'tail -n {} {} > {}'.format(num_tail_lines, log_file_name, LOG_TAIL_FILE_NAME),
+    ])
+
+
+def stored_name(folder, name):
+    """Return the name under which a file is stored in a `FolderData`, compressed or not (None if absent)."""
+    names = folder.list_object_names()
+    for candidate in (name, name + COMPRESSED_SUFFIX):
+        if candidate in names:
+            return candidate
+    return None
+
+
+def retrieved_file_names(folder):
+    """Return the names of the files in a `FolderData`, without the suffix of compressed files."""
+    return [
+        name[:-len(COMPRESSED_SUFFIX)] if name.endswith(COMPRESSED_SUFFIX) else name
+        for name in folder.list_object_names()
+    ]
+
+
+@contextlib.contextmanager
+def open_retrieved(folder, name, mode='r'):
+    """Open a retrieved file, decompressing ``<name>.gz`` on the fly if only the compressed file was retrieved.
+
+    :param folder: `FolderData`
+    :param name: name of the (uncompressed) file
+    :param mode: 'r' (text stream) or 'rb' (binary stream)
+    :raises FileNotFoundError: if neither the file nor its compressed version was retrieved
+    """
+    fname = stored_name(folder, name)
+    if fname is None:
+        raise FileNotFoundError('{} was not retrieved'.format(name))
+    if fname == name:
+        with folder.open(fname, mode) as handle:
+            yield handle
+        return
+    with folder.open(fname, 'rb') as handle:
+        with gzip.GzipFile(fileobj=handle, mode='rb') as binary:
+            if 'b' in mode:
+                yield binary
+            else:
+                with io.TextIOWrapper(binary, encoding='utf-8') as text:
+                    yield text
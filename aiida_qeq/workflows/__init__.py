@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Workflows provided by aiida_qeq.
+
+Register workflows via the "aiida.workflows" entry point in setup.json.
+"""
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Workflows provided by aiida_qeq for Qeq calculations.
+
+Register workflows via the "aiida.workflows" entry point in setup.json.
+"""
+from aiida.common import AttributeDict
+from aiida.engine import (BaseRestartWorkChain, ProcessHandlerReport, ToContext, WorkChain, calcfunction,
+                          process_handler, while_)
+from aiida.orm import ArrayData, Bool, Dict, List, to_aiida_type
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_qeq.engines.utils import get_arrays
+from aiida_qeq.utils.canonical import canonical_structure
+from aiida_qeq.utils.cif import cif_node_from_structure
+
+QeqCalculation = CalculationFactory('qeq.qeq')
+QeqParameters = DataFactory('qeq.qeq')
+CifData = DataFactory('cif')
+
+
+def charges_match(structure, charges):
+    """Return True if an `ArrayData` with charges (e.g. ``charges`` output of `QeqCalculation`) fits a structure.
+
+    :param structure: `CifData`
+    :param charges: `ArrayData` with array ``charges`` and (optionally) ``atomic_numbers``
+    """
+    numbers = get_arrays(structure)[2]
+    if len(charges.get_array('charges')) != len(numbers):
+        return False
+    if 'atomic_numbers' in charges.get_arraynames():
+        return bool((charges.get_array('atomic_numbers') == numbers).all())
+    return True
+
+
+@calcfunction
+def attach_charges(structure, charges):
+    """Return the structure with the given charges in the ``_atom_site_charge`` column.
+
+    The CIF keeps the file name of the input structure, such that it can replace the structure of a `QeqCalculation`.
+
+    :param structure: `CifData`
+    :param charges: `ArrayData` with array ``charges`` and (optionally) ``atomic_numbers``
+    """
+    numbers = charges.get_array('atomic_numbers') if 'atomic_numbers' in charges.get_arraynames() else None
+    return cif_node_from_structure(structure,
+                                   charges.get_array('charges'),
+                                   method=charges.get_attribute('partial_charge_method', 'qeq'),
+                                   numbers=numbers,
+                                   filename=structure.filename)
+
+
+@calcfunction
+def collect_values(**values):
+    """Return a `Dict` with the values of the given base type nodes (e.g. the exit status of each failed structure).
+
+    :param values: `Int`, `Float`, `Str` or `Bool` nodes, keyed by the names of the dictionary entries
+    """
+    return Dict(dict={key: node.value for key, node in values.items()})
+
+
+class QeqBaseWorkChain(BaseRestartWorkChain):
+    """
+    Workchain running a `QeqCalculation`, restarting it if the SCF does not converge.
+
+    With ``canonicalize_structure``, the structure is first rewritten into the minimal P1 layout parsed reliably by
+    egulp (see `aiida_qeq.utils.canonical`); structures that fail this check are rejected without submission.
+    If ``initial_charges`` are given (e.g. the ``charges`` output of a calculation on a similar structure),
+    they are written into the input CIF and passed to egulp with ``point_charges_present`` as initial guess.
+    If the SCF does not converge, the calculation is restarted with the next ``imethod`` of ``imethods``.
+    """
+
+    _process_class = QeqCalculation
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.expose_inputs(QeqCalculation, namespace='qeq')
+        spec.input('initial_charges',
+                   valid_type=ArrayData,
+                   required=False,
+                   help='Charges used as initial guess, e.g. the `charges` output of a calculation on a similar '
+                   'structure. Ignored if they do not match the atoms of the structure.')
+        spec.input('imethods',
+                   valid_type=List,
+                   required=False,
+                   help='Values of `imethod` tried in turn if the SCF does not converge.')
+        spec.input('canonicalize_structure',
+                   valid_type=Bool,
+                   default=lambda: Bool(False),
+                   help='Rewrite the structure into canonical P1 layout (and check it) before submission.')
+
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_process)(
+                cls.run_process,
+                cls.inspect_process,
+            ),
+            cls.results,
+        )
+
+        spec.expose_outputs(QeqCalculation)
+
+        spec.exit_code(801, 'ERROR_SCF_NOT_CONVERGED', 'SCF did not converge for any of the methods tried.')
+        spec.exit_code(802, 'ERROR_INVALID_STRUCTURE', 'The structure could not be canonicalized.')
+
+    def setup(self):
+        """Set up the context: inputs of the first calculation and the methods left to try."""
+        super().setup()
+        self.ctx.inputs = AttributeDict(self.exposed_inputs(QeqCalculation, 'qeq'))
+        self.ctx.imethods = self.inputs.imethods.get_list() if 'imethods' in self.inputs else []
+
+        if self.inputs.canonicalize_structure:
+            try:
+                self.ctx.inputs.structure = canonical_structure(self.ctx.inputs.structure)
+            except ValueError as exception:
+                self.report('rejecting structure: {}'.format(exception))
+                return self.exit_codes.ERROR_INVALID_STRUCTURE  # pylint: disable=no-member
+
+        if 'initial_charges' in self.inputs:
+            if charges_match(self.ctx.inputs.structure, self.inputs.initial_charges):
+                self.ctx.inputs.structure = attach_charges(self.ctx.inputs.structure, self.inputs.initial_charges)
+                self.update_configure(point_charges_present=True)
+            else:
+                self.report('initial charges do not match the structure: starting from scratch')
+        return None
+
+    def update_configure(self, **kwargs):
+        """Replace the ``configure`` input of the next calculation by one with updated options."""
+        configure = self.ctx.inputs.configure.get_dict() if 'configure' in self.ctx.inputs else {}
+        configure.update(kwargs)
+        self.ctx.inputs.configure = QeqParameters(dict=configure)
+
+    @process_handler(
+        priority=500,
+        exit_codes=QeqCalculation.exit_codes.ERROR_SCF_NOT_CONVERGED,  # pylint: disable=no-member
+    )
+    def handle_scf_not_converged(self, node):
+        """Restart with the next ``imethod``, or abort if all of them have been tried."""
+        if not self.ctx.imethods:
+            self.report('SCF of {}<{}> did not converge and no other imethod is left to try'.format(
+                self.ctx.process_name, node.pk))
+            return ProcessHandlerReport(True, self.exit_codes.ERROR_SCF_NOT_CONVERGED)  # pylint: disable=no-member
+
+        imethod = self.ctx.imethods.pop(0)
+        self.report('SCF of {}<{}> did not converge: restarting with imethod {}'.format(
+            self.ctx.process_name, node.pk, imethod))
+        self.update_configure(imethod=imethod)
+        return ProcessHandlerReport(True)
+
+
+class QeqSeriesWorkChain(WorkChain):
+    """
+    Workchain computing Qeq charges of a series of related structures (e.g. frames of a trajectory).
+
+    Structures are run one after the other in the order of their input keys (e.g. ``frame_000``, ``frame_001``, ...),
+    each starting from the charges of the last structure that converged.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.expose_inputs(QeqBaseWorkChain, namespace='base', exclude=('qeq.structure', 'initial_charges'))
+        spec.input('initial_charges',
+                   valid_type=ArrayData,
+                   required=False,
+                   help='Charges used as initial guess for the first structure.')
+        spec.input_namespace('structures',
+                             valid_type=CifData,
+                             dynamic=True,
+                             help='Structures of the series, run in the order of their keys.')
+
+        spec.outline(
+            cls.setup,
+            while_(cls.has_next)(
+                cls.run_next,
+                cls.inspect_next,
+            ),
+            cls.results,
+        )
+
+        spec.output_namespace('structure_with_charges',
+                              valid_type=CifData,
+                              dynamic=True,
+                              help='Structures with charges, one per input structure that succeeded.')
+        spec.output_namespace('charges', valid_type=ArrayData, dynamic=True, help='Charges of each structure.')
+        spec.output('failures',
+                    valid_type=Dict,
+                    required=False,
+                    help='Exit status (or process state, if excepted or killed) of each structure that failed.')
+
+        spec.exit_code(810, 'ERROR_ALL_STRUCTURES_FAILED', 'Qeq failed for all structures of the series.')
+
+    def setup(self):
+        """Set up the queue of structures."""
+        self.ctx.keys = sorted(self.inputs.structures.keys())
+        self.ctx.index = 0
+        self.ctx.charges = self.inputs.get('initial_charges')
+        self.ctx.failures = {}
+
+    def has_next(self):
+        """Return whether there are structures left to run."""
+        return self.ctx.index < len(self.ctx.keys)
+
+    def run_next(self):
+        """Run the next structure, starting from the charges of the previous one."""
+        key = self.ctx.keys[self.ctx.index]
+        inputs = AttributeDict(self.exposed_inputs(QeqBaseWorkChain, 'base'))
+        inputs.qeq = AttributeDict(inputs.qeq)
+        inputs.qeq.structure = self.inputs.structures[key]
+        if self.ctx.charges is not None:
+            inputs.initial_charges = self.ctx.charges
+        inputs.setdefault('metadata', {})['call_link_label'] = key
+
+        node = self.submit(QeqBaseWorkChain, **inputs)
+        self.report('launching QeqBaseWorkChain<{}> for structure {}'.format(node.pk, key))
+        return ToContext(workchain=node)
+
+    def inspect_next(self):
+        """Collect the outputs of the last structure and keep its charges as initial guess of the next one."""
+        key = self.ctx.keys[self.ctx.index]
+        node = self.ctx.workchain
+        self.ctx.index += 1
+
+        if not node.is_finished_ok:
+            self.report('structure {} failed with exit status {}'.format(key, node.exit_status))
+            # excepted and killed processes have no exit status
+            self.ctx.failures[key] = node.exit_status if node.is_finished else node.process_state.value
+            return
+
+        if 'charges' in node.outputs:
+            self.ctx.charges = node.outputs.charges
+            self.out('charges.{}'.format(key), node.outputs.charges)
+        if 'structure_with_charges' in node.outputs:
+            self.out('structure_with_charges.{}'.format(key), node.outputs.structure_with_charges)
+
+    def results(self):
+        """Report the structures that failed."""
+        if self.ctx.failures:
+            failures = {key: to_aiida_type(status) for key, status in self.ctx.failures.items()}
+            self.out('failures', collect_values(**failures))
+            if len(self.ctx.failures) == len(self.ctx.keys):
+                return self.exit_codes.ERROR_ALL_STRUCTURES_FAILED  # pylint: disable=no-member
+        return None
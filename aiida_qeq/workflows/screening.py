@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Workflow computing Qeq charges for all structures of a group, with a bounded number of calculations in flight.
+
+Register workflows via the "aiida.workflows" entry point in setup.json.
+"""
+from aiida.common import AttributeDict
+from aiida.engine import ToContext, WorkChain, while_
+from aiida.orm import Dict, Group, Int, ProcessNode, QueryBuilder, Str, load_group, load_node, to_aiida_type
+from aiida.plugins import DataFactory
+
+from aiida_qeq.utils.cache import file_hash, options_hash
+from .qeq import QeqBaseWorkChain, collect_values
+
+QeqParameters = DataFactory('qeq.qeq')
+CifData = DataFactory('cif')
+
+# process type : (structure, parameters, configure) input link labels
+# (workchains first, such that a running `QeqBaseWorkChain` is awaited rather than the calculation it launched)
+CHARGE_PROCESSES = {
+    'aiida.workflows:qeq.qeq_base': ('qeq__structure', 'qeq__parameters', 'qeq__configure'),
+    'aiida.calculations:qeq.qeq': ('structure', 'parameters', 'configure'),
+}
+ACTIVE_PROCESS_STATES = ('created', 'waiting', 'running')
+# number of structures per query (keeps the size of IN clauses bounded)
+QUERY_CHUNK_SIZE = 1000
+DEFAULT_MAX_CONCURRENT = 50
+
+
+def _incoming(node, link_label):
+    """Return the input node of ``node`` with the given link label, or None."""
+    links = node.get_incoming(link_label_filter=link_label).all()
+    return links[0].node if links else None
+
+
+def charge_fingerprint(parameters, configure=None):
+    """Return a string identifying the charges computed with the given parameter file and configure options.
+
+    Parameter files are compared by content, configure options by value (output selection excluded).
+
+    :param parameters: `SinglefileData` or `QeqElementTable`
+    :param configure: `QeqParameters` (optional, defaults are used if omitted)
+    """
+    configure = (configure or QeqParameters()).get_dict()
+    return '{}:{}'.format(file_hash(parameters), options_hash(configure))
+
+
+def find_charge_processes(structure_pks, fingerprint, active=False):
+    """Find Qeq processes on the given structures with the given fingerprint.
+
+    Both `QeqCalculation` and `QeqBaseWorkChain` processes are considered.
+
+    :param structure_pks: list of pks of `CifData` nodes
+    :param fingerprint: string returned by `charge_fingerprint`
+    :param active: if True, return processes that have not terminated yet, otherwise processes that finished
+        successfully with a ``structure_with_charges`` output
+    :return: dictionary mapping structure pks to process nodes
+    """
+    found = {}
+    fingerprints = {}
+    for start in range(0, len(structure_pks), QUERY_CHUNK_SIZE):
+        for process_type, (structure_label, parameters_label, configure_label) in CHARGE_PROCESSES.items():
+            if active:
+                filters = {'process_type': process_type, 'attributes.process_state': {'in': ACTIVE_PROCESS_STATES}}
+            else:
+                filters = {'process_type': process_type, 'attributes.exit_status': 0}
+            builder = QueryBuilder()
+            builder.append(CifData,
+                           filters={'id': {
+                               'in': structure_pks[start:start + QUERY_CHUNK_SIZE]
+                           }},
+                           tag='structure',
+                           project='id')
+            builder.append(ProcessNode,
+                           with_incoming='structure',
+                           edge_filters={'label': structure_label},
+                           filters=filters,
+                           tag='process',
+                           project='*')
+            if not active:
+                builder.append(CifData, with_incoming='process', edge_filters={'label': 'structure_with_charges'})
+
+            for structure_pk, process in builder.iterall():
+                if structure_pk in found:
+                    continue
+                if process.pk not in fingerprints:
+                    fingerprints[process.pk] = charge_fingerprint(_incoming(process, parameters_label),
+                                                                  _incoming(process, configure_label))
+                if fingerprints[process.pk] == fingerprint:
+                    found[structure_pk] = process
+    return found
+
+
+class QeqScreeningWorkChain(WorkChain):
+    """
+    Workchain computing Qeq charges for all `CifData` nodes of a group.
+
+    At most ``max_concurrent`` `QeqBaseWorkChain` processes run at the same time. Each iteration of the loop awaits
+    the oldest process in flight, then collects every process that has terminated in the meantime and submits new
+    ones in their place, such that slots are refilled without waiting for a whole batch of processes to finish.
+    Structures for which a Qeq calculation with the same parameters already succeeded are skipped, and processes that
+    are still running for them (e.g. launched by an interrupted screening) are awaited instead of being launched
+    again. Running the workchain again on the same group thus resumes the screening.
+
+    The charged structures are added to the result group; the extra ``source_structure`` holds the uuid of the
+    original structure.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.expose_inputs(QeqBaseWorkChain, namespace='base', exclude=('qeq.structure', 'initial_charges'))
+        spec.input('structure_group', valid_type=Str, help='Label of the group of `CifData` nodes to compute.')
+        spec.input('result_group',
+                   valid_type=Str,
+                   required=False,
+                   help='Label of the group to add the structures with charges to (created if needed). '
+                   'Defaults to "<structure_group>/qeq".')
+        spec.input('max_concurrent',
+                   valid_type=Int,
+                   default=lambda: Int(DEFAULT_MAX_CONCURRENT),
+                   help='Maximum number of Qeq processes running at the same time.')
+
+        spec.outline(
+            cls.setup,
+            while_(cls.has_pending)(
+                cls.submit_processes,
+                cls.inspect_processes,
+            ),
+            cls.results,
+        )
+
+        spec.output('summary',
+                    valid_type=Dict,
+                    help='Label of the result group and number of structures, skipped, succeeded and failed.')
+        spec.output('failures',
+                    valid_type=Dict,
+                    required=False,
+                    help='Exit status (or process state, if excepted or killed) of each structure that failed, '
+                    'keyed by "structure_<pk>".')
+
+        spec.exit_code(810, 'ERROR_ALL_STRUCTURES_FAILED', 'Qeq failed for all structures that were computed.')
+
+    def setup(self):
+        """Find structures that are done or in progress, and queue the remaining ones."""
+        label = self.inputs.structure_group.value
+        group = load_group(label=label)
+        result_label = self.inputs.result_group.value if 'result_group' in self.inputs else '{}/qeq'.format(label)
+        result_group, _ = Group.objects.get_or_create(label=result_label)
+        self.ctx.result_group = result_group.pk
+        self.ctx.result_label = result_label
+
+        builder = QueryBuilder()
+        builder.append(Group, filters={'id': group.pk}, tag='group')
+        builder.append(CifData, with_group='group', project='id')
+        structure_pks = sorted(pk for pk, in builder.iterall())
+
+        inputs = self.exposed_inputs(QeqBaseWorkChain, 'base')
+        self.ctx.fingerprint = charge_fingerprint(inputs['qeq']['parameters'], inputs['qeq'].get('configure'))
+
+        done = find_charge_processes(structure_pks, self.ctx.fingerprint)
+        for structure_pk, process in done.items():
+            self.add_result(structure_pk, process)
+        remaining = [pk for pk in structure_pks if pk not in done]
+        running = find_charge_processes(remaining, self.ctx.fingerprint, active=True)
+
+        self.ctx.adopted = [process.pk for process in running.values()]
+        self.ctx.pending = [pk for pk in remaining if pk not in running]
+        # pks of the processes awaited or launched by this workchain that have not been inspected yet
+        self.ctx.in_flight = []
+        self.ctx.summary = {
+            'num_structures': len(structure_pks),
+            'num_skipped': len(done),
+            'num_succeeded': 0,
+            'num_failed': 0,
+        }
+        self.ctx.failures = {}
+        self.report('{} structures in group {}: {} done, {} running, {} to compute'.format(
+            len(structure_pks), label, len(done), len(running), len(self.ctx.pending)))
+
+    def add_result(self, structure_pk, process):
+        """Add the charged structure of a successful process to the result group."""
+        cif = process.outputs.structure_with_charges
+        cif.set_extra('source_structure', load_node(structure_pk).uuid)
+        load_group(pk=self.ctx.result_group).add_nodes(cif)
+
+    def has_pending(self):
+        """Return whether there are structures left to compute or processes left to await."""
+        return bool(self.ctx.pending or self.ctx.adopted or self.ctx.in_flight)
+
+    def submit_processes(self):
+        """Await running processes and submit new ones until ``max_concurrent`` are in flight.
+
+        The oldest process in flight is awaited, the others are inspected whenever the workchain is woken up.
+        """
+        max_concurrent = self.inputs.max_concurrent.value
+        num_submitted = 0
+        while self.ctx.adopted and len(self.ctx.in_flight) < max_concurrent:
+            self.ctx.in_flight.append(self.ctx.adopted.pop(0))
+        while self.ctx.pending and len(self.ctx.in_flight) < max_concurrent:
+            structure_pk = self.ctx.pending.pop(0)
+            inputs = AttributeDict(self.exposed_inputs(QeqBaseWorkChain, 'base'))
+            inputs.qeq = AttributeDict(inputs.qeq)
+            inputs.qeq.structure = load_node(structure_pk)
+            inputs.setdefault('metadata', {})['call_link_label'] = 'structure_{}'.format(structure_pk)
+            node = self.submit(QeqBaseWorkChain, **inputs)
+            self.ctx.in_flight.append(node.pk)
+            num_submitted += 1
+        if num_submitted:
+            self.report('launched {} processes, {} in flight, {} structures left'.format(
+                num_submitted, len(self.ctx.in_flight), len(self.ctx.pending)))
+        return ToContext(oldest=load_node(self.ctx.in_flight[0]))
+
+    def inspect_processes(self):
+        """Add the charged structures of the processes that have terminated to the result group and record failures.
+
+        Processes that are still running stay in flight.
+        """
+        in_flight = []
+        for pk in self.ctx.in_flight:
+            node = load_node(pk)
+            if not node.is_terminated:
+                in_flight.append(pk)
+                continue
+            label = CHARGE_PROCESSES.get(node.process_type, ('qeq__structure',))[0]
+            structure_pk = _incoming(node, label).pk
+            if node.is_finished_ok and 'structure_with_charges' in node.outputs:
+                self.add_result(structure_pk, node)
+                self.ctx.summary['num_succeeded'] += 1
+            else:
+                # excepted and killed processes have no exit status
+                status = node.exit_status if node.is_finished else node.process_state.value
+                self.ctx.failures['structure_{}'.format(structure_pk)] = status
+                self.ctx.summary['num_failed'] += 1
+        self.ctx.in_flight = in_flight
+
+    def results(self):
+        """Output the summary and the structures that failed."""
+        summary = {key: Int(value) for key, value in self.ctx.summary.items()}
+        self.out('summary', collect_values(result_group=Str(self.ctx.result_label), **summary))
+        if self.ctx.failures:
+            failures = {key: to_aiida_type(status) for key, status in self.ctx.failures.items()}
+            self.out('failures', collect_values(**failures))
+            if not self.ctx.summary['num_succeeded'] and not self.ctx.summary['num_skipped']:
+                return self.exit_codes.ERROR_ALL_STRUCTURES_FAILED  # pylint: disable=no-member
+        return None
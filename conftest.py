@@ -4,18 +4,68 @@ For pytest
 initialise a test database and profile
 """
 # pylint: disable=missing-function-docstring
+import json
+import platform
+
 import pytest
 
 from aiida.plugins import DataFactory
-import aiida_qeq.data as data
 from tests import TEST_DIR, DATA_DIR
 
 pytest_plugins = ['aiida.manage.tests.pytest_fixtures', 'aiida_testing.mock_code']  # pylint: disable=invalid-name
 
-SinglefileData = DataFactory('singlefile')
 CifData = DataFactory('cif')
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark-json',
+                     default=None,
+                     help='Run the benchmarks in tests/benchmarks and write their results to this JSON file.')
+    parser.addoption('--benchmark-max-repeat',
+                     type=int,
+                     default=2,
+                     help='Benchmark supercells repeating the test structures up to this number of times per axis.')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: benchmark, only run with --benchmark-json')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('benchmark_json'):
+        return
+    skip = pytest.mark.skip(reason='benchmarks only run with --benchmark-json')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_generate_tests(metafunc):
+    if 'repeat' in metafunc.fixturenames:
+        metafunc.parametrize('repeat', range(1, metafunc.config.getoption('benchmark_max_repeat') + 1))
+
+
+@pytest.fixture(scope='session')
+def benchmark_records(request):
+    """List of benchmark results, written to the file given by --benchmark-json at the end of the session."""
+    import aiida
+    import numpy
+    import aiida_qeq
+
+    records = []
+    yield records
+
+    metadata = {
+        'aiida_qeq': aiida_qeq.__version__,
+        'aiida_core': aiida.__version__,
+        'numpy': numpy.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+    }
+    with open(request.config.getoption('benchmark_json'), 'w') as handle:
+        json.dump({'metadata': metadata, 'records': records}, handle, indent=2)
+
+
 @pytest.fixture(scope='function')
 def hkust1_cif(aiida_profile):  # pylint: disable=unused-argument
     return CifData(file=str(TEST_DIR / 'HKUST1.cif'), parse_policy='lazy')
@@ -28,8 +78,8 @@ def MgO_cif(aiida_profile):  # pylint: disable=unused-argument
 
 @pytest.fixture(scope='function')
 def qeq_parameters(aiida_profile):  # pylint: disable=unused-argument
-    """Sample parameters file for QEQ calculation."""
-    return SinglefileData(file=str(data.DATA_DIR / data.qeq.DEFAULT_PARAM_FILE_NAME))
+    """Parameter table for QEQ calculation (GMP.param shipped with the plugin)."""
+    return DataFactory('qeq.element_table').get_or_create()
 
 
 @pytest.fixture(scope='function')
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Compare the dense and the matrix-free (PME) QEq solvers on supercells of HKUST-1 and MgO.
+
+Run as ``python -m examples.benchmark_pme``; no AiiDA profile is needed.
+"""
+
+import os
+import time
+
+import click
+import numpy as np
+
+import aiida_qeq.data.qeq as data
+from aiida_qeq.data import DATA_DIR
+from aiida_qeq.data.tables import read_element_table
+from aiida_qeq.engines import pme, qeq
+from . import EXAMPLE_DIR
+
+STRUCTURES = {
+    'HKUST1': EXAMPLE_DIR / 'HKUST1.cif',
+    'MgO': EXAMPLE_DIR.parent / 'tests' / 'MgO.cif',
+}
+
+
+def _timed(function, *args):
+    """Return result and wall time of a function call."""
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def benchmark(name, repeats, max_dense_atoms):
+    """Print number of atoms, solver times and maximum charge difference for supercells of a structure."""
+    import ase.io
+
+    electronegativity, hardness = read_element_table(os.path.join(DATA_DIR, data.DEFAULT_PARAM_FILE_NAME))[:2]
+    unit_cell = ase.io.read(str(STRUCTURES[name]))
+
+    for repeat in repeats:
+        atoms = unit_cell.repeat(repeat)
+        arrays = (np.array(atoms.cell), atoms.positions, atoms.numbers, electronegativity, hardness)
+        result, pme_time = _timed(pme.compute_charges, *arrays)
+
+        if len(atoms) <= max_dense_atoms:
+            dense, dense_time = _timed(qeq.compute_charges, *arrays)
+            difference = np.abs(result.charges - dense.charges).max()
+            print('{:8s} {:>3d}^3 {:8d} {:10.2f} {:10.2f} {:12.2e}'.format(name, repeat, len(atoms), dense_time,
+                                                                           pme_time, difference))
+        else:
+            print('{:8s} {:>3d}^3 {:8d} {:>10s} {:10.2f} {:>12s}'.format(name, repeat, len(atoms), '-', pme_time, '-'))
+
+
+@click.command()
+@click.option('--structure', type=click.Choice(sorted(STRUCTURES)), multiple=True, help='Structures to benchmark.')
+@click.option('--repeat', type=int, multiple=True, default=(1, 2, 3), help='Supercell sizes (repeat along each axis).')
+@click.option('--max-dense-atoms', type=int, default=5000, help='Skip the dense solver for larger supercells.')
+def cli(structure, repeat, max_dense_atoms):
+    """Compare the dense and the matrix-free QEq solvers on supercells."""
+    print('{:8s} {:>5s} {:>8s} {:>10s} {:>10s} {:>12s}'.format('name', 'cell', 'atoms', 'dense [s]', 'pme [s]',
+                                                               'max |dq|'))
+    for name in structure or sorted(STRUCTURES):
+        benchmark(name, repeat, max_dense_atoms)
+
+
+if __name__ == '__main__':
+    cli()  # pylint: disable=no-value-for-parameter
@@ -8,13 +8,12 @@ from aiida.plugins import DataFactory, CalculationFactory
 from aiida import engine
 from aiida import cmdline
 
-import aiida_qeq.data.eqeq as data
-from aiida_qeq.data import DATA_DIR
 from . import EXAMPLE_DIR
 
 EqeqCalc = CalculationFactory('qeq.eqeq')
 CifData = DataFactory('cif')
-SinglefileData = DataFactory('singlefile')
+EQeqIonizationTable = DataFactory('qeq.ionization_table')
+EQeqChargeCenterTable = DataFactory('qeq.charge_center_table')
 Parameters = DataFactory('qeq.eqeq')
 
 
@@ -26,8 +25,8 @@ def run_eqeq_hkust1(eqeq_code):  # pylint: disable=
     builder.code = eqeq_code
     builder.structure = CifData(file=os.path.join(EXAMPLE_DIR, 'HKUST1.cif'))
     builder.parameters = Parameters({'method': 'ewald'})
-    builder.charge_data = SinglefileData(file=os.path.join(DATA_DIR, data.DEFAULT_CHARGE_FILE_NAME))
-    builder.ionization_data = SinglefileData(file=os.path.join(DATA_DIR, data.DEFAULT_IONIZATION_FILE_NAME))
+    builder.charge_data = EQeqChargeCenterTable.get_or_create()
+    builder.ionization_data = EQeqIonizationTable.get_or_create()
 
     result, node = engine.run_get_node(builder)
 
@@ -8,13 +8,11 @@ from aiida.plugins import DataFactory, CalculationFactory
 from aiida import engine
 from aiida import cmdline
 
-import aiida_qeq.data.qeq as data
-from aiida_qeq.data import DATA_DIR
 from . import EXAMPLE_DIR
 
 QeqCalc = CalculationFactory('qeq.qeq')
 CifData = DataFactory('cif')
-SinglefileData = DataFactory('singlefile')
+QeqElementTable = DataFactory('qeq.element_table')
 Parameters = DataFactory('qeq.qeq')
 
 
@@ -27,7 +25,7 @@ def run_qeq_hkust1(qeq_code):
     builder = QeqCalc.get_builder()
     builder.code = qeq_code
     builder.structure = CifData(file=os.path.join(EXAMPLE_DIR, 'HKUST1.cif'))
-    builder.parameters = SinglefileData(file=os.path.join(DATA_DIR, data.DEFAULT_PARAM_FILE_NAME))
+    builder.parameters = QeqElementTable.get_or_create()
 
     result, node = engine.run_get_node(builder)
 
@@ -15,3 +15,30 @@ TEST_DIR = Path(__file__).resolve().parent
 DATA_DIR = TEST_DIR / 'data'
 
 TEST_COMPUTER = 'localhost-test'
+
+
+def calcjob_node(computer, entry_point, inputs, files):
+    """Create a stored `CalcJobNode` with inputs and a ``retrieved`` folder containing the given files.
+
+    :param inputs: dictionary of input nodes by link label (``__`` separates namespaces)
+    :param files: dictionary of file contents by path in the ``retrieved`` folder
+    """
+    import io
+    from aiida.common.links import LinkType
+    from aiida.orm import CalcJobNode, FolderData
+
+    node = CalcJobNode(computer=computer, process_type='aiida.calculations:{}'.format(entry_point))
+    node.set_option('resources', {'num_machines': 1, 'num_mpiprocs_per_machine': 1})
+    node.set_option('max_wallclock_seconds', 1800)
+    node.set_option('scheduler_stderr', '_scheduler-stderr.txt')
+    for label, input_node in inputs.items():
+        input_node.store()
+        node.add_incoming(input_node, link_type=LinkType.INPUT_CALC, link_label=label)
+    node.store()
+
+    retrieved = FolderData()
+    for filename, content in files.items():
+        retrieved.put_object_from_filelike(io.StringIO(content), filename)
+    retrieved.add_incoming(node, link_type=LinkType.CREATE, link_label='retrieved')
+    retrieved.store()
+    return node
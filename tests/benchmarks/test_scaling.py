@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the plugin path and the charge solvers on supercells of increasing size.
+
+Skipped unless pytest is run with ``--benchmark-json``, e.g.::
+
+    pytest tests/benchmarks --benchmark-json=benchmarks.json --benchmark-max-repeat=3
+
+Each benchmark adds one record (structure, supercell size, number of atoms, timings, ...) to the JSON file.
+"""
+import io
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+from aiida import engine
+from aiida.orm import Node, QueryBuilder
+from aiida.plugins import CalculationFactory, DataFactory, ParserFactory
+
+import aiida_qeq.data.qeq as qeq_data
+from aiida_qeq.engines import eqeq as eqeq_engine
+from aiida_qeq.engines import pme as pme_engine
+from aiida_qeq.engines import qeq as qeq_engine
+from aiida_qeq.engines.utils import fractional_coordinates, get_symbols
+from aiida_qeq.utils.cif import write_cif_with_charges
+from tests import TEST_DIR, DATA_DIR as TEST_DATA_DIR, calcjob_node
+
+pytestmark = pytest.mark.benchmark
+
+CifData = DataFactory('cif')
+QeqElementTable = DataFactory('qeq.element_table')
+EQeqIonizationTable = DataFactory('qeq.ionization_table')
+EQeqChargeCenterTable = DataFactory('qeq.charge_center_table')
+QeqParameters = DataFactory('qeq.qeq')
+EQeqParameters = DataFactory('qeq.eqeq')
+
+STRUCTURES = {
+    'HKUST1': TEST_DIR.parent / 'examples' / 'HKUST1.cif',
+    'MgO': TEST_DIR / 'MgO.cif',
+}
+# The dense solvers need O(N^2) memory and O(N^3) time
+MAX_DENSE_ATOMS = 5000
+# Number of calls when timing functions that do not depend on the structure
+NUM_CALLS = 1000
+
+
+def supercell(name, repeat):
+    """Return supercell of a test structure as `ase.Atoms`."""
+    import ase.io
+    return ase.io.read(str(STRUCTURES[name])).repeat(repeat)
+
+
+def supercell_cif(name, repeat):
+    """Return supercell of a test structure as `CifData` (with zero charges)."""
+    atoms = supercell(name, repeat)
+    cell = np.array(atoms.cell)
+    content = write_cif_with_charges(cell, get_symbols(atoms.numbers), fractional_coordinates(cell, atoms.positions),
+                                     np.zeros(len(atoms)))
+    filename = '{name}_{repeat}x{repeat}x{repeat}.cif'.format(name=name, repeat=repeat)
+    with io.BytesIO(content.encode('utf-8')) as handle:
+        return CifData(file=handle, filename=filename, parse_policy='lazy')
+
+
+def timed(function, *args, **kwargs):
+    """Return result and wall time of a function call."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def count_nodes():
+    """Return the number of nodes in the database."""
+    return QueryBuilder().append(Node).count()
+
+
+def synthetic_charges(numbers):
+    """Return reproducible charges summing up to zero."""
+    charges = np.random.RandomState(0).uniform(-1, 1, len(numbers))  # pylint: disable=no-member
+    return charges - charges.mean()
+
+
+def synthetic_qeq_log(cell, positions, numbers):
+    """Return a qeq.log of the size egulp writes for a structure, with a converged SCF."""
+    lines = ['egulp version 2.0.2']
+    lines += [
+        'Lattice vector #{} {:10.7f} {:10.7f} {:10.7f}'.format(index + 1, *vector) for index, vector in enumerate(cell)
+    ]
+    lines += ['Number of atoms is {}'.format(len(numbers)), 'Reading atoms']
+    for index, position in enumerate(positions):
+        lines += ['inp atom {:3d}: {:15.12f} {:15.12f} {:15.12f}'.format(index + 1, *position)]
+        lines += ['new atom {:3d}: {:15.12f} {:15.12f} {:15.12f}'.format(index + 1, *position)]
+    lines += ['Cycle: {:3d} Qdiff: {:12.6e}'.format(cycle, 10.**-cycle) for cycle in range(1, 7)]
+    lines += ['SCF CONVERGED']
+    lines += [
+        '{:4d} {:4d} {:12.7f}'.format(index + 1, number, charge)
+        for index, (number, charge) in enumerate(zip(numbers, synthetic_charges(numbers)))
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def qeq_output_files(atoms):
+    """Return dictionary of file names and contents written by egulp for a structure."""
+    cell, positions, numbers = np.array(atoms.cell), atoms.positions, atoms.numbers
+    charges = synthetic_charges(numbers)
+    charges_dat = ''.join('{:4d} {:4d} {:12.7f}\n'.format(index + 1, number, charge)
+                          for index, (number, charge) in enumerate(zip(numbers, charges)))
+    charges_cif = write_cif_with_charges(cell, get_symbols(numbers), fractional_coordinates(cell, positions), charges)
+    return {'charges.dat': charges_dat, 'charges.cif': charges_cif, '_scheduler-stderr.txt': ''}
+
+
+def eqeq_output_files(atoms, structure, parameters):
+    """Return dictionary of file names and contents written by eqeq for a structure (except for the JSON file)."""
+    cell, positions, numbers = np.array(atoms.cell), atoms.positions, atoms.numbers
+    charges = synthetic_charges(numbers)
+    names = parameters.output_files_dict(structure.filename)
+    charges_cif = write_cif_with_charges(cell, get_symbols(numbers), fractional_coordinates(cell, positions), charges)
+    return {names['cif']: charges_cif, '_scheduler-stderr.txt': ''}
+
+
+def synthetic_calculations(atoms, structure, temporary_folder):
+    """Return list of (entry point, inputs, retrieved files) of Qeq and EQeq calculations with synthetic outputs.
+
+    The files retrieved into the temporary folder (qeq.log, the JSON file of eqeq) are written to ``temporary_folder``.
+    """
+    with open(str(temporary_folder / qeq_data.LOG_FILE_NAME), 'w') as handle:
+        handle.write(synthetic_qeq_log(np.array(atoms.cell), atoms.positions, atoms.numbers))
+    eqeq_parameters = EQeqParameters({'method': 'ewald'})
+    with open(str(temporary_folder / eqeq_parameters.output_files_dict(structure.filename)['json']), 'w') as handle:
+        handle.write(json.dumps(synthetic_charges(atoms.numbers).tolist()))
+
+    qeq_inputs = {'structure': structure, 'parameters': QeqElementTable.get_or_create()}
+    eqeq_inputs = {'structure': structure, 'parameters': eqeq_parameters}
+    return [
+        ('qeq.qeq', qeq_inputs, qeq_output_files(atoms)),
+        ('qeq.eqeq', eqeq_inputs, eqeq_output_files(atoms, structure, eqeq_parameters)),
+    ]
+
+
+def charge_solvers(atoms):
+    """Return list of (name, function, parameters) of the in-process charge solvers applicable to a structure."""
+    element_table = QeqElementTable.get_or_create()
+    qeq_parameters = (element_table.electronegativity, element_table.hardness)
+    solvers = [('qeq.pme', pme_engine.compute_charges, qeq_parameters)]
+    if len(atoms) <= MAX_DENSE_ATOMS:
+        ionization_table = EQeqIonizationTable.get_or_create()
+        charge_centers = EQeqChargeCenterTable.get_or_create().charge_center_dict
+        options = EQeqParameters({'method': 'ewald'}).get_dict()
+        eqeq_parameters = (ionization_table.symbols, ionization_table.energies, charge_centers, options)
+        solvers += [
+            ('qeq.dense', qeq_engine.compute_charges, qeq_parameters),
+            ('eqeq.dense', eqeq_engine.compute_charges, eqeq_parameters),
+        ]
+    return solvers
+
+
+def retrieved_bytes(node):
+    """Return the total size of the files in the ``retrieved`` folder of a calculation."""
+    retrieved = node.outputs.retrieved
+    total = 0
+    for name in retrieved.list_object_names():
+        with retrieved.open(name, 'rb') as handle:
+            total += len(handle.read())
+    return total
+
+
+@pytest.mark.parametrize('name', sorted(STRUCTURES))
+def test_benchmark_prepare(qeq_code, eqeq_code, name, repeat, benchmark_records):
+    """Time `prepare_for_submission` (dry run) of Qeq and EQeq calculations."""
+    atoms = supercell(name, repeat)
+    structure = supercell_cif(name, repeat)
+    qeq_builder = CalculationFactory('qeq.qeq').get_builder()
+    qeq_builder.code = qeq_code
+    qeq_builder.structure = structure
+    qeq_builder.parameters = QeqElementTable.get_or_create()
+
+    eqeq_builder = CalculationFactory('qeq.eqeq').get_builder()
+    eqeq_builder.code = eqeq_code
+    eqeq_builder.structure = structure
+    eqeq_builder.parameters = EQeqParameters({'method': 'ewald'})
+    eqeq_builder.charge_data = EQeqChargeCenterTable.get_or_create()
+    eqeq_builder.ionization_data = EQeqIonizationTable.get_or_create()
+
+    for entry_point, builder in [('qeq.qeq', qeq_builder), ('qeq.eqeq', eqeq_builder)]:
+        builder.metadata.dry_run = True
+        builder.metadata.store_provenance = False
+        _result, seconds = timed(engine.run, builder)
+        benchmark_records.append({
+            'benchmark': 'prepare',
+            'calculation': entry_point,
+            'structure': name,
+            'repeat': repeat,
+            'num_atoms': len(atoms),
+            'seconds': seconds,
+        })
+
+
+@pytest.mark.parametrize('name', sorted(STRUCTURES))
+def test_benchmark_parse(qeq_code, name, repeat, benchmark_records, tmp_path):
+    """Time `QeqParser.parse` and `EQeqParser.parse` on synthetic outputs, count created nodes and bytes."""
+    atoms = supercell(name, repeat)
+    structure = supercell_cif(name, repeat)
+    for entry_point, inputs, files in synthetic_calculations(atoms, structure, tmp_path):
+        node = calcjob_node(qeq_code.computer, entry_point, inputs, files)
+        num_nodes = count_nodes()
+        (results, calcfunction), seconds = timed(ParserFactory(entry_point).parse_from_node,
+                                                 node,
+                                                 retrieved_temporary_folder=str(tmp_path))
+        assert calcfunction.is_finished_ok, calcfunction.exit_status
+        assert 'structure_with_charges' in results
+        benchmark_records.append({
+            'benchmark': 'parse',
+            'calculation': entry_point,
+            'structure': name,
+            'repeat': repeat,
+            'num_atoms': len(atoms),
+            'seconds': seconds,
+            'num_nodes': count_nodes() - num_nodes,
+            'retrieved_bytes': retrieved_bytes(node),
+        })
+
+
+@pytest.mark.parametrize('name', sorted(STRUCTURES))
+def test_benchmark_solvers(aiida_profile, name, repeat, benchmark_records):  # pylint: disable=unused-argument
+    """Time the in-process charge solvers."""
+    atoms = supercell(name, repeat)
+    for solver, function, parameters in charge_solvers(atoms):
+        _result, seconds = timed(function, np.array(atoms.cell), atoms.positions, atoms.numbers, *parameters)
+        benchmark_records.append({
+            'benchmark': 'solver',
+            'solver': solver,
+            'structure': name,
+            'repeat': repeat,
+            'num_atoms': len(atoms),
+            'seconds': seconds,
+        })
+
+
+def test_benchmark_input_generation(aiida_profile, benchmark_records):  # pylint: disable=unused-argument
+    """Time generation of the command line and the configure.input file (independent of the structure)."""
+    parameters = QeqParameters()
+    for method, function in [('configure_string', lambda: parameters.configure_string),
+                             ('cmdline_params', lambda: parameters.cmdline_params('structure.cif'))]:
+        _result, seconds = timed(lambda f=function: [f() for _ in range(NUM_CALLS)])
+        benchmark_records.append({'benchmark': method, 'calculation': 'qeq.qeq', 'seconds': seconds / NUM_CALLS})
+
+
+def test_benchmark_mock_run(qeq_code, benchmark_records):
+    """Time a complete calculation with the mocked egulp code, count created nodes and retrieved bytes."""
+    builder = CalculationFactory('qeq.qeq').get_builder()
+    builder.code = qeq_code
+    builder.structure = CifData(
+        file=os.path.join(TEST_DATA_DIR, 'mock-egulp-2d61ca9-58a7e9adc6ace777832c50046ee34492', 'HKUST1.cif'))
+    builder.parameters = QeqElementTable.get_or_create()
+
+    num_nodes = count_nodes()
+    (_result, node), seconds = timed(engine.run_get_node, builder)
+    assert node.is_finished_ok
+    benchmark_records.append({
+        'benchmark': 'run',
+        'calculation': 'qeq.qeq',
+        'structure': 'HKUST1',
+        'repeat': 1,
+        'num_atoms': 624,
+        'seconds': seconds,
+        'num_nodes': count_nodes() - num_nodes,
+        'retrieved_bytes': retrieved_bytes(node),
+    })
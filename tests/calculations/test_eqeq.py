@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Tests for eqeq calculation plugin
+"""
+
+import os
+from aiida.plugins import DataFactory, CalculationFactory
+from aiida import engine
+
+from tests import TEST_DIR, DATA_DIR as TEST_DATA_DIR
+
+EQeqCalc = CalculationFactory('qeq.eqeq')
+CifData = DataFactory('cif')
+EQeqParameters = DataFactory('qeq.eqeq')
+
+
+def test_eqeq_sweep_submit_test(eqeq_code):
+    """Prepare eqeq parameter sweep without running it: all combinations run in one job on one staged structure.
+    """
+    builder = EQeqCalc.get_builder()
+    builder.code = eqeq_code
+    builder.structure = CifData(file=os.path.join(TEST_DATA_DIR, '08010N2_DDEC.cif'))
+    builder.parameters = EQeqParameters({'lambda': [1.0, 1.2], 'hI0': [-2.0, -1.0]})
+    builder.ionization_data = DataFactory('qeq.ionization_table').get_or_create()
+    builder.charge_data = DataFactory('qeq.charge_center_table').get_or_create()
+    builder.metadata.dry_run = True
+
+    _result, node = engine.run_get_node(builder)
+
+    folder = node.dry_run_info['folder']
+    assert os.path.isfile(os.path.join(folder, '08010N2_DDEC.cif'))
+    with open(os.path.join(folder, node.dry_run_info['script_filename'])) as handle:
+        script = handle.read()
+    assert script.count("'08010N2_DDEC.cif'") == 4
+    assert "'1.0' '-1.0'" in script
+
+    retrieve_list = node.get_retrieve_list()
+    assert '08010N2_DDEC.cif_EQeq_ewald_1.20_-1.00.cif' in retrieve_list
+    assert len([name for name in retrieve_list if name.endswith('.cif')]) == 4
+
+
+def test_eqeq_hkust1(eqeq_code):
+    """Run eqeq calculation on HKUST-1 with the ionization and charge center tables.
+    """
+    builder = EQeqCalc.get_builder()
+    builder.code = eqeq_code
+    builder.structure = CifData(file=str(TEST_DIR.parent / 'examples' / 'HKUST1.cif'))
+    builder.parameters = EQeqParameters({'method': 'ewald'})
+    builder.ionization_data = DataFactory('qeq.ionization_table').get_or_create()
+    builder.charge_data = DataFactory('qeq.charge_center_table').get_or_create()
+
+    result, node = engine.run_get_node(builder)
+
+    assert node.is_finished_ok, node.exit_status
+    charges = result['charges'].get_array('charges')
+    assert len(charges) == 624
+    assert abs(charges.sum()) < 1e-3
+    assert 'structure_with_charges' in result
@@ -13,6 +13,7 @@ from tests import DATA_DIR as TEST_DATA_DIR
 QeqCalc = CalculationFactory('qeq.qeq')
 CifData = DataFactory('cif')
 SinglefileData = DataFactory('singlefile')
+QeqElementTable = DataFactory('qeq.element_table')
 Parameters = DataFactory('qeq.eqeq')
 
 
@@ -25,9 +26,32 @@ def test_qeq_failure(qeq_code):
     builder = QeqCalc.get_builder()
     builder.code = qeq_code
     builder.structure = CifData(file=os.path.join(TEST_DATA_DIR, '08010N2_DDEC.cif'))
-    builder.parameters = SinglefileData(file=os.path.join(DATA_DIR, data.DEFAULT_PARAM_FILE_NAME))
+    builder.parameters = QeqElementTable.get_or_create()
 
     _result, node = engine.run_get_node(builder)
 
     assert not node.is_finished_ok
     assert node.exit_status == 801
+
+    metrics = node.outputs.metrics.get_dict()
+    assert metrics['num_atoms'] == 228
+    assert metrics['parse_seconds'] > 0
+    assert metrics['retrieved_bytes'] > 0
+
+
+def test_qeq_parameter_file_submit_test(qeq_code):
+    """Prepare qeq calculation with a parameter file instead of a table, without running it.
+    """
+    builder = QeqCalc.get_builder()
+    builder.code = qeq_code
+    builder.structure = CifData(file=os.path.join(TEST_DATA_DIR, '08010N2_DDEC.cif'))
+    builder.parameters = SinglefileData(file=os.path.join(DATA_DIR, data.DEFAULT_PARAM_FILE_NAME))
+    builder.metadata.dry_run = True
+
+    _result, node = engine.run_get_node(builder)
+
+    folder = node.dry_run_info['folder']
+    with open(os.path.join(folder, data.DEFAULT_PARAM_FILE_NAME)) as handle:
+        assert handle.read() == QeqElementTable.get_or_create().file_content
+    with open(os.path.join(folder, node.dry_run_info['script_filename'])) as handle:
+        assert "'08010N2_DDEC.cif' 'GMP.param' 'configure.input'" in handle.read()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Tests for batched qeq calculation plugin
+"""
+
+import os
+from aiida.plugins import DataFactory, CalculationFactory
+from aiida import engine
+
+import aiida_qeq.data.qeq as data
+from aiida_qeq.calculations.qeq_batch import BATCH_SCRIPT_NAME
+from tests import TEST_DIR, DATA_DIR as TEST_DATA_DIR
+
+QeqBatchCalc = CalculationFactory('qeq.qeq_batch')
+CifData = DataFactory('cif')
+QeqElementTable = DataFactory('qeq.element_table')
+
+
+def test_qeq_batch_submit_test(qeq_code):
+    """Prepare batched qeq calculation on two structures without running it.
+    """
+    builder = QeqBatchCalc.get_builder()
+    builder.code = qeq_code
+    builder.structures = {
+        'mgo': CifData(file=os.path.join(TEST_DIR, 'MgO.cif')),
+        'n2': CifData(file=os.path.join(TEST_DATA_DIR, '08010N2_DDEC.cif')),
+    }
+    builder.parameters = QeqElementTable.get_or_create()
+    builder.metadata.options.max_parallel = 2
+    builder.metadata.dry_run = True
+
+    _result, node = engine.run_get_node(builder)
+
+    folder = node.dry_run_info['folder']
+    assert os.path.isfile(os.path.join(folder, BATCH_SCRIPT_NAME))
+    assert os.path.isfile(os.path.join(folder, data.DEFAULT_CONFIGURE_FILE_NAME))
+    assert os.path.isfile(os.path.join(folder, data.DEFAULT_PARAM_FILE_NAME))
+    assert os.path.isfile(os.path.join(folder, 'mgo', 'MgO.cif'))
+    assert os.path.isfile(os.path.join(folder, 'n2', '08010N2_DDEC.cif'))
+
+    with open(os.path.join(folder, node.dry_run_info['script_filename'])) as handle:
+        script = handle.read()
+    # the batch script runs in the background while the code runs the first structure
+    assert "'configure.input' 'mgo' 'n2' '08010N2_DDEC.cif' &" in script
+    assert script.index(BATCH_SCRIPT_NAME) < script.index("'MgO.cif'")
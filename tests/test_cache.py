@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Tests for the charge cache
+"""
+import numpy as np
+from aiida.common.links import LinkType
+from aiida.plugins import CalculationFactory, DataFactory
+
+from aiida_qeq.utils.cache import (ChargeCache, cached_charges, inputs_cache_key, options_hash, store_charges,
+                                   structure_hash)
+from tests import DATA_DIR, calcjob_node
+
+HKUST1_DIR = DATA_DIR / 'mock-egulp-2d61ca9-58a7e9adc6ace777832c50046ee34492'
+
+CELL = np.array([[4.2, 0., 0.], [0., 4.2, 0.], [0.1, 0., 4.3]])
+POSITIONS = np.array([[0., 0., 0.], [2.1, 2.1, 0.], [2.1, 0., 2.15], [0.1, 2.1, 2.15]])
+NUMBERS = np.array([12, 12, 8, 8])
+
+
+def test_structure_hash_canonical():
+    """Hash does not depend on periodic images, but on the order of the atoms (to which the charges refer)."""
+    reference = structure_hash(CELL, POSITIONS, NUMBERS)
+
+    shifted = POSITIONS + np.dot([[1, 0, 0], [0, -1, 0], [0, 0, 0], [2, 1, 1]], CELL)
+    assert structure_hash(CELL, shifted, NUMBERS) == reference
+
+    order = [3, 1, 0, 2]
+    assert structure_hash(CELL, POSITIONS[order], NUMBERS[order]) != reference
+
+    moved = POSITIONS.copy()
+    moved[0, 0] += 0.01
+    assert structure_hash(CELL, moved, NUMBERS) != reference
+
+
+def test_options_hash():
+    """Output selection does not enter the options hash."""
+    assert options_hash({'imethod': 0, 'retrieve': ['charges.cif']}) == options_hash({'imethod': 0})
+    assert options_hash({'imethod': 0}) != options_hash({'imethod': 1})
+
+
+def test_charge_cache_lru(tmp_path):
+    """Least recently used entries are evicted first."""
+    cache = ChargeCache(directory=str(tmp_path), max_size=250)
+    cache.put('aa01', b'x' * 100)
+    cache.put('bb02', b'y' * 100)
+    assert cache.get('aa01') == b'x' * 100  # aa01 is now most recently used
+    cache.put('cc03', b'z' * 100)
+
+    assert 'aa01' in cache
+    assert 'bb02' not in cache
+    assert cache.get('bb02') is None
+    assert cache.stats == {'hits': 1, 'misses': 1, 'entries': 2, 'size': 200}
+
+
+def test_charge_cache_round_trip(aiida_localhost, tmp_path):
+    """Charges of a finished calculation are found again for a builder with the same inputs."""
+    from plumpy import ProcessState
+    # imported here, since pytest collects run_* functions of test modules
+    from aiida_qeq.utils.cache import run_cached
+    QeqCalculation = CalculationFactory('qeq.qeq')  # pylint: disable=invalid-name
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+
+    cache = ChargeCache(directory=str(tmp_path))
+    structure = CifData(file=str(HKUST1_DIR / 'HKUST1.cif'))
+    parameters = DataFactory('qeq.element_table').get_or_create()
+    builder = QeqCalculation.get_builder()
+    builder.structure = structure
+    builder.parameters = parameters
+    assert cached_charges(builder, cache) is None
+
+    node = calcjob_node(aiida_localhost, 'qeq.qeq', {'structure': structure, 'parameters': parameters}, {})
+    charged = CifData(file=str(HKUST1_DIR / 'charges.cif'))
+    charged.add_incoming(node, link_type=LinkType.CREATE, link_label='structure_with_charges')
+    charged.store()
+    assert not store_charges(node, cache)  # not finished yet
+    node.set_process_state(ProcessState.FINISHED)
+    node.set_exit_status(0)
+    assert inputs_cache_key(QeqCalculation, node.inputs) == inputs_cache_key(QeqCalculation, builder)
+    assert store_charges(node, cache)
+
+    # a hit does not run the calculation (the builder has no code)
+    cif = run_cached(builder, cache)
+    assert cif.get_attribute('partial_charge_method') == 'qeq'
+    assert cif.get_attribute('charge_cache_key') == inputs_cache_key(QeqCalculation, builder)[0]
+    with cif.open(mode='rb') as handle, charged.open(mode='rb') as reference:
+        assert handle.read() == reference.read()
+    assert cache.stats['hits'] == cache.stats['misses'] == cache.stats['entries'] == 1
+
+    # the output selection does not change the charges, the method does
+    builder.configure = DataFactory('qeq.qeq')({'retrieve': ['charges.dat']})
+    assert cached_charges(builder, cache) is not None
+    builder.configure = DataFactory('qeq.qeq')({'imethod': 1})
+    assert cached_charges(builder, cache) is None
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Tests for the pre-flight canonicalisation of structures
+"""
+import io
+
+import numpy as np
+import pytest
+from aiida.plugins import DataFactory
+
+from aiida_qeq.engines.utils import fractional_coordinates, get_arrays
+from aiida_qeq.utils.canonical import canonical_structure, check_structure, wrap_fractional
+from tests import TEST_DIR
+
+CifData = DataFactory('cif')
+
+
+def test_wrap_fractional():
+    """Wrapped coordinates stay in [0, 1) after rounding."""
+    wrapped = wrap_fractional([[-0.25, 0.999999999, 1.0], [2.5, -1e-12, 0.5]])
+    assert np.allclose(wrapped, [[0.75, 0., 0.], [0.5, 0., 0.5]])
+
+
+def test_check_structure(aiida_profile):  # pylint: disable=unused-argument
+    """Overlapping atoms and degenerate cells are rejected."""
+    cell, positions, numbers = get_arrays(CifData(file=str(TEST_DIR / 'MgO.cif')))
+    check_structure(cell, positions, numbers)
+
+    with pytest.raises(ValueError):
+        check_structure(cell, np.vstack([positions, positions[:1] + 0.1]), np.append(numbers, 8))
+    with pytest.raises(ValueError):
+        check_structure(np.diag([1., 1., 0.]), positions, numbers)
+
+
+def test_canonical_structure(aiida_profile):  # pylint: disable=unused-argument
+    """The canonical structure is created once per file content and keeps the atoms of the input."""
+    structure = CifData(file=str(TEST_DIR / 'MgO.cif'))
+    canonical = canonical_structure(structure)
+
+    assert canonical.is_stored
+    assert canonical.filename == structure.filename
+    lines = canonical.get_content().rstrip().splitlines()
+    assert lines[lines.index('_atom_site_charge') - 1] == '_atom_site_fract_z'
+    assert len(lines) - lines.index('_atom_site_charge') - 1 == 12
+    assert canonical_structure(canonical).uuid == canonical.uuid
+    assert canonical_structure(CifData(file=str(TEST_DIR / 'MgO.cif'))).uuid == canonical.uuid
+
+    cell, positions, numbers = get_arrays(canonical)
+    reference = get_arrays(structure)
+    assert np.allclose(cell, reference[0])
+    # positions are only wrapped into the cell
+    shift = fractional_coordinates(cell, positions) - fractional_coordinates(*reference[:2])
+    assert np.allclose(shift, np.round(shift), atol=1e-5)
+    assert np.all(numbers == reference[2])
+
+    with io.BytesIO(b'data_broken\n_cell_length_a 1.0\n') as handle:
+        with pytest.raises(ValueError):
+            canonical_structure(CifData(file=handle, filename='broken.cif', parse_policy='lazy'))
@@ -32,6 +32,28 @@ class TestEQeqParameters(PluginTestCase):
         with self.assertRaises(MultipleInvalid):
             EQeqParameters(d)
 
+    def test_sweep(self):
+        """Test parameter sweep over lists of lambda and hI0 values."""
+        from aiida.plugins import DataFactory
+        from voluptuous import Invalid
+        from aiida_qeq.data.eqeq import sweep_key
+        EQeqParameters = DataFactory('qeq.eqeq')
+
+        p = EQeqParameters({'lambda': [1.0, 1.2], 'hI0': -1.0})
+        self.assertTrue(p.is_sweep)
+        self.assertEqual(p.sweep_points, [(1.0, -1.0), (1.2, -1.0)])
+        self.assertEqual(sweep_key(p.sweep_points[1]), 'lambda_1_20_hI0_m1_00')
+        self.assertEqual(
+            p.cmdline_params(structure_file_name='test.cif', point=(1.2, -1.0))[:3], ['test.cif', '1.2', '-1.0'])
+        self.assertEqual(
+            p.output_files_dict('test.cif', point=(1.2, -1.0))['cif'], 'test.cif_EQeq_ewald_1.20_-1.00.cif')
+        with self.assertRaises(ValueError):
+            p.output_files_dict('test.cif')
+
+        self.assertFalse(EQeqParameters({}).is_sweep)
+        with self.assertRaises(Invalid):
+            EQeqParameters({'lambda': [1.0, 1.2], 'retrieve': ['pdb']})
+
 
 class TestQeqParameters(PluginTestCase):
     """Test input parameters for Qeq calculation"""
@@ -69,3 +91,93 @@ include_pceq 0
 imethod 0"""
 
         self.assertEqual(p.configure_string, expected_string)
+
+
+def test_parameter_tables(aiida_profile):  # pylint: disable=unused-argument
+    """Parameter tables are stored once and write back the files they were read from byte for byte."""
+    import io
+    from aiida.plugins import DataFactory
+    from aiida_qeq.data import DATA_DIR
+
+    for entry_point in ['qeq.element_table', 'qeq.ionization_table', 'qeq.charge_center_table']:
+        table_class = DataFactory(entry_point)
+        table = table_class.get_or_create()
+        assert table.is_stored
+        assert table.filename == table_class.DEFAULT_FILE_NAME
+        assert table_class.get_or_create().uuid == table.uuid
+        assert table_class.from_file(io.StringIO(table.file_content), table.filename).content_hash == table.content_hash
+
+    for entry_point in ['qeq.element_table', 'qeq.ionization_table']:
+        table_class = DataFactory(entry_point)
+        with open(str(DATA_DIR / table_class.DEFAULT_FILE_NAME)) as handle:
+            assert table_class.from_file().file_content == handle.read()
+
+
+def test_element_table(aiida_profile):  # pylint: disable=unused-argument
+    """The element table holds the values of GMP.param and round-trips tables created from arrays."""
+    import io
+    import numpy as np
+    from aiida.plugins import DataFactory
+
+    table_class = DataFactory('qeq.element_table')
+    table = table_class.get_or_create()
+    electronegativity, hardness = table.electronegativity, table.hardness
+    assert electronegativity[6] == 5.34 and hardness[6] == 5.065
+    assert np.isnan(electronegativity[0])
+    # tables created from (fitted) arrays round-trip through the file format
+    fitted = table_class.from_arrays(electronegativity + 0.123456, hardness)
+    assert fitted.filename == 'GMP.param'
+    assert fitted.content_hash == table_class.from_file(io.StringIO(fitted.file_content)).content_hash
+    assert np.array_equal(fitted.electronegativity, np.round(electronegativity + 0.123456, 4), equal_nan=True)
+
+
+def test_eqeq_tables(aiida_profile):  # pylint: disable=unused-argument
+    """The EQeq tables hold the values of ionizationdata.dat and chargecenters.dat."""
+    import io
+    import numpy as np
+    from aiida.plugins import DataFactory
+    from aiida_qeq.data.tables import NUM_IONIZATION_ENERGIES
+
+    ionization_table = DataFactory('qeq.ionization_table').get_or_create()
+    assert ionization_table.symbols['H'] == 1
+    assert ionization_table.energies.shape[1] == NUM_IONIZATION_ENERGIES
+    assert ionization_table.energies[1, :2].tolist() == [0.7542, 13.598]
+    assert np.isnan(ionization_table.energies[1, 2])
+    assert ionization_table.file_content.splitlines()[0].split('\t')[3:6] == ['0.75420', '13.598000', 'np']
+    assert ionization_table.content_hash == DataFactory('qeq.ionization_table').from_file(
+        io.StringIO(ionization_table.file_content)).content_hash
+
+    charge_table = DataFactory('qeq.charge_center_table').get_or_create()
+    assert charge_table.charge_center_dict['Li'] == 1
+    assert charge_table.charge_centers[29] == 2
+
+
+def test_grid_data(aiida_profile, tmp_path):  # pylint: disable=unused-argument
+    """Cube files are converted into memory-mapped arrays with the grid metadata in Angstrom."""
+    import numpy as np
+    from aiida.orm import load_node
+    from aiida.plugins import DataFactory
+    from aiida_qeq.engines.utils import BOHR
+
+    shape = (8, 6, 7)
+    values = np.random.RandomState(0).normal(size=shape)  # pylint: disable=no-member
+    lines = ['potential', 'comment', '    1    0.000000    0.000000    0.000000']
+    lines += ['{:5d}{:12.6f}{:12.6f}{:12.6f}'.format(n, *row) for n, row in zip(shape, 0.5 * np.eye(3))]
+    lines += ['    8    0.000000    1.000000    2.000000    3.000000']
+    for row in values.reshape(-1, shape[2]):
+        lines += [''.join('{:13.5E}'.format(value) for value in row[start:start + 6]) for start in (0, 6)]
+    with open(str(tmp_path / 'repeat.cube'), 'w') as handle:
+        handle.write('\n'.join(lines) + '\n')
+
+    grid = DataFactory('qeq.grid').from_cube(str(tmp_path / 'repeat.cube')).store()
+    grid = load_node(grid.pk)
+    assert grid.shape == shape
+    assert np.allclose(grid.cell, np.diag(shape) * 0.5 * BOHR)
+    assert np.allclose(grid.positions, [[1. * BOHR, 2. * BOHR, 3. * BOHR]])
+    assert isinstance(grid.values, np.memmap)
+    assert np.allclose(grid.values, values, atol=1e-5)
+    assert np.allclose(grid.get_values(np.s_[3, :, 2]), values[3, :, 2], atol=1e-5)
+
+    coarse, voxel = grid.downsample(2)
+    assert np.allclose(coarse, values[::2, ::2, ::2], atol=1e-5)
+    assert np.allclose(voxel, np.eye(3) * BOHR)
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Tests for the in-process charge equilibration engines."""
+import json
+
+import numpy as np
+import pytest
+from aiida.plugins import CalculationFactory, DataFactory
+
+import aiida_qeq.data.qeq as data
+from aiida_qeq.data import DATA_DIR
+from aiida_qeq.engines import qeq as qeq_engine
+from aiida_qeq.engines import eqeq as eqeq_engine
+from aiida_qeq.engines import pme as pme_engine
+from aiida_qeq.engines.utils import get_arrays
+from tests import TEST_DIR, DATA_DIR as TEST_DATA_DIR
+
+CifData = DataFactory('cif')
+SinglefileData = DataFactory('singlefile')
+EQeqParameters = DataFactory('qeq.eqeq')
+QeqElementTable = DataFactory('qeq.element_table')
+
+QEQ_REFERENCE_DIR = TEST_DATA_DIR / 'mock-egulp-2d61ca9-58a7e9adc6ace777832c50046ee34492'
+EQEQ_REFERENCE_DIR = TEST_DATA_DIR / 'mock-eqeq-6490320-5e093ca7b0a5e9d5efcab6054a3dceaf'
+
+
+def test_qeq_engine_hkust1(aiida_profile):  # pylint: disable=unused-argument
+    """Compare charges of the in-process QEq engine with the ones computed by egulp."""
+    structure = CifData(file=str(QEQ_REFERENCE_DIR / 'HKUST1.cif'))
+    parameters = SinglefileData(file=str(DATA_DIR / data.DEFAULT_PARAM_FILE_NAME))
+
+    result = qeq_engine.qeq_charges(structure, parameters)
+    cif = result['structure_with_charges']
+    assert cif.get_attribute('partial_charge_method') == 'qeq'
+
+    charges = np.array(cif.values['crystal']['_atom_site_charge'], dtype=float)
+    reference = np.loadtxt(str(QEQ_REFERENCE_DIR / 'charges.dat'))
+    assert len(charges) == len(reference)
+    # charges are written with 7 decimals
+    assert abs(charges.sum()) < len(charges) * 1e-7
+    assert np.abs(charges - reference[:, 2]).max() < 0.05
+
+
+def test_qeq_engine_missing_element(aiida_profile):  # pylint: disable=unused-argument
+    """Check that elements without parameters are rejected."""
+    table = QeqElementTable.get_or_create()
+    electronegativity, hardness = table.electronegativity, table.hardness
+    cell, positions, numbers = get_arrays(CifData(file=str(QEQ_REFERENCE_DIR / 'HKUST1.cif')))
+    numbers[0] = 104
+
+    with pytest.raises(ValueError):
+        qeq_engine.compute_charges(cell, positions, numbers, electronegativity, hardness)
+
+
+def test_eqeq_engine_hkust1(aiida_profile):  # pylint: disable=unused-argument
+    """Compare charges of the in-process EQeq engine with the ones computed by eqeq.
+
+    eqeq runs with fixed Ewald parameters, which leave symmetry-equivalent Cu atoms with charges differing
+    by up to 0.034 e. The in-process engine converges the Ewald sum to the requested precision.
+    """
+    structure = CifData(file=str(EQEQ_REFERENCE_DIR / 'HKUST1.cif'))
+    parameters = EQeqParameters({'method': 'ewald'})
+    ionization_data = DataFactory('qeq.ionization_table').get_or_create()
+    charge_data = DataFactory('qeq.charge_center_table').get_or_create()
+
+    result = eqeq_engine.eqeq_charges(structure, parameters, ionization_data, charge_data)
+    cif = result['structure_with_charges']
+    assert cif.get_attribute('partial_charge_method') == 'eqeq'
+    assert result['ewald_parameters']['num_kvectors'] > 0
+
+    charges = np.array(cif.values['crystal']['_atom_site_charge'], dtype=float)
+    with open(str(EQEQ_REFERENCE_DIR / 'HKUST1.cif_EQeq_ewald_1.20_-2.00.json')) as handle:
+        reference = np.array(json.load(handle))
+    assert abs(charges.sum()) < 1e-6
+    assert np.abs(charges - reference).max() < 0.05
+
+    copper = charges[np.array(cif.values['crystal']['_atom_site_type_symbol']) == 'Cu']
+    # at most one unit of the last decimal (charge-precision 3) apart
+    assert copper.max() - copper.min() < 1.5e-3
+
+
+def test_eqeq_round_charges():
+    """Check that rounded charges keep their sum."""
+    charges = np.array([0.33333, 0.33333, 0.33334, -1.0])
+    rounded = eqeq_engine.round_charges(charges, 2)
+
+    assert np.allclose(rounded, np.round(rounded, 2))
+    assert abs(rounded.sum()) < 1e-12
+
+
+@pytest.mark.parametrize('cif_file', [QEQ_REFERENCE_DIR / 'HKUST1.cif', TEST_DIR / 'MgO.cif'])
+def test_qeq_engine_pme(aiida_profile, monkeypatch, cif_file):  # pylint: disable=unused-argument
+    """Check that the matrix-free solver reproduces the charges of the dense solver."""
+    table = QeqElementTable.get_or_create()
+    electronegativity, hardness = table.electronegativity, table.hardness
+    structure = CifData(file=str(cif_file))
+    cell, positions, numbers = get_arrays(structure)
+
+    dense = qeq_engine.compute_charges(cell, positions, numbers, electronegativity, hardness)
+    result = pme_engine.compute_charges(cell, positions, numbers, electronegativity, hardness)
+    assert result.converged
+    assert abs(result.charges.sum()) < 1e-8
+    assert np.abs(result.charges - dense.charges).max() < 1e-4
+
+    # conjugate gradients stopped after one iteration
+    constrained_cg = pme_engine.constrained_cg
+    monkeypatch.setattr(pme_engine, 'constrained_cg', lambda *args: constrained_cg(*args, max_iterations=1))
+    assert not pme_engine.compute_charges(cell, positions, numbers, electronegativity, hardness).converged
+    _, node = pme_engine.qeq_charges_pme.run_get_node(structure, table)
+    assert node.exit_status == CalculationFactory('qeq.qeq').exit_codes.ERROR_SCF_NOT_CONVERGED.status
+
+
+def test_potential_grid():
+    """Check that the grid potential does not depend on the Ewald splitting and is evaluated consistently in chunks."""
+    from aiida_qeq.engines import potential
+
+    rng = np.random.RandomState(0)  # pylint: disable=no-member
+    cell = np.array([[6., 0., 0.], [1., 7., 0.], [0.5, 0.8, 8.]])
+    positions = rng.rand(6, 3) @ cell
+    numbers = np.array([8, 1, 6, 8, 1, 29])
+    charges = rng.normal(size=6) + 0.1  # includes the background of a charged cell
+    shape = (10, 11, 12)
+
+    default = potential.PotentialEvaluator(cell, positions, numbers, charges, shape, offset=0.3)
+    reference = potential.PotentialEvaluator(cell,
+                                             positions,
+                                             numbers,
+                                             charges,
+                                             shape,
+                                             offset=0.3,
+                                             accuracy=1e-8,
+                                             cutoff=8.)
+    values = np.concatenate(list(potential.iter_potential(default)))
+    assert values.shape == shape
+    assert np.allclose(values[3:5], default.planes(3, 5), equal_nan=True)
+    assert np.nanmax(np.abs(values - reference.planes(0, shape[0]))) < 1e-4
+
+    # points closer than offset to an atom are excluded
+    distances, _ = default.tree.query(default.points(0, shape[0]))
+    assert np.array_equal(np.isnan(values.ravel()), distances < 0.3)
+
+    shell = potential.PotentialEvaluator(cell, positions, numbers, charges, shape, shell=(1., 2.))
+    inside = np.isfinite(shell.planes(0, shape[0]))
+    assert 0 < inside.sum() < inside.size
+
+
+@pytest.mark.parametrize('cif_file', [QEQ_REFERENCE_DIR / 'HKUST1.cif', TEST_DIR / 'MgO.cif'])
+def test_qeq_engine_symmetry(aiida_profile, cif_file):  # pylint: disable=unused-argument
+    """Check that the symmetry-reduced solver reproduces the charges of the P1 solver."""
+    pytest.importorskip('spglib')
+    from aiida_qeq.engines import symmetry as symmetry_engine
+
+    table = QeqElementTable.get_or_create()
+    electronegativity, hardness = table.electronegativity, table.hardness
+    cell, positions, numbers = get_arrays(CifData(file=str(cif_file)))
+
+    dense = qeq_engine.compute_charges(cell, positions, numbers, electronegativity, hardness)
+    # strict tolerance: only exact symmetries of the structure
+    result, symmetry = symmetry_engine.compute_charges(cell,
+                                                       positions,
+                                                       numbers,
+                                                       electronegativity,
+                                                       hardness,
+                                                       symprec=1e-4)
+    assert len(symmetry.representatives) < len(numbers)
+    assert np.abs(result.charges - dense.charges).max() < 1e-8
+    assert abs(result.energy - dense.energy) < 1e-6
+
+    # default tolerance symmetrises the near-symmetric HKUST-1 structure (Fm-3m)
+    result, symmetry = symmetry_engine.compute_charges(cell, positions, numbers, electronegativity, hardness)
+    for orbit in range(len(symmetry.representatives)):
+        assert np.ptp(result.charges[symmetry.orbits == orbit]) == 0.
+    assert np.abs(result.charges - dense.charges).max() < 5e-3
+
+
+def test_qeq_engine_incremental(aiida_profile):  # pylint: disable=unused-argument
+    """Check that low-rank updates of the parent system reproduce the charges of independent solves."""
+    from aiida_qeq.engines.incremental import IncrementalQeq
+
+    table = QeqElementTable.get_or_create()
+    electronegativity, hardness = table.electronegativity, table.hardness
+    cell, positions, numbers = get_arrays(CifData(file=str(QEQ_REFERENCE_DIR / 'HKUST1.cif')))
+    engine = IncrementalQeq(cell, positions, numbers, electronegativity, hardness)
+
+    # fluorinate two linkers, remove one atom and reorder the atoms
+    variant_numbers = numbers.copy()
+    variant_numbers[np.flatnonzero(numbers == 1)[:2]] = 9
+    order = np.random.RandomState(0).permutation(len(numbers))[1:]  # pylint: disable=no-member
+    variant_positions, variant_numbers = positions[order], variant_numbers[order]
+
+    result = engine.compute_charges(variant_positions, variant_numbers, cell=cell)
+    dense = engine.compute_charges(variant_positions, variant_numbers, max_update_fraction=0.)
+    reference = qeq_engine.compute_charges(cell, variant_positions, variant_numbers, electronegativity, hardness)
+    assert result.converged
+    assert abs(result.charges.sum()) < 1e-8
+    assert np.abs(result.charges - dense.charges).max() < 1e-8
+    # within the convergence threshold of the hydrogen hardness
+    assert np.abs(result.charges - reference.charges).max() < 1e-4
+
+    with pytest.raises(ValueError):
+        engine.compute_charges(positions, numbers, cell=2 * cell)
+
+
+def test_eqeq_engine_sweep(aiida_profile):  # pylint: disable=unused-argument
+    """Check that a parameter sweep with shared Coulomb matrix reproduces independent calculations."""
+    ionization_data = DataFactory('qeq.ionization_table').get_or_create()
+    symbols, energies = ionization_data.symbols, ionization_data.energies
+    charge_centers = DataFactory('qeq.charge_center_table').get_or_create().charge_center_dict
+    cell, positions, numbers = get_arrays(CifData(file=str(TEST_DIR / 'MgO.cif')))
+    numbers[0] = 1  # include hydrogen, whose hardness depends on hI0
+
+    parameters = EQeqParameters({'lambda': [1.0, 1.2], 'hI0': [-2.0, -1.0]})
+    results = eqeq_engine.compute_charges_sweep(cell, positions, numbers, symbols, energies, charge_centers, parameters)
+    assert sorted(results) == parameters.sweep_points
+    for (lambda_, hydrogen_affinity), result in results.items():
+        point = dict(parameters.get_dict(), **{'lambda': lambda_, 'hI0': hydrogen_affinity})
+        reference = eqeq_engine.compute_charges(cell, positions, numbers, symbols, energies, charge_centers, point)
+        assert np.array_equal(result.charges, reference.charges)
+
+
+def test_qeq_fit(aiida_profile):  # pylint: disable=unused-argument,too-many-locals
+    """Check the analytic derivatives of the charges and fit parameters to charges computed with other parameters."""
+    from aiida_qeq.engines import fitting
+    from aiida_qeq.engines.utils import fractional_coordinates, get_symbols
+    from aiida_qeq.utils.cif import cif_node_with_charges
+
+    table = QeqElementTable.get_or_create()
+    electronegativity, hardness = table.electronegativity, table.hardness
+    cell, positions, numbers = get_arrays(CifData(file=str(QEQ_REFERENCE_DIR / 'HKUST1.cif')))
+    elements = np.unique(numbers)  # H, C, O, Cu
+    target_electronegativity, target_hardness = electronegativity.copy(), hardness.copy()
+    target_electronegativity[elements] += [0.3, -0.2, 0.5, 0.1]
+    target_hardness[elements] *= [1.1, 0.9, 1.05, 0.95]
+    reference = qeq_engine.compute_charges(cell, positions, numbers, target_electronegativity, target_hardness)
+
+    structure = fitting.training_structure(cell, positions, numbers, reference.charges)
+    result, jacobian = fitting.charge_derivatives(structure, electronegativity, hardness, elements)
+    step = 1e-5
+    for index, element in enumerate(elements):
+        for offset, values in ((0, electronegativity), (len(elements), hardness)):
+            values[element] += step
+            shifted = fitting.charge_derivatives(structure, electronegativity, hardness, elements)[0]
+            values[element] -= step
+            # within the convergence threshold of the hydrogen hardness
+            assert np.abs((shifted.charges - result.charges) / step - jacobian[:, offset + index]).max() < 1e-4
+
+    fractional = fractional_coordinates(cell, positions)
+    cif = cif_node_with_charges(cell, get_symbols(numbers), fractional, reference.charges, method='qeq')
+    parameters = SinglefileData(file=str(DATA_DIR / data.DEFAULT_PARAM_FILE_NAME))
+    outputs = fitting.fit_qeq_parameters(parameters, hkust1=cif)
+    fit = outputs['fit'].get_dict()
+    assert fit['success']
+    assert fit['elements'] == ['H', 'C', 'O', 'Cu']
+    assert fit['rmsd'] < 1e-3 < fit['initial_rmsd']
+
+    table = outputs['parameters']
+    assert table.filename == data.DEFAULT_PARAM_FILE_NAME
+    fitted = qeq_engine.compute_charges(cell, positions, numbers, table.electronegativity, table.hardness)
+    assert np.abs(fitted.charges - reference.charges).max() < 1e-2
+
+
+def test_cluster_engine(aiida_profile, monkeypatch):  # pylint: disable=unused-argument,too-many-locals
+    """Compare the sparse cluster engines with dense nonperiodic solves, treating HKUST-1 as an isolated cluster."""
+    from aiida_qeq.engines import cluster
+    from aiida_qeq.engines.utils import COULOMB_CONSTANT
+
+    cell, positions, numbers = get_arrays(CifData(file=str(QEQ_REFERENCE_DIR / 'HKUST1.cif')))
+    distances = np.linalg.norm(positions[:, None, :] - positions[None, :, :], axis=2)
+
+    # cell list, split into many chunks
+    monkeypatch.setattr(cluster, 'CHUNK_PAIRS', 1000)
+    pairs = list(cluster.iter_neighbour_pairs(positions, 6.))
+    rows, columns = np.concatenate([pair[0] for pair in pairs]), np.concatenate([pair[1] for pair in pairs])
+    assert (rows < columns).all()
+    assert np.array_equal(np.sort(rows * len(numbers) + columns), np.flatnonzero(np.triu(distances < 6., k=1)))
+
+    # QEq, the dense matrix with 1 / r and orbital overlap corrections for all pairs
+    table = QeqElementTable.get_or_create()
+    electronegativity, hardness = table.electronegativity, table.hardness
+    radii = qeq_engine.default_radii()
+    upper = np.triu_indices(len(numbers), k=1)
+    dense = np.zeros(distances.shape)
+    corrections = qeq_engine.OrbitalCorrections(numbers, radii)
+    dense[upper] = COULOMB_CONSTANT / distances[upper] + corrections(upper[0], upper[1], distances[upper])
+    hydrogen_zeta = np.where(numbers == 1, qeq_engine.slater_exponents(numbers, radii), np.nan)
+    reference = qeq_engine.solve(dense + dense.T, electronegativity[numbers], hardness[numbers], hydrogen_zeta)
+    result = cluster.compute_qeq_charges(positions, numbers, electronegativity, hardness)
+    assert result.converged
+    assert abs(result.charges.sum()) < 1e-8
+    # the shifted potential is accurate in the bulk, the largest deviations are at the surface of the cluster
+    assert np.sqrt(np.mean((result.charges - reference.charges)**2)) < 0.02
+    assert np.abs(result.charges - reference.charges).max() < 0.1
+
+    # EQeq
+    structure = CifData(file=str(QEQ_REFERENCE_DIR / 'HKUST1.cif'))
+    ionization_data = DataFactory('qeq.ionization_table').get_or_create()
+    charge_data = DataFactory('qeq.charge_center_table').get_or_create()
+    parameters = EQeqParameters({'method': 'nonperiodic'})
+    cif = cluster.eqeq_charges_cluster(structure, parameters, ionization_data, charge_data)['structure_with_charges']
+    charges = np.array(cif.values['crystal']['_atom_site_charge'], dtype=float)
+    reference = eqeq_engine.compute_charges(cell, positions, numbers, ionization_data.symbols, ionization_data.energies,
+                                            charge_data.charge_center_dict, parameters.get_dict())
+    assert np.abs(charges - reference.charges).max() < 0.05
+
+    with pytest.raises(ValueError):
+        cluster.eqeq_charges_cluster(structure, EQeqParameters({'method': 'ewald'}), ionization_data, charge_data)
+
+
+def test_coulomb_integral_tables(monkeypatch, tmp_path):  # pylint: disable=too-many-locals
+    """Check that tables are persisted and reloaded, and that interpolation matches the tabulated corrections."""
+    from aiida_qeq.engines import integrals
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setattr(integrals, '_TABLES', {})
+    radii = qeq_engine.default_radii()
+    tables = integrals.CoulombIntegralTables(radii)
+    tables.require([8, 1, 6, 1])
+    assert tables.path.startswith(str(tmp_path))
+    with np.load(tables.path) as handle:
+        assert sorted(handle.files) == ['1-1', '1-6', '1-8', '6-6', '6-8', '8-8']
+
+    # a new process reads the tables from disk instead of computing them
+    monkeypatch.setattr(integrals, '_TABLES', {})
+
+    def fail(*args, **kwargs):
+        raise AssertionError('table was recomputed')
+
+    monkeypatch.setattr(integrals, 'orbital_correction_table', fail)
+    numbers = np.array([1, 6, 8, 6])
+    corrections = qeq_engine.OrbitalCorrections(numbers, radii)
+    monkeypatch.undo()
+
+    distances = np.random.RandomState(0).uniform(0.01, 9., 1000)  # pylint: disable=no-member
+    i, j = np.random.RandomState(1).randint(len(numbers), size=(2, len(distances)))  # pylint: disable=no-member
+    values = corrections(i, j, distances)
+    zeta = integrals.slater_exponents(numbers, radii)
+    n = integrals.principal_quantum_numbers(numbers)
+    for a, b in set(zip(i, j)):
+        pairs = (i == a) & (j == b)
+        grid, table = integrals.orbital_correction_table(n[a], zeta[a], n[b], zeta[b])
+        assert np.abs(values[pairs] - np.interp(distances[pairs], grid, table, right=0.)).max() < 1e-10
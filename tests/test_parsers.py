@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""Tests for parser helpers
+"""
+import io
+import subprocess
+
+import numpy as np
+import pytest
+from aiida.plugins import DataFactory, ParserFactory
+
+from aiida_qeq.calculations.qeq_batch import EXIT_STATUS_FILE_NAME, STDERR_FILE_NAME
+from aiida_qeq.parsers.qeq import parse_log, parse_energy_file, stream_contains
+from aiida_qeq.utils.charges import read_charges_dat, read_charges_json
+from aiida_qeq.engines.utils import get_arrays
+from aiida_qeq.utils.cif import check_charges_cif, cif_node_from_structure, read_p1_cif, structure_arrays
+from aiida_qeq.utils.formats import WRITERS, charges_file_content
+from aiida_qeq.utils.metrics import TIMING_FILE_NAME, read_timing, timing_texts
+from aiida_qeq.utils.transfer import (LOG_SUMMARY_FILE_NAME, compress_text, log_summary_text, open_retrieved,
+                                      retrieved_file_names)
+from aiida_qeq.utils.cube import plane_lines, read_cube_header
+from aiida_qeq.data.qeq import LOG_SUMMARY_PATTERNS
+from tests import DATA_DIR, calcjob_node
+
+HKUST1_DIR = DATA_DIR / 'mock-egulp-2d61ca9-58a7e9adc6ace777832c50046ee34492'
+N2_DIR = DATA_DIR / 'mock-egulp-2d61ca9-c801b39f6a57ae7d3086c45032b06bdc'
+EQEQ_DIR = DATA_DIR / 'mock-eqeq-6490320-5e093ca7b0a5e9d5efcab6054a3dceaf'
+
+
+def test_parse_log_converged():
+    """Parse log of converged qeq calculation."""
+    with open(HKUST1_DIR / 'qeq.log', 'r') as handle:
+        results = parse_log(handle)
+
+    assert results['egulp_version'] == '2.0.2'
+    assert results['num_atoms'] == 624
+    assert results['cell'] == [[26.343, 0., 0.], [0., 26.343, 0.], [0., 0., 26.343]]
+    assert results['scf_converged']
+    assert results['num_scf_cycles'] == 30
+    assert results['scf_qdiff'][-1] == 0.00000943
+    assert 10 in results['remapped_atoms']
+
+    with open(HKUST1_DIR / 'energy.dat', 'r') as handle:
+        energies = parse_energy_file(handle)
+    assert len(energies['scf_energies']) == 30
+    assert energies['energy'] == -178.7138070
+
+
+def test_parse_log_not_converged():
+    """Parse log of qeq calculation with diverging SCF."""
+    with open(N2_DIR / 'qeq.log', 'r') as handle:
+        results = parse_log(handle)
+
+    assert results['scf_converged'] is False
+    assert results['num_scf_cycles'] == 50
+    assert results['scf_qdiff'][-1] is None
+
+
+def test_stream_contains():
+    """Text spanning chunk boundaries is found."""
+    stream = io.StringIO('x' * 10 + 'Segmentation fault' + 'y' * 10)
+    assert stream_contains(stream, 'Segmentation fault', chunk_size=7)
+    assert not stream_contains(io.StringIO('Segmentation'), 'Segmentation fault', chunk_size=4)
+
+
+def test_read_timing(tmp_path):
+    """Wall time recorded by the job script is read back."""
+    prepend_text, append_text = timing_texts()
+    subprocess.run(['bash', '-c', '\n'.join([prepend_text, 'sleep 0.1', append_text])], cwd=str(tmp_path), check=True)
+    with open(str(tmp_path / TIMING_FILE_NAME), 'r') as handle:
+        assert read_timing(handle) >= 0.1
+    # executable did not finish
+    assert read_timing(io.StringIO('start 1600000000.5\n')) is None
+
+
+def test_log_summary_and_compression(aiida_profile, tmp_path):  # pylint: disable=unused-argument
+    """The log summary written by the job script parses like the full log, compressed files are read back."""
+    import shutil
+    FolderData = DataFactory('folder')  # pylint: disable=invalid-name
+    for fname in ('qeq.log', 'charges.dat', 'charges.cif'):
+        shutil.copy(str(HKUST1_DIR / fname), str(tmp_path / fname))
+    script = '\n'.join([log_summary_text('qeq.log', LOG_SUMMARY_PATTERNS), compress_text(['charges.cif'], 1000)])
+    subprocess.run(['bash', '-c', script], cwd=str(tmp_path), check=True)
+
+    with open(str(tmp_path / LOG_SUMMARY_FILE_NAME), 'r') as handle:
+        summary = parse_log(handle)
+    with open(HKUST1_DIR / 'qeq.log', 'r') as handle:
+        assert summary == parse_log(handle)
+
+    (tmp_path / 'qeq.log').unlink()
+    folder = FolderData(tree=str(tmp_path))
+    assert 'charges.cif.gz' in folder.list_object_names()
+    assert 'charges.cif' in retrieved_file_names(folder)
+    with open_retrieved(folder, 'charges.cif') as handle:
+        assert check_charges_cif(handle, 624).charges[0] == 0.6334535
+    with open_retrieved(folder, 'charges.dat') as handle:
+        assert read_charges_dat(handle)[1][0] == 0.6334535
+
+
+def test_read_cube_header():
+    """Header of a cube file is read and the lines of the planes of the grid are located."""
+    content = '\n'.join([
+        'comment',
+        'comment',
+        '    2    0.000000    0.000000    0.000000',
+        '    4    0.500000    0.000000    0.000000',
+        '    3    0.000000    0.500000    0.000000',
+        '    8    0.000000    0.000000    0.500000',
+        '    6    0.000000    0.000000    0.000000    0.000000',
+        '    1    0.000000    1.000000    0.000000    0.000000',
+    ] + ['1. 2. 3. 4. 5. 6.', '7. 8.'] * 12)
+    header = read_cube_header(io.StringIO(content))
+    assert header.shape == (4, 3, 8)
+    assert list(header.numbers) == [6, 1]
+    assert header.num_lines == 8
+    # two lines per row along the third axis, three rows per plane
+    assert plane_lines(header, 1, 3) == (15, 26)
+
+    with pytest.raises(ValueError):
+        read_cube_header(io.StringIO('\n'.join(content.splitlines()[:5])))
+
+
+def test_read_charges():
+    """Charges from egulp and eqeq output files are aligned with the atoms of HKUST-1."""
+    with open(HKUST1_DIR / 'charges.dat', 'r') as handle:
+        numbers, qeq_charges = read_charges_dat(handle)
+    with open(EQEQ_DIR / 'HKUST1.cif_EQeq_ewald_1.20_-2.00.json', 'r') as handle:
+        eqeq_charges = read_charges_json(handle)
+
+    assert len(numbers) == len(qeq_charges) == len(eqeq_charges) == 624
+    assert list(numbers[:3]) == [29, 8, 6]
+    assert qeq_charges[0] == 0.6334535
+    assert eqeq_charges[0] == 0.878
+
+
+def test_cif_node_from_structure(aiida_profile):  # pylint: disable=unused-argument
+    """Structure with charges assembled from the input structure matches charges.dat."""
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    structure = CifData(file=str(HKUST1_DIR / 'HKUST1.cif'))
+    with open(HKUST1_DIR / 'charges.dat', 'r') as handle:
+        numbers, charges = read_charges_dat(handle)
+
+    cif = cif_node_from_structure(structure, charges, method='qeq', numbers=numbers)
+
+    assert cif.get_attribute('partial_charge_method') == 'qeq'
+    cif_charges = np.array(cif.values['crystal']['_atom_site_charge'], dtype=float)
+    assert np.allclose(cif_charges, charges)
+
+
+def test_read_p1_cif():
+    """Atoms and charges of the CIF files written by egulp and eqeq are read into arrays."""
+    with open(HKUST1_DIR / 'charges.cif', 'r') as handle:
+        qeq_cif = read_p1_cif(handle)
+    with open(EQEQ_DIR / 'HKUST1.cif_EQeq_ewald_1.20_-2.00.cif', 'r') as handle:
+        eqeq_cif = check_charges_cif(handle, 624)
+
+    assert np.allclose(qeq_cif.cell_parameters, [26.343, 26.343, 26.343, 90., 90., 90.])
+    assert qeq_cif.symbols[:3] == eqeq_cif.symbols[:3] == ['Cu', 'O', 'C']
+    assert qeq_cif.fractional.shape == (624, 3)
+    assert qeq_cif.charges[0] == 0.6334535
+    assert eqeq_cif.charges[0] == 0.878
+    assert qeq_cif.symmetry_operations == ['x,y,z']
+
+    # SCF of egulp diverged
+    with open(N2_DIR / 'charges.cif', 'r') as handle:
+        with pytest.raises(ValueError):
+            check_charges_cif(handle, 228)
+    with open(HKUST1_DIR / 'charges.cif', 'r') as handle:
+        with pytest.raises(ValueError):
+            check_charges_cif(handle, 228)
+
+
+def test_structure_arrays(aiida_profile):  # pylint: disable=unused-argument
+    """Arrays read by the P1 reader agree with the ones of ase."""
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    for path in [HKUST1_DIR / 'HKUST1.cif', DATA_DIR / '08010N2_DDEC.cif']:
+        structure = CifData(file=str(path))
+        cell, positions, numbers = structure_arrays(structure)
+        reference = get_arrays(structure)
+        assert np.allclose(cell, reference[0], atol=1e-4)
+        assert np.allclose(positions, reference[1], atol=1e-4)
+        assert np.all(numbers == reference[2])
+
+
+def test_charges_file_content(aiida_profile):  # pylint: disable=unused-argument
+    """Other file formats are written from the charged structure or from the input structure and the charges."""
+    import ase.io
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    charged = CifData(file=str(EQEQ_DIR / 'HKUST1.cif_EQeq_ewald_1.20_-2.00.cif'))
+    with open(EQEQ_DIR / 'HKUST1.cif_EQeq_ewald_1.20_-2.00.json', 'r') as handle:
+        charges = read_charges_json(handle)
+
+    for fmt in WRITERS:
+        content = charges_file_content(charged, fmt)
+        assert content == charges_file_content(CifData(file=str(EQEQ_DIR / 'HKUST1.cif')), fmt, charges=charges)
+
+    atoms = ase.io.read(io.StringIO(charges_file_content(charged, 'xyz')), format='extxyz')
+    assert len(atoms) == 624
+    assert np.allclose(atoms.get_initial_charges(), charges)
+
+    with pytest.raises(ValueError):
+        charges_file_content(charged, 'mol')
+    with pytest.raises(ValueError):
+        charges_file_content(charged, 'xyz', charges=charges[:10])
+
+
+def test_qeq_batch_parser(aiida_localhost, tmp_path):
+    """Failures of single structures of a batch are told apart, the batch fails only if all structures fail."""
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    QeqBatchParser = ParserFactory('qeq.qeq_batch')  # pylint: disable=invalid-name
+
+    temporary_files = {
+        'ok': {
+            EXIT_STATUS_FILE_NAME: '0\n',
+            'qeq.log': (HKUST1_DIR / 'qeq.log').read_text()
+        },
+        'segfault': {
+            EXIT_STATUS_FILE_NAME: '139\n',
+            STDERR_FILE_NAME: ''
+        },
+        'not_converged': {
+            EXIT_STATUS_FILE_NAME: '0\n',
+            'qeq.log': (N2_DIR / 'qeq.log').read_text()
+        },
+        'missing': {
+            EXIT_STATUS_FILE_NAME: '0\n'
+        },
+    }
+    for key, files in temporary_files.items():
+        (tmp_path / key).mkdir()
+        for fname, content in files.items():
+            (tmp_path / key / fname).write_text(content)
+    # egulp writes charges.cif even if the SCF diverged
+    retrieved_files = {
+        'ok/charges.cif': (HKUST1_DIR / 'charges.cif').read_text(),
+        'not_converged/charges.cif': (N2_DIR / 'charges.cif').read_text(),
+    }
+    structures = {
+        'structures__{}'.format(key): CifData(file=str(DATA_DIR / '08010N2_DDEC.cif')) for key in temporary_files
+    }
+    node = calcjob_node(aiida_localhost, 'qeq.qeq_batch', structures, retrieved_files)
+
+    results = {
+        key: QeqBatchParser.parse_structure(key, node.outputs.retrieved, str(tmp_path)) for key in temporary_files
+    }
+    assert results['ok'].get_attribute('partial_charge_method') == 'qeq'
+    assert results['segfault'] == 'ERROR_SEGFAULT'
+    assert results['not_converged'] == 'ERROR_SCF_NOT_CONVERGED'
+    assert results['missing'] == 'ERROR_MISSING_OUTPUT'
+
+    del structures['structures__ok']
+    del retrieved_files['ok/charges.cif']
+    node = calcjob_node(aiida_localhost, 'qeq.qeq_batch', structures, retrieved_files)
+    outputs, calcfunction = QeqBatchParser.parse_from_node(node, retrieved_temporary_folder=str(tmp_path))
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_ALL_STRUCTURES_FAILED.status
+    assert outputs['failures'].get_dict() == {
+        'segfault': 'ERROR_SEGFAULT',
+        'not_converged': 'ERROR_SCF_NOT_CONVERGED',
+        'missing': 'ERROR_MISSING_OUTPUT',
+    }
+    assert 'structure_with_charges' not in outputs
+
+
+def test_qeq_parser_hkust1(aiida_localhost, tmp_path):
+    """QeqParser stores charges, structure with charges and other retrieved files of a HKUST-1 calculation."""
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    (tmp_path / 'qeq.log').write_text((HKUST1_DIR / 'qeq.log').read_text())
+    retrieve = ['charges.cif', 'charges.dat', 'energy.dat']
+    configure = DataFactory('qeq.qeq')(dict={'retrieve': retrieve})
+    inputs = {
+        'structure': CifData(file=str(HKUST1_DIR / 'HKUST1.cif')),
+        'parameters': DataFactory('qeq.element_table').get_or_create(),
+        'configure': configure,
+    }
+    files = {fname: (HKUST1_DIR / fname).read_text() for fname in retrieve}
+    files['_scheduler-stderr.txt'] = ''
+    node = calcjob_node(aiida_localhost, 'qeq.qeq', inputs, files)
+
+    outputs, calcfunction = ParserFactory('qeq.qeq').parse_from_node(node, retrieved_temporary_folder=str(tmp_path))
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_status
+    assert outputs['charges'].get_array('charges')[0] == 0.6334535
+    assert len(outputs['charges'].get_array('atomic_numbers')) == 624
+    assert outputs['structure_with_charges'].get_attribute('partial_charge_method') == 'qeq'
+    assert outputs['output_parameters']['energy'] == -178.7138070
+    assert outputs['energy_dat'].get_content() == files['energy.dat']
+    assert outputs['metrics']['num_atoms'] == 624
+
+
+def test_qeq_parser_charges_only(aiida_localhost, tmp_path):
+    """With only charges.dat retrieved, QeqParser attaches the charges to the input structure."""
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    (tmp_path / 'qeq.log').write_text((HKUST1_DIR / 'qeq.log').read_text())
+    configure = DataFactory('qeq.qeq')(dict={'retrieve': ['charges.dat']})
+    inputs = {
+        'structure': CifData(file=str(HKUST1_DIR / 'HKUST1.cif')),
+        'parameters': DataFactory('qeq.element_table').get_or_create(),
+        'configure': configure,
+    }
+    files = {'charges.dat': (HKUST1_DIR / 'charges.dat').read_text(), '_scheduler-stderr.txt': ''}
+    node = calcjob_node(aiida_localhost, 'qeq.qeq', inputs, files)
+
+    outputs, calcfunction = ParserFactory('qeq.qeq').parse_from_node(node, retrieved_temporary_folder=str(tmp_path))
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_status
+    charges = outputs['charges'].get_array('charges')
+    cif = outputs['structure_with_charges']
+    assert cif.get_attribute('partial_charge_method') == 'qeq'
+    with cif.open() as handle:
+        assert np.allclose(read_p1_cif(handle).charges, charges)
+    with open(HKUST1_DIR / 'charges.cif', 'r') as handle:
+        assert np.allclose(read_p1_cif(handle).charges, charges)
+
+
+def test_eqeq_parser_charges_only(aiida_localhost, tmp_path):
+    """With only the JSON output retrieved, EQeqParser attaches the charges to the input structure."""
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    parameters = DataFactory('qeq.eqeq')(dict={'retrieve': ['json']})
+    structure = CifData(file=str(EQEQ_DIR / 'HKUST1.cif'))
+    json_file = parameters.output_files_dict(structure.filename)['json']
+    (tmp_path / json_file).write_text((EQEQ_DIR / json_file).read_text())
+    inputs = {
+        'structure': structure,
+        'parameters': parameters,
+        'charge_data': DataFactory('qeq.charge_center_table').get_or_create(),
+        'ionization_data': DataFactory('qeq.ionization_table').get_or_create(),
+    }
+    node = calcjob_node(aiida_localhost, 'qeq.eqeq', inputs, {'_scheduler-stderr.txt': ''})
+
+    outputs, calcfunction = ParserFactory('qeq.eqeq').parse_from_node(node, retrieved_temporary_folder=str(tmp_path))
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_status
+    charges = outputs['charges'].get_array('charges')
+    assert charges[0] == 0.878
+    cif = outputs['structure_with_charges']
+    assert cif.get_attribute('partial_charge_method') == 'eqeq'
+    assert cif.filename == structure.filename
+    with cif.open() as handle:
+        assert np.allclose(read_p1_cif(handle).charges, charges)
+    with open(EQEQ_DIR / 'HKUST1.cif_EQeq_ewald_1.20_-2.00.cif', 'r') as handle:
+        assert np.allclose(read_p1_cif(handle).charges, charges)
+
+
+def test_eqeq_parser_truncated_json(aiida_localhost, tmp_path):
+    """EQeqParser fails if the JSON file written by eqeq has fewer charges than the input structure has atoms."""
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    parameters = DataFactory('qeq.eqeq')(dict={'retrieve': ['json']})
+    structure = CifData(file=str(EQEQ_DIR / 'HKUST1.cif'))
+    json_file = parameters.output_files_dict(structure.filename)['json']
+    content = (EQEQ_DIR / json_file).read_text()
+    (tmp_path / json_file).write_text(content[:content.index(',', len(content) // 2)])
+    inputs = {
+        'structure': structure,
+        'parameters': parameters,
+        'charge_data': DataFactory('qeq.charge_center_table').get_or_create(),
+        'ionization_data': DataFactory('qeq.ionization_table').get_or_create(),
+    }
+    node = calcjob_node(aiida_localhost, 'qeq.eqeq', inputs, {'_scheduler-stderr.txt': ''})
+
+    outputs, calcfunction = ParserFactory('qeq.eqeq').parse_from_node(node, retrieved_temporary_folder=str(tmp_path))
+
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_CHARGES_INCONSISTENT.status
+    assert 'charges' not in outputs
+
+
+def test_eqeq_parser_sweep(aiida_localhost, tmp_path):
+    """EQeqParser adds the charges of each point of a sweep, and fails only if no point has charges."""
+    from aiida_qeq.data.eqeq import sweep_key
+    CifData = DataFactory('cif')  # pylint: disable=invalid-name
+    parameters = DataFactory('qeq.eqeq')({'lambda': 1.2, 'hI0': [-2.0, -1.0]})
+    structure = CifData(file=str(EQEQ_DIR / 'HKUST1.cif'))
+    output_dict = parameters.output_files_dict(structure.filename, (1.2, -2.0))
+    (tmp_path / output_dict['json']).write_text((EQEQ_DIR / output_dict['json']).read_text())
+    inputs = {
+        'structure': structure,
+        'parameters': parameters,
+        'charge_data': DataFactory('qeq.charge_center_table').get_or_create(),
+        'ionization_data': DataFactory('qeq.ionization_table').get_or_create(),
+    }
+    files = {output_dict['cif']: (EQEQ_DIR / output_dict['cif']).read_text(), '_scheduler-stderr.txt': ''}
+
+    # the outputs of a sweep are namespaced, which `Parser.parse_from_node` does not support
+    parser = ParserFactory('qeq.eqeq')(calcjob_node(aiida_localhost, 'qeq.eqeq', inputs, files))
+    assert parser.parse(retrieved_temporary_folder=str(tmp_path)) is None
+    key = sweep_key((1.2, -2.0))
+    assert sorted(parser.outputs) == ['charges_sweep.' + key, 'metrics', 'structure_with_charges_sweep.' + key]
+    assert parser.outputs['charges_sweep.' + key].get_array('charges')[0] == 0.878
+    assert parser.outputs['structure_with_charges_sweep.' + key].get_attribute('partial_charge_method') == 'eqeq'
+
+    parser = ParserFactory('qeq.eqeq')(calcjob_node(aiida_localhost, 'qeq.eqeq', inputs, {'_scheduler-stderr.txt': ''}))
+    assert parser.parse() == parser.exit_codes.ERROR_MISSING_OUTPUT
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Tests for the qeq workflows
+"""
+
+import os
+
+import numpy as np
+from aiida.plugins import DataFactory, WorkflowFactory
+from aiida import engine
+from aiida.orm import Int, List, Str
+from plumpy import ProcessState
+
+from aiida_qeq.utils.charges import charges_array
+from aiida_qeq.workflows.qeq import attach_charges, charges_match, collect_values
+from tests import TEST_DIR, DATA_DIR as TEST_DATA_DIR, calcjob_node
+
+QeqBaseWorkChain = WorkflowFactory('qeq.qeq_base')
+CifData = DataFactory('cif')
+QeqElementTable = DataFactory('qeq.element_table')
+QeqParameters = DataFactory('qeq.qeq')
+
+
+def generate_workchain(inputs):
+    """Return a `QeqBaseWorkChain` instance with the given inputs, without running it."""
+    from aiida.engine.utils import instantiate_process
+    from aiida.manage.manager import get_manager
+
+    return instantiate_process(get_manager().get_runner(), QeqBaseWorkChain, **inputs)
+
+
+def test_qeq_base_scf_failure(qeq_code):
+    """Check that the workchain stops with exit code 801 once no other imethod is left to try.
+    """
+    builder = QeqBaseWorkChain.get_builder()
+    builder.qeq.code = qeq_code
+    builder.qeq.structure = CifData(file=os.path.join(TEST_DATA_DIR, '08010N2_DDEC.cif'))
+    builder.qeq.parameters = QeqElementTable.get_or_create()
+    builder.imethods = List(list=[])
+
+    _result, node = engine.run_get_node(builder)
+
+    assert node.exit_status == 801
+    assert len(node.called) == 1
+
+
+def test_qeq_base_scf_restart(qeq_code):
+    """Check that a calculation whose SCF does not converge is restarted with the next imethod.
+    """
+    process = generate_workchain({
+        'qeq': {
+            'code': qeq_code,
+            'structure': CifData(file=os.path.join(TEST_DATA_DIR, '08010N2_DDEC.cif')),
+            'parameters': QeqElementTable.get_or_create(),
+            'configure': QeqParameters(dict={'imethod': 0}),
+        },
+        'imethods': List(list=[1, 2]),
+    })
+    process.setup()
+
+    node = calcjob_node(qeq_code.computer, 'qeq.qeq', {}, {})
+    node.set_process_state(ProcessState.FINISHED)
+    node.set_exit_status(801)
+    report = process.handle_scf_not_converged(node)
+
+    assert report.do_break
+    assert report.exit_code.status == 0
+    assert process.ctx.inputs.configure['imethod'] == 1
+    assert 'imethod 1' in process.ctx.inputs.configure.configure_string
+    assert process.ctx.imethods == [2]
+
+    # calculations failing for other reasons are not handled
+    node = calcjob_node(qeq_code.computer, 'qeq.qeq', {}, {})
+    node.set_process_state(ProcessState.FINISHED)
+    node.set_exit_status(802)
+    assert process.handle_scf_not_converged(node) is None
+
+
+def test_qeq_base_initial_charges(qeq_code):
+    """Check that matching initial charges are written into the structure and used as initial guess.
+    """
+    structure = CifData(file=os.path.join(TEST_DIR, 'MgO.cif'))
+    numbers = structure.get_ase().numbers
+    charges = charges_array(np.where(numbers == 12, 1.5, -1.5), numbers, method='qeq')
+    inputs = {
+        'qeq': {
+            'code': qeq_code,
+            'structure': structure,
+            'parameters': QeqElementTable.get_or_create(),
+        },
+        'initial_charges': charges,
+    }
+
+    process = generate_workchain(inputs)
+    process.setup()
+
+    configure = process.ctx.inputs.configure
+    assert configure['point_charges_present']
+    assert 'point_charges_present 1' in configure.configure_string
+    cif = process.ctx.inputs.structure
+    assert cif.filename == structure.filename
+    assert np.allclose(np.array(cif.values['crystal']['_atom_site_charge'], dtype=float), charges.get_array('charges'))
+
+    # charges of another structure are ignored
+    inputs['initial_charges'] = charges_array([1.5, -1.5], [12, 8], method='qeq')
+    process = generate_workchain(inputs)
+    process.setup()
+
+    assert 'configure' not in process.ctx.inputs
+    assert process.ctx.inputs.structure.uuid == structure.uuid
+
+
+def test_attach_charges(aiida_profile):  # pylint: disable=unused-argument
+    """Check that initial charges are written into the structure and mismatching charges are detected.
+    """
+    structure = CifData(file=os.path.join(TEST_DIR, 'MgO.cif'))
+    numbers = structure.get_ase().numbers
+    charges = charges_array(np.where(numbers == 12, 1.5, -1.5), numbers, method='qeq')
+
+    assert charges_match(structure, charges)
+    assert not charges_match(structure, charges_array([1.5, -1.5], [12, 8], method='qeq'))
+
+    cif = attach_charges(structure, charges)
+    assert cif.filename == structure.filename
+    assert np.allclose(np.array(cif.values['crystal']['_atom_site_charge'], dtype=float), charges.get_array('charges'))
+
+
+def test_collect_values(aiida_profile):  # pylint: disable=unused-argument
+    """Check that the exit status of failed structures is collected into a `Dict` created by a calcfunction.
+    """
+    failures = collect_values(frame_000=Int(410), frame_002=Str('excepted'))
+    assert failures.get_dict() == {'frame_000': 410, 'frame_002': 'excepted'}
+    assert failures.creator.process_label == 'collect_values'
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Tests for the screening workflow
+"""
+
+import os
+
+from aiida import engine
+from aiida.orm import Group, Int, List, Str, load_group
+from aiida.plugins import DataFactory, WorkflowFactory
+
+from tests import DATA_DIR as TEST_DATA_DIR
+
+QeqScreeningWorkChain = WorkflowFactory('qeq.screening')
+CifData = DataFactory('cif')
+QeqElementTable = DataFactory('qeq.element_table')
+
+HKUST1_DIR = TEST_DATA_DIR / 'mock-egulp-2d61ca9-58a7e9adc6ace777832c50046ee34492'
+
+
+def test_qeq_screening(clear_database_before_test, qeq_code):  # pylint: disable=unused-argument
+    """Screen a group with one converging and one failing structure, then resume without recomputing.
+    """
+    hkust1 = CifData(file=str(HKUST1_DIR / 'HKUST1.cif')).store()
+    n2 = CifData(file=os.path.join(TEST_DATA_DIR, '08010N2_DDEC.cif')).store()
+    group = Group(label='test_qeq_screening').store()
+    group.add_nodes([hkust1, n2])
+
+    builder = QeqScreeningWorkChain.get_builder()
+    builder.base.qeq.code = qeq_code
+    builder.base.qeq.parameters = QeqElementTable.get_or_create()
+    builder.base.imethods = List(list=[])
+    builder.structure_group = Str(group.label)
+    builder.max_concurrent = Int(1)
+
+    result, node = engine.run_get_node(builder)
+
+    assert node.is_finished_ok
+    summary = result['summary'].get_dict()
+    assert summary['num_succeeded'] == 1
+    assert summary['num_failed'] == 1
+    assert list(result['failures'].get_dict()) == ['structure_{}'.format(n2.pk)]
+    assert result['summary'].creator.process_label == 'collect_values'
+    charged = list(load_group(label=summary['result_group']).nodes)
+    assert len(charged) == 1
+    assert charged[0].get_extra('source_structure') == hkust1.uuid
+
+    # HKUST-1 is skipped, only N2 is computed again
+    result, node = engine.run_get_node(builder)
+
+    summary = result['summary'].get_dict()
+    assert summary['num_skipped'] == 1
+    assert summary['num_failed'] == 1
+    assert [called.process_label for called in node.called].count('QeqBaseWorkChain') == 1